@@ -122,6 +122,7 @@ INSTALLED_APPS = (
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'django_extensions',
     'simple_history',
     'rest_framework.authtoken',
@@ -160,6 +161,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     'simple_history.middleware.HistoryRequestMiddleware',
     'admin_reorder.middleware.ModelAdminReorder',
+    'data_facility_integrations.middleware.RdsAccessBatchMiddleware',
     'django_prometheus.middleware.PrometheusAfterMiddleware',
 )
 
@@ -350,7 +352,10 @@ LDAP_SETTINGS = {
         'AttributesBlackList': ['memberUid'],
         'RecreateGroups': False,
         'SystemUserPpolicyConfig': config('LDAP_SYSTEM_USER_POLICY_CONFIG', default=''),
-        'PpolicyLockDownDurationSeconds': 900
+        'PpolicyLockDownDurationSeconds': 900,
+        'ExportPoolSize': config('LDAP_EXPORT_POOL_SIZE', cast=int, default=4),
+        'FullExportIntervalHours': config('LDAP_FULL_EXPORT_INTERVAL_HOURS', cast=int, default=24),
+        'SearchPageSize': config('LDAP_SEARCH_PAGE_SIZE', cast=int, default=500),
     },
     'Connection': {
         'BindDN': config('LDAP_BIND_DN', default='cn=admin,' + LDAP_BASE_DN),
@@ -405,6 +410,15 @@ AUTH_LDAP_GROUP_CACHE_TIMEOUT = config('AUTH_LDAP_GROUP_CACHE_TIMEOUT',
                                        cast=int,
                                        default=5 * 60)
 
+# Seconds the active roles of a user are cached by the API (data_facility_admin.roles).
+ROLE_CACHE_TIMEOUT = config('ROLE_CACHE_TIMEOUT', cast=int, default=60)
+
+# Seconds the dataset catalog API responses are cached, unless the catalog changes (data_facility_admin.catalog).
+CATALOG_CACHE_TIMEOUT = config('CATALOG_CACHE_TIMEOUT', cast=int, default=5 * 60)
+
+# Also match datasets by trigram similarity of their names in searches (DatasetQuerySet.search).
+DATASET_SEARCH_TRIGRAM = config('DATASET_SEARCH_TRIGRAM', cast=bool, default=True)
+
 AUTHENTICATION_BACKENDS = (
     'django.contrib.auth.backends.ModelBackend',
     'django_auth_ldap.backend.LDAPBackend',
@@ -434,6 +448,18 @@ DATABASES = {
     },
 }
 
+# Shared by the uWSGI workers and the scripts, so invalidations are seen by all the processes
+# (data_facility_admin.roles and catalog). The database cache table is created by a migration.
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': config('CACHE_LOCATION', default='dfadmin_cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': config('CACHE_MAX_ENTRIES', cast=int, default=10000),
+        },
+    },
+}
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.7/topics/i18n/
 LANGUAGE_CODE = 'en-us'
@@ -578,6 +604,9 @@ DFAFMIN_API_GENERIC_GROUP = config('DFAFMIN_API_GENERIC_GROUP', default='Authent
 
 SNS_HOOK = {
     'ACTIVE': config('SNS_HOOK_ACTIVE', cast=bool, default=False),
+    # Where the events go: 'sns', 'memory' or 'file' (JSON lines appended to FILE_PATH), see event_hooks.
+    'TRANSPORT': config('SNS_HOOK_TRANSPORT', default='sns'),
+    'FILE_PATH': config('SNS_HOOK_FILE_PATH', default='sns_events.jsonl'),
     'BASE_ARN': config('SNS_HOOK_BASE_ARN', default='?'),
     'REGION': config('SNS_HOOK_REGION', default='us-east-1'),
     'AWS_ACCESS_KEY_ID': config('AWS_ACCESS_KEY_ID', default=None),
@@ -590,6 +619,15 @@ SNS_HOOK = {
     'TOPIC_DATASET_DEACTIVATED': config('SNS_HOOK_TOPIC_DATASET_DEACTIVATED', default='adrf-dataset-deactivated'),
     'TOPIC_DATASET_DB_ACTIVATED': config('SNS_HOOK_TOPIC_DATASET_DB_ACTIVATED', default='adrf-dataset-db-activated'),
     'TOPIC_DATASET_DB_DEACTIVATED': config('SNS_HOOK_TOPIC_DATASET_DB_DEACTIVATED', default='adrf-dataset-db-deactivated'),
+    # Summary of the events of a bulk operation, see event_hooks.coalesce_dataset_events.
+    'TOPIC_DATASET_BATCH': config('SNS_HOOK_TOPIC_DATASET_BATCH', default='adrf-dataset-batch'),
+
+    # Delivery of the queued events (data_facility_admin.outbox). Delays are in seconds.
+    'OUTBOX_BATCH_SIZE': config('SNS_HOOK_OUTBOX_BATCH_SIZE', cast=int, default=100),
+    'OUTBOX_MAX_ATTEMPTS': config('SNS_HOOK_OUTBOX_MAX_ATTEMPTS', cast=int, default=10),
+    'OUTBOX_RETRY_DELAY': config('SNS_HOOK_OUTBOX_RETRY_DELAY', cast=int, default=30),
+    'OUTBOX_MAX_RETRY_DELAY': config('SNS_HOOK_OUTBOX_MAX_RETRY_DELAY', cast=int, default=60 * 60),
+    'OUTBOX_POLL_INTERVAL': config('SNS_HOOK_OUTBOX_POLL_INTERVAL', cast=int, default=5),
 }
 
 # Django Debug Toolbar config
@@ -10,6 +10,12 @@ print('logging configuration is updated for tests: logs go to "FILE" only.')
 RDS_INTEGRATION = False
 WS_K8S_INTEGRATION = False
 SNS_HOOK['ACTIVE'] = False
+# mockldap does not support the paged results control.
+LDAP_SETTINGS['General']['SearchPageSize'] = 0
+# Tests run in one process, and the cache outlives the test transactions.
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+ROLE_CACHE_TIMEOUT = 0
+CATALOG_CACHE_TIMEOUT = 0
 
 LOGGING['loggers']['data_facility_admin']['handlers'] = ['file']
 LOGGING['loggers']['data_facility_integrations']['handlers'] = ['file']
@@ -0,0 +1,227 @@
+''' Set-based resolution of who has access to what: users -> projects -> datasets.
+
+The per-object model methods (Project.active_members, Dataset.active_members, ...) used to walk
+the related rows in Python. AccessGraph loads the active memberships, instructor roles and dataset
+accesses of many projects at once, with the time windows filtered by the database, and answers the
+per-project, per-dataset and per-user questions from memory.
+'''
+import datetime
+from django.db.models import Min, Q
+from django.utils import timezone
+from data_facility_admin.models import User, Project, ProjectMember, ProjectRole, UserDfRole
+from data_facility_admin.models import Dataset, DatasetAccess
+
+
+def active_project_members(now):
+    ''' Filter for the ProjectMembers active at now (same as ProjectMember.active()). '''
+    return Q(start_date__lte=now, member__status__in=User.MEMBERSHIP_STATUS_WHITELIST) & \
+        (Q(end_date__isnull=True) | Q(end_date__gte=now))
+
+
+def active_user_df_roles(now):
+    ''' Filter for the UserDfRoles active at now (same as DfRole.active_users()). '''
+    return Q(begin__lte=now, user__status__in=User.MEMBERSHIP_STATUS_WHITELIST) & \
+        (Q(end__isnull=True) | Q(end__gt=now))
+
+
+def active_dataset_accesses(now):
+    ''' Filter for the DatasetAccesses active at now (same as DatasetAccess.status()). '''
+    return Q(dataset__status=Dataset.STATUS_ACTIVE) & \
+        (Q(dataset__expiration__isnull=True) | Q(dataset__expiration__gte=now.date())) & \
+        (Q(start_at__isnull=True) | Q(start_at__lte=now)) & \
+        (Q(end_at__isnull=True) | Q(end_at__gte=now))
+
+
+class AccessGraph(object):
+    ''' The effective permissions of a set of projects, loaded in three queries. '''
+
+    def __init__(self, projects, now=None):
+        self.now = now or timezone.now()
+        self.projects = dict((project.id, project) for project in projects)
+        # project id -> {user id: (user, system role)}
+        self._members = dict((project_id, {}) for project_id in self.projects)
+        # role id -> [users]
+        self._instructors = {}
+        # project id -> [datasets]
+        self._datasets = dict((project_id, []) for project_id in self.projects)
+        self._public_members = None
+
+        for pm in ProjectMember.objects.filter(active_project_members(self.now),
+                                               project__in=list(self.projects)) \
+                .select_related('member', 'role').order_by('id'):
+            self._members[pm.project_id][pm.member_id] = (pm.member, pm.role.system_role)
+
+        instructor_roles = set(project.instructors_id for project in self.projects.values()
+                               if project.instructors_id)
+        if instructor_roles:
+            self._instructors = dict((role_id, []) for role_id in instructor_roles)
+            for user_df_role in UserDfRole.objects.filter(active_user_df_roles(self.now),
+                                                          role__in=instructor_roles) \
+                    .select_related('user').order_by('id'):
+                self._instructors[user_df_role.role_id].append(user_df_role.user)
+
+        for access in DatasetAccess.objects.filter(active_dataset_accesses(self.now),
+                                                   project__in=list(self.projects)) \
+                .select_related('dataset', 'dataset__database_schema').order_by('id'):
+            self._datasets[access.project_id].append(access.dataset)
+
+    @classmethod
+    def for_datasets(cls, datasets, now=None):
+        ''' Graph with the active projects that have access to any of the datasets. '''
+        projects = Project.objects.filter(status=Project.STATUS_ACTIVE,
+                                          datasetaccess__dataset__in=list(datasets)).distinct()
+        return cls(projects, now)
+
+    @classmethod
+    def attach(cls, projects, now=None):
+        ''' Builds a graph for the projects and attaches it to them, so their active_members,
+            active_member_permissions and datasets_with_access methods share it. '''
+        projects = list(projects)
+        graph = cls(projects, now)
+        for project in projects:
+            project.access_graph = graph
+        return graph
+
+    def users(self):
+        ''' The User objects of all the memberships and instructor roles, e.g. to prefetch their relations. '''
+        users = [member for members in self._members.values() for member, _ in members.values()]
+        for instructors in self._instructors.values():
+            users.extend(instructors)
+        return users
+
+    def instructors(self, project):
+        return self._instructors.get(self.projects[project.id].instructors_id, [])
+
+    # Per project
+    def members(self, project):
+        members = set(member for member, _ in self._members[project.id].values())
+        members.update(self.instructors(project))
+        return members
+
+    def member_permissions(self, project):
+        # Project Instructors have write permissions by default.
+        permissions = [{'username': user.username, 'system_role': ProjectRole.SYSTEM_ROLE_WRITER}
+                       for user in self.instructors(project)]
+        instructor_ids = set(user.id for user in self.instructors(project))
+        # Member permissions depend on associated project role.
+        for user_id, (member, system_role) in sorted(self._members[project.id].items()):
+            if user_id not in instructor_ids:
+                permissions.append({'username': member.username, 'system_role': system_role})
+        return permissions
+
+    def datasets(self, project):
+        return list(self._datasets[project.id])
+
+    # Per dataset
+    def dataset_members(self, dataset):
+        if dataset.public:
+            if self._public_members is None:
+                self._public_members = set(User.objects.filter(status__in=User.MEMBERSHIP_STATUS_WHITELIST))
+            return set(self._public_members)
+        members = set()
+        for project_id, datasets in self._datasets.items():
+            if self.projects[project_id].status == Project.STATUS_ACTIVE and \
+                    any(d.id == dataset.id for d in datasets):
+                members.update(self.members(self.projects[project_id]))
+        return members
+
+    # Per user
+    def user_projects(self, user):
+        return [project for project in self.projects.values() if user in self.members(project)]
+
+    def user_datasets(self, user):
+        datasets = {}
+        for project in self.user_projects(user):
+            if project.status == Project.STATUS_ACTIVE:
+                for dataset in self._datasets[project.id]:
+                    datasets[dataset.id] = dataset
+        return list(datasets.values())
+
+
+def dataset_member_ldap_names(datasets, now=None):
+    ''' The ldap_names of the active members of each dataset: a dict from dataset id to a frozenset.
+        Members are deduplicated by the database and never loaded as User objects. Public datasets
+        share a single set with all the active users, loaded once.
+    '''
+    now = now or timezone.now()
+    datasets = list(datasets)
+    members = {}
+    public_members = None
+    private_ids = []
+    for dataset in datasets:
+        if dataset.public:
+            if public_members is None:
+                public_members = frozenset(User.objects.filter(status__in=User.MEMBERSHIP_STATUS_WHITELIST)
+                                           .values_list('ldap_name', flat=True))
+            members[dataset.id] = public_members
+        else:
+            private_ids.append(dataset.id)
+            members[dataset.id] = set()
+    if not private_ids:
+        return members
+
+    accesses = DatasetAccess.objects.filter(active_dataset_accesses(now),
+                                            dataset__in=private_ids,
+                                            project__status=Project.STATUS_ACTIVE)
+    # Each filter() call keeps the conditions on the same membership row.
+    project_members = accesses.filter(
+        Q(project__projectmember__end_date__isnull=True) | Q(project__projectmember__end_date__gte=now),
+        project__projectmember__start_date__lte=now,
+        project__projectmember__member__status__in=User.MEMBERSHIP_STATUS_WHITELIST) \
+        .values_list('dataset_id', 'project__projectmember__member__ldap_name').distinct()
+    instructors = accesses.filter(
+        Q(project__instructors__userdfrole__end__isnull=True) |
+        Q(project__instructors__userdfrole__end__gt=now),
+        project__instructors__userdfrole__begin__lte=now,
+        project__instructors__userdfrole__user__status__in=User.MEMBERSHIP_STATUS_WHITELIST) \
+        .values_list('dataset_id', 'project__instructors__userdfrole__user__ldap_name').distinct()
+    for rows in (project_members, instructors):
+        for dataset_id, ldap_name in rows:
+            members[dataset_id].add(ldap_name)
+    for dataset_id in private_ids:
+        members[dataset_id] = frozenset(members[dataset_id])
+    return members
+
+
+def next_access_changes(projects, now=None):
+    ''' When the permissions of each project change by themselves, as memberships, instructor roles and
+        dataset accesses start or end and datasets expire: a dict from project id to the first of those
+        times after now. Projects without any are left out.
+    '''
+    now = now or timezone.now()
+    projects = list(projects)
+    project_ids = [project.id for project in projects]
+    changes = {}
+
+    def add(rows):
+        for project_id, when in rows:
+            if when is not None and (project_id not in changes or when < changes[project_id]):
+                changes[project_id] = when
+
+    def first_after(queryset, group_by, field, lookup, value=now):
+        # order_by() keeps the default ordering out of the GROUP BY.
+        return queryset.filter(**{'%s__%s' % (field, lookup): value}).order_by() \
+            .values(group_by).annotate(first=Min(field)).values_list(group_by, 'first')
+
+    members = ProjectMember.objects.filter(project__in=project_ids)
+    add(first_after(members, 'project_id', 'start_date', 'gt'))
+    add(first_after(members, 'project_id', 'end_date', 'gte'))
+
+    accesses = DatasetAccess.objects.filter(project__in=project_ids)
+    add(first_after(accesses, 'project_id', 'start_at', 'gt'))
+    add(first_after(accesses, 'project_id', 'end_at', 'gte'))
+    # Datasets expire at the end of their expiration date.
+    add((project_id, timezone.make_aware(datetime.datetime.combine(expiration + datetime.timedelta(days=1),
+                                                                   datetime.time.min), timezone.utc))
+        for project_id, expiration in first_after(accesses, 'project_id', 'dataset__expiration', 'gte', now.date()))
+
+    projects_by_role = {}
+    for project in projects:
+        if project.instructors_id:
+            projects_by_role.setdefault(project.instructors_id, []).append(project.id)
+    if projects_by_role:
+        roles = UserDfRole.objects.filter(role__in=list(projects_by_role))
+        for field in ('begin', 'end'):
+            add((project_id, when) for role_id, when in first_after(roles, 'role_id', field, 'gt')
+                for project_id in projects_by_role[role_id])
+    return changes
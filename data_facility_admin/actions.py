@@ -2,31 +2,42 @@
 from requests import ConnectionError, HTTPError, TooManyRedirects
 
 from .models import User
+from data_facility_admin import entitlements
 from data_facility_admin.helpers import KeycloakHelper, EmailHelper
 from django.conf import settings
 from django.contrib import messages
+from django.utils import timezone
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+def update_users_status(queryset, status):
+    ''' Updates the status of the users without saving each one, removing their entitlement snapshots. '''
+    users = list(queryset.values_list('pk', flat=True))
+    # The update sends no post_save, so the snapshots showing the users are removed here.
+    project_ids = entitlements.users_project_ids(users)
+    User.objects.filter(pk__in=users).update(status=status, updated_at=timezone.now())
+    entitlements.invalidate(project_ids)
+
+
 def user_unlock(modeladmin, request, queryset):
     ''' Unlock selected users. '''
-    queryset.update(status=User.STATUS_UNLOCKED_BY_ADMIN)
+    update_users_status(queryset, User.STATUS_UNLOCKED_BY_ADMIN)
     messages.success(request, "Success! Users unlocked.")
 user_unlock.short_description = "Unlock selected users"
 
 
 def user_disable(modeladmin, request, queryset):
     ''' Unlock selected users. '''
-    queryset.update(status=User.STATUS_DISABLED)
+    update_users_status(queryset, User.STATUS_DISABLED)
     messages.success(request, "Success! Users disabled.")
 user_disable.short_description = "Disable selected users (Use instead of Delete)"
 
 
 def user_activate(modeladmin, request, queryset):
     ''' Unlock selected users. '''
-    queryset.filter(status=User.STATUS_PENDING_APPROVAL).update(status=User.STATUS_NEW)
+    update_users_status(queryset.filter(status=User.STATUS_PENDING_APPROVAL), User.STATUS_NEW)
     messages.success(request, "Success! Users activated")
 user_activate.short_description = "Activate selected users (Status will be New)"
 
@@ -3,6 +3,7 @@
 from ajax_select.admin import AjaxSelectAdmin
 from ajax_select import make_ajax_form
 from django.contrib import admin
+from django.contrib.admin.views.main import ORDER_VAR
 from rest_framework.authtoken.models import Token
 from simple_history.admin import SimpleHistoryAdmin
 from .models import *
@@ -179,6 +180,16 @@ class DatasetAdmin(SimpleHistoryAdmin):
     inlines = [DatasetAgreementInline, DataStewardInline, DatasetAccessInline]
     readonly_fields = ['ldap_id', 'ldap_name', 'system_status']
 
+    def get_search_results(self, request, queryset, search_term):
+        # Uses the dataset search vector, see DatasetQuerySet.search. Results are ordered by rank unless
+        # another ordering is chosen.
+        if not search_term:
+            return queryset, False
+        results = queryset.search(search_term)
+        if ORDER_VAR in request.GET:
+            results = results.order_by(*queryset.query.order_by)
+        return results, False
+
 
 @admin.register(TermsOfUse)
 class TermsOfUseAdmin(SimpleHistoryAdmin):
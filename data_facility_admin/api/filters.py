@@ -0,0 +1,14 @@
+''' Filter backends of the API '''
+from rest_framework.filters import SearchFilter
+
+
+class DatasetSearchFilter(SearchFilter):
+    """
+    Searches the datasets with their full-text index (see DatasetQuerySet.search), ordered by rank.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        text = ' '.join(self.get_search_terms(request))
+        if not text:
+            return queryset
+        return queryset.search(text)
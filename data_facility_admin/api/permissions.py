@@ -1,4 +1,4 @@
-from rest_framework.permissions import DjangoModelPermissions
+from rest_framework.permissions import BasePermission, DjangoModelPermissions
 
 class ADRFPermissions(DjangoModelPermissions):
     perms_map = {
@@ -11,3 +11,12 @@ class ADRFPermissions(DjangoModelPermissions):
         'DELETE': ['%(app_label)s.delete_%(model_name)s'],
     }
 
+
+class EntitlementChangesPermissions(BasePermission):
+    ''' The permission changes feed shows project memberships, user roles and dataset accesses. '''
+    perms = ['data_facility_admin.view_projectmember',
+             'data_facility_admin.view_userdfrole',
+             'data_facility_admin.view_datasetaccess']
+
+    def has_permission(self, request, view):
+        return bool(request.user and request.user.is_authenticated and request.user.has_perms(self.perms))
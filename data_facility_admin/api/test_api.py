@@ -1,14 +1,19 @@
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
 from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils import timezone
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIRequestFactory, force_authenticate, APIClient, RequestsClient
 
-from data_facility_admin import factories, models
+from data_facility_admin import actions, entitlements, factories, models
+from data_facility_admin.api import serializers as api_serializers
 from data_facility_admin.api import views as api_views
 from data_facility_admin.models import Project, DfRole
+import mock
 import requests
 from requests.auth import HTTPBasicAuth
 from django.test import tag
@@ -127,6 +132,100 @@ class ApiTests(TestCase):
         project_data = response.data['results'][0]
         assert 'environment' in project_data
 
+    def test_api_db_sync_ordering(self):
+        Project.objects.create(name='Another project', ldap_name='project-another-project', abstract='a')
+        request = self.factory.get(API_BASE + 'db-sync?ordering=-name', format='json')
+        force_authenticate(request, user=self.user)
+        names = [project['name'] for project in api_views.DatabaseSyncListView(request).data['results']]
+        self.assertEqual(sorted(names, reverse=True), names)
+
+    def test_api_db_sync_snapshot_data_matches_the_serializer(self):
+        owned = factories.ProjectFactory.create(owner=factories.UserFactory.create())
+        for project in (Project.objects.get(name=PROJECT_NAME), owned):
+            self.assertEqual(dict(api_serializers.DatabaseSyncSerializer(project).data),
+                             entitlements.snapshot_data(project))
+
+    def test_api_db_sync_not_modified_with_etag(self):
+        request = self.factory.get(API_BASE + 'db-sync', format='json')
+        force_authenticate(request, user=self.user)
+        etag = api_views.DatabaseSyncListView(request)['ETag']
+
+        request = self.factory.get(API_BASE + 'db-sync', format='json', HTTP_IF_NONE_MATCH=etag)
+        force_authenticate(request, user=self.user)
+        response = api_views.DatabaseSyncListView(request)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+
+    def test_api_db_sync_snapshot_updated_on_membership_change(self):
+        request = self.factory.get(API_BASE + 'db-sync', format='json')
+        force_authenticate(request, user=self.user)
+        etag = api_views.DatabaseSyncListView(request)['ETag']
+
+        project = Project.objects.get(name=PROJECT_NAME)
+        member = models.User.objects.create(first_name='Sync', last_name='Member', email='sync@a.a',
+                                            status=models.User.STATUS_ACTIVE)
+        role = models.ProjectRole.objects.create(name='db-sync-reader',
+                                                 system_role=models.ProjectRole.SYSTEM_ROLE_READER)
+        models.ProjectMember.objects.create(project=project, member=member, role=role, start_date=YESTERDAY)
+
+        request = self.factory.get(API_BASE + 'db-sync', format='json', HTTP_IF_NONE_MATCH=etag)
+        force_authenticate(request, user=self.user)
+        response = api_views.DatabaseSyncListView(request)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        project_data = [p for p in response.data['results'] if p['name'] == PROJECT_NAME][0]
+        self.assertIn({'username': member.username, 'system_role': models.ProjectRole.SYSTEM_ROLE_READER},
+                      project_data['active_member_permissions'])
+
+    def test_api_db_sync_snapshot_updated_when_user_disabled_by_admin_action(self):
+        project = Project.objects.get(name=PROJECT_NAME)
+        member = models.User.objects.create(first_name='Disabled', last_name='Member', email='disabled@a.a',
+                                            status=models.User.STATUS_ACTIVE)
+        role = models.ProjectRole.objects.create(name='db-sync-disabled-reader',
+                                                 system_role=models.ProjectRole.SYSTEM_ROLE_READER)
+        models.ProjectMember.objects.create(project=project, member=member, role=role, start_date=YESTERDAY)
+
+        def usernames():
+            request = self.factory.get(API_BASE + 'db-sync', format='json')
+            force_authenticate(request, user=self.user)
+            response = api_views.DatabaseSyncListView(request)
+            project_data = [p for p in response.data['results'] if p['name'] == PROJECT_NAME][0]
+            return [permission['username'] for permission in project_data['active_member_permissions']]
+
+        self.assertIn(member.username, usernames())
+        with mock.patch.object(actions, 'messages'):
+            actions.user_disable(None, None, models.User.objects.filter(pk=member.pk))
+        self.assertNotIn(member.username, usernames())
+
+# Entitlement changes API
+    def get_entitlement_changes(self, query=''):
+        request = self.factory.get(API_BASE + 'entitlement-changes' + query, format='json')
+        force_authenticate(request, user=self.user)
+        return api_views.EntitlementChangesListView(request)
+
+    def test_api_entitlement_changes(self):
+        response = self.get_entitlement_changes('?since=2020-01-01T00:00:00Z&limit=10')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertIn('cursor', response.data)
+
+    def test_api_entitlement_changes_naive_since_uses_the_server_time_zone(self):
+        response = self.get_entitlement_changes('?since=2020-01-01T00:00:00')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+    @parameterized.expand([
+        ('?since=2020-01-01',),
+        ('?since=yesterday',),
+        ('?limit=0',),
+        ('?limit=-1',),
+        ('?cursor=invalid',),
+    ])
+    def test_api_entitlement_changes_invalid_parameters(self, query):
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, self.get_entitlement_changes(query).status_code)
+
+    def test_api_entitlement_changes_needs_permissions(self):
+        user = User.objects.create_user(username='changes-no-perms', password=ADMIN_PASSWORD)
+        request = self.factory.get(API_BASE + 'entitlement-changes', format='json')
+        force_authenticate(request, user=user)
+        self.assertEqual(status.HTTP_403_FORBIDDEN, api_views.EntitlementChangesListView(request).status_code)
+
 # DfRole API
     def test_api_dfrole_list(self):
         request = self.factory.get(API_BASE + 'dfroles/', format='json')
@@ -396,6 +495,87 @@ class ApiClientTests(TestCase):
         self.assertEqual(project.name, response.data['results'][0]['name'])
 
 
+    def test_api_project_list_queries_do_not_grow_with_projects(self):
+        project_role = models.ProjectRole.objects.create(name='My Role',
+                                                         system_role=models.ProjectRole.SYSTEM_ROLE_ADMIN)
+
+        def add_project(i):
+            project = factories.ProjectFactory.create(name='Query Project %s' % i,
+                                                      type=models.Project.PROJECT_TYPE_RESEARCH,
+                                                      status=models.Project.STATUS_ACTIVE,
+                                                      start=YESTERDAY)
+            models.ProjectMember.objects.create(project=project, member=factories.UserFactory.create(),
+                                                role=project_role, start_date=YESTERDAY)
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('project-list', args=[]), format='json')
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            return len(queries)
+
+        add_project(0)
+        one_project = count_queries()
+        for i in range(1, 4):
+            add_project(i)
+        self.assertEqual(one_project, count_queries())
+
+    @override_settings(CATALOG_CACHE_TIMEOUT=60)
+    def test_api_dataset_list_is_cached_until_the_catalog_changes(self):
+        cache.clear()
+        dataset = factories.DatasetFactory.create(name='Cached name')
+        url = reverse('dataset-list', args=[])
+        first = self.client.get(url, format='json')
+        self.assertEqual(status.HTTP_200_OK, first.status_code)
+        # Updates without signals are not seen while the catalog version is the same.
+        models.Dataset.objects.filter(pk=dataset.pk).update(name='Updated name')
+        self.assertEqual(first.data, self.client.get(url, format='json').data)
+
+        dataset.refresh_from_db()
+        dataset.save()
+        response = self.client.get(url, format='json')
+        self.assertNotEqual(first['ETag'], response['ETag'])
+        self.assertEqual(['Updated name'], [d['name'] for d in response.data['results']])
+
+    def test_catalog_version_bumps_on_curator_and_username_changes(self):
+        curators = models.DfRole.objects.get_or_create(name=models.DfRole.ADRF_CURATORS)[0]
+        other = models.DfRole.objects.create(name='Not curators')
+        user = factories.UserFactory.create()
+        user_df_role = models.UserDfRole.objects.create(user=user, role=curators)
+        user_df_role = models.UserDfRole.objects.get(pk=user_df_role.pk)
+        with mock.patch('data_facility_admin.catalog.bump') as bump:
+            user_df_role.role = other
+            user_df_role.save()
+            self.assertEqual(1, bump.call_count)
+            user_df_role.save()
+            self.assertEqual(1, bump.call_count)
+
+            user = models.User.objects.get(pk=user.pk)
+            user.ldap_name = 'renamed-curator'
+            user.save()
+            self.assertEqual(2, bump.call_count)
+
+    def test_api_dataset_search(self):
+        factories.DatasetFactory.create(name='Wages', description='Census of the wages')
+        factories.DatasetFactory.create(name='Census')
+        response = self.client.get(reverse('dataset-list', args=[]), {'search': 'census'}, format='json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(['Census', 'Wages'], [d['name'] for d in response.data['results']])
+
+    def test_api_dataset_conditional_get(self):
+        cache.clear()
+        dataset = factories.DatasetFactory.create()
+        url = reverse('dataset-detail', kwargs={'dataset_id': dataset.dataset_id})
+        response = self.client.get(url, format='json')
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertIn('Last-Modified', response)
+
+        response = self.client.get(url, format='json', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+
+        factories.DatasetFactory.create()
+        response = self.client.get(url, format='json', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
 class ApiAuthorizationTests(TestCase):
     @classmethod
     def setUpClass(cls):
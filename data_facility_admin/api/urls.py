@@ -14,6 +14,7 @@ api_router.register(r'DataProviders'.lower(), views.DataProviderViewSet)
 api_router.register(r'DatabaseSchema'.lower(), views.DatabaseSchemaViewSet)
 
 urls = [
-    url(r'^db-sync', views.DatabaseSyncListView, name='db-sync')
+    url(r'^db-sync', views.DatabaseSyncListView, name='db-sync'),
+    url(r'^entitlement-changes', views.EntitlementChangesListView, name='entitlement-changes'),
     ]
 urls += api_router.urls
@@ -1,17 +1,26 @@
 from django_filters import filters
-from rest_framework import mixins, generics, viewsets
+from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework import mixins, generics, status, viewsets
+from rest_framework.filters import OrderingFilter
 from rest_framework.generics import ListAPIView
+from rest_framework.views import APIView
 from rest_framework.response import Response
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from collections import OrderedDict
 
+from data_facility_admin import catalog, changes, entitlements, roles
+from data_facility_admin.access import AccessGraph
 from data_facility_admin.models import User
 from .. import models
 from . import serializers
+from .filters import DatasetSearchFilter
+from .permissions import EntitlementChangesPermissions
 from django.shortcuts import get_object_or_404
 
 import logging
 # from django_filters import rest_framework as filters
-from django.db.models import Q
+from django.db.models import Q, prefetch_related_objects
 
 logger = logging.getLogger(__name__)
 
@@ -51,13 +60,17 @@ class CategoryViewSet(viewsets.ModelViewSet):
 
 class DatasetViewSet(viewsets.ModelViewSet):
     """
-    Search is based on 'name', 'dataset_id', 'data_provider__name', 'description'.
+    Search is based on 'name', 'dataset_id', 'data_provider__name', 'description' and the keywords, with
+    results ordered by rank.
 
     Additional filters:
         - access_type: Public (Green), Restricted (Restricted Green) or Private (Yellow)
         - category__name: name of the category. Can be a single value or multiple '|' separated.
         - data_provider__name: name of the data provider. Can be a single value or multiple '|' separated.
         - start_date and end_date: to filter datasets by temporal_coverage
+
+    List and detail responses are cached until the catalog changes, and support If-None-Match and
+    If-Modified-Since (see data_facility_admin.catalog).
     """
     # filter_backends = (filters.DjangoFilterBackend,)
     serializer_class = serializers.DatasetSerializer
@@ -77,8 +90,10 @@ class DatasetViewSet(viewsets.ModelViewSet):
     #                     'data_provider__name': ['exact'],
     #                     'temporal_coverage_start__year': ['gte'],
     #                     'temporal_coverage_end__year': ['lte']}
+    filter_backends = (DjangoFilterBackend, DatasetSearchFilter, OrderingFilter)
+    # Used by the browsable API; the search uses the dataset search vector.
     search_fields = ('name', 'dataset_id', 'data_provider__name', 'description')
-    ordering = ('name',)
+    # No default ordering, to keep the search rank. Datasets are ordered by name otherwise.
     ordering_fields = ('name', 'dataset_id')
     lookup_field = 'dataset_id'
     lookup_url_kwarg = 'dataset_id'
@@ -87,7 +102,8 @@ class DatasetViewSet(viewsets.ModelViewSet):
         """
         Retrieve datasets respecting ACLs.
         """
-        queryset = models.Dataset.objects.filter(available=True)
+        queryset = models.Dataset.objects.filter(available=True) \
+            .select_related('category', 'database_schema').prefetch_related('datasteward_set__user')
         access_type = self.request.query_params.get('access_type', None)
         logger.debug('Access_type filter: %s' % access_type)
         if access_type:
@@ -126,6 +142,13 @@ class DatasetViewSet(viewsets.ModelViewSet):
 
         return queryset
 
+    def list(self, request, *args, **kwargs):
+        return catalog.cached_response(request, lambda: super(DatasetViewSet, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return catalog.cached_response(request,
+                                       lambda: super(DatasetViewSet, self).retrieve(request, *args, **kwargs))
+
 
 class UserViewSet(viewsets.ModelViewSet):
     """
@@ -161,54 +184,26 @@ class ProjectViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         """
-        Retrieve datasets respecting ACLs.
+        Retrieve projects respecting ACLs.
         """
+        now = timezone.now()
         queryset = models.Project.objects.filter(models.Project.FILTER_ACTIVE)
-        for project in queryset.iterator():
-            logger.debug('iterator: %s' % project)    
         user_filter = self.request.query_params.get('member', None) or self.request.query_params.get('user', None)
         logger.debug('member filter: %s' % user_filter)
         # member
-        curator = False
         if user_filter:
-            now = timezone.now()
-            queryset = queryset.filter(
-                                        (
-                                            (
-                                                Q(projectmember__member__ldap_name=user_filter) &
-                                                (
-                                                    Q(projectmember__start_date__isnull=False) & Q(projectmember__start_date__lte=now) & 
-                                                    (                                                        
-                                                        (
-                                                            Q(projectmember__end_date__isnull=False) & Q(projectmember__end_date__gte=now)
-                                                        ) |
-                                                        Q(projectmember__end_date__isnull=True)
-                                                    )
-                                                )
-                                            ) |
-                                            (
-                                                Q(instructors__userdfrole__user__ldap_name=user_filter) &
-                                                (
-                                                    Q(instructors__userdfrole__begin__isnull=False) & Q(instructors__userdfrole__begin__lte=now) & 
-                                                    (                                                        
-                                                        (
-                                                            Q(instructors__userdfrole__end__isnull=False) & Q(instructors__userdfrole__end__gte=now)
-                                                        ) |
-                                                        Q(instructors__userdfrole__end__isnull=True)
-                                                    )
-                                                )                                           
-                                            )
-                                        )                                         
-                                       )
+            # Projects where the user is an active member or instructor. Subqueries instead of joins,
+            # so no distinct() is needed.
+            memberships = models.ProjectMember.objects.filter(member__ldap_name=user_filter,
+                                                              start_date__lte=now) \
+                .filter(Q(end_date__isnull=True) | Q(end_date__gte=now))
+            instructor_roles = models.UserDfRole.objects.filter(user__ldap_name=user_filter, begin__lte=now) \
+                .filter(Q(end__isnull=True) | Q(end__gte=now))
+            queryset = queryset.filter(Q(id__in=memberships.values('project_id')) |
+                                       Q(instructors__in=instructor_roles.values('role_id')))
             # Filter expired or not started projects
-            queryset = queryset.filter(Q(start__isnull=True) |
-                                       Q(start__lte=now))
-            queryset = queryset.filter(Q(end__isnull=True) |
-                                       Q(end__gte=now))
-
-            # Filter with invalid membership
-            # queryset = queryset.filter(Q(projectmember__start_date__lte=now) & Q(projectmember__end_date__gte=now))
-            queryset = queryset.distinct()
+            queryset = queryset.filter(Q(start__isnull=True) | Q(start__lte=now))
+            queryset = queryset.filter(Q(end__isnull=True) | Q(end__gte=now))
 
         # TODO: Remove DATA TRANSFER filtering when new PG_SYNC is in place.
         # type
@@ -217,15 +212,22 @@ class ProjectViewSet(viewsets.ModelViewSet):
         if not type_filter:     # Add default filter only when there is no type param and the user is not a Data Curator
             data_curator = False
             if user_filter:
-                user_roles = [dfr.name for dfr in models.User.objects.get(ldap_name=user_filter).active_roles]
-                data_curator = models.DfRole.ADRF_CURATORS in user_roles
+                data_curator = roles.has_role(user_filter, models.DfRole.ADRF_CURATORS)
             if not data_curator:
                 queryset = queryset.exclude(type=models.Project.PROJECT_TYPE_DATA_TRANSFER)
 
         request_user = self.request.user
         logger.debug('Current user: %s' % request_user)
 
-        return queryset
+        return queryset.select_related('owner').prefetch_related('projecttool_set')
+
+    def paginate_queryset(self, queryset):
+        # Resolve the members and datasets of the whole page at once.
+        page = super(ProjectViewSet, self).paginate_queryset(queryset)
+        if page is not None:
+            graph = AccessGraph.attach(page)
+            prefetch_related_objects(graph.users(), 'tags')
+        return page
 
 
 class DataStewardViewSet(viewsets.ModelViewSet):
@@ -246,5 +248,84 @@ class DataProviderViewSet(viewsets.ModelViewSet):
     lookup_url_kwarg = 'slug'
 
 
-DatabaseSyncListView = ListAPIView.as_view(queryset=models.Project.objects.all(),
-                                           serializer_class=serializers.DatabaseSyncSerializer)
+class DatabaseSyncView(ListAPIView):
+    """
+    Projects with their active member permissions and datasets, served from the entitlement snapshots
+    (see data_facility_admin.entitlements). Supports If-None-Match with the returned ETag, and the
+    'fields', 'omit' and 'ordering' parameters.
+    """
+    # Checked by the permissions; the data comes from the snapshots.
+    queryset = models.Project.objects.all()
+    serializer_class = serializers.DatabaseSyncSerializer
+    filter_backends = (OrderingFilter,)
+    ordering_fields = ('name', 'ldap_name', 'environment', 'status')
+    ordering = ('name',)
+
+    def select_fields(self, data):
+        fields = self.request.query_params.get('fields', None)
+        omit = set(filter(None, self.request.query_params.get('omit', '').split(',')))
+        allowed = set(filter(None, fields.split(','))) if fields is not None else set(data)
+        # The stored JSON has no key order.
+        return OrderedDict((key, data[key]) for key in entitlements.SNAPSHOT_FIELDS
+                           if key in data and key in allowed and key not in omit)
+
+    def snapshot_ordering(self):
+        ''' The 'ordering' parameter, applied to the projects of the snapshots. '''
+        ordering = OrderingFilter().get_ordering(self.request, self.get_queryset(), self)
+        return ['%sproject__%s' % ('-' if field.startswith('-') else '', field.lstrip('-'))
+                for field in ordering] + ['project_id']
+
+    def list(self, request, *args, **kwargs):
+        entitlements.refresh()
+        etag = entitlements.etag(request.get_full_path())
+        if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        queryset = models.ProjectEntitlement.objects.order_by(*self.snapshot_ordering()).values_list('data', flat=True)
+        page = self.paginate_queryset(queryset)
+        data = [self.select_fields(project_data) for project_data in (queryset if page is None else page)]
+        response = Response(data) if page is None else self.get_paginated_response(data)
+        response['ETag'] = etag
+        return response
+
+
+DatabaseSyncListView = DatabaseSyncView.as_view()
+
+
+class EntitlementChangesView(APIView):
+    """
+    Feed of the effective permission changes (see data_facility_admin.changes), oldest first.
+
+    Parameters:
+        - cursor: the 'cursor' returned by the previous call, or of any change. Returns the changes after it.
+        - since: ISO datetime to start from when there is no cursor, in the server's time zone when it has no
+          offset. Default: the beginning.
+        - limit: number of changes per call (default 100, max 1000).
+    """
+    permission_classes = (EntitlementChangesPermissions,)
+
+    def get(self, request, *args, **kwargs):
+        try:
+            if request.query_params.get('cursor'):
+                cursor = changes.Cursor.decode(request.query_params['cursor'])
+            elif request.query_params.get('since'):
+                since = parse_datetime(request.query_params['since'])
+                if since is not None and timezone.is_naive(since):
+                    since = timezone.make_aware(since)
+                cursor = changes.Cursor.since(since)
+            else:
+                cursor = changes.BEGINNING
+            if cursor.at is None or timezone.is_naive(cursor.at):
+                raise ValueError('The cursor needs a datetime with a timezone.')
+            limit = int(request.query_params.get('limit', changes.DEFAULT_LIMIT))
+            if limit < 1:
+                raise ValueError('The limit must be positive.')
+            limit = min(limit, changes.MAX_LIMIT)
+        except (ValueError, TypeError, AttributeError):
+            return Response({'detail': 'Invalid cursor, since or limit.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        results, last, more = changes.changes_after(cursor, limit)
+        return Response(OrderedDict([('cursor', last.encode()), ('more', more), ('results', results)]))
+
+
+EntitlementChangesListView = EntitlementChangesView.as_view()
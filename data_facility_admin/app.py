@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class DataFacilityAdminConfig(AppConfig):
     name = 'data_facility_admin'
     verbose_name = "Data Facility"
+
+    def ready(self):
+        # Connects the signals that keep the entitlement snapshots, the role and catalog caches up to date.
+        from data_facility_admin import catalog, entitlements, roles
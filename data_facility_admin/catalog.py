@@ -0,0 +1,117 @@
+''' Versioned response cache of the dataset catalog API.
+
+The catalog version is the time of the last save or delete of a Dataset, Category, DataProvider, DataSteward,
+DatabaseSchema or curator role, or of a rename of a User, kept in the default cache. That cache is shared by the uWSGI workers and the
+scripts (see settings.CACHES), so a bump from any process makes all the cached responses stale at once.
+The responses of the dataset endpoints are cached by version and query for up to
+settings.CATALOG_CACHE_TIMEOUT seconds, and the version gives their ETag and Last-Modified for conditional GETs.
+'''
+import datetime
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, urlencode
+
+from data_facility_admin.models import Dataset, Category, DataProvider, DataSteward, DatabaseSchema
+from data_facility_admin.models import DfRole, User, UserDfRole
+
+VERSION_KEY = 'dfadmin:catalog:version'
+
+
+def version():
+    ''' Time of the last change of the catalog, as a timestamp. '''
+    value = cache.get(VERSION_KEY)
+    if value is None:
+        # Nothing is known about earlier changes, so everything cached before is stale.
+        cache.add(VERSION_KEY, time.time(), None)
+        value = cache.get(VERSION_KEY)
+    return value
+
+
+def bump():
+    cache.set(VERSION_KEY, time.time(), None)
+
+
+def _query_key(request):
+    # Stewards are active by date and the serialized links depend on the host.
+    query = urlencode(sorted(request.query_params.lists()), doseq=True)
+    return '%s|%s?%s' % (datetime.date.today().isoformat(), request.build_absolute_uri(request.path), query)
+
+
+def cached_response(request, view):
+    '''
+    The response of the view for the request, from the cache when the catalog did not change. Answers
+    If-None-Match and If-Modified-Since with 304 without calling the view.
+
+    :param view: function returning the DRF Response of the request.
+    '''
+    from rest_framework.response import Response
+
+    current = version()
+    digest = hashlib.md5('%r|%s' % (current, _query_key(request))).hexdigest()
+    headers = {'ETag': '"%s"' % digest, 'Last-Modified': http_date(current)}
+
+    conditional = get_conditional_response(request, etag=headers['ETag'], last_modified=int(current))
+    if conditional is None:
+        key = 'dfadmin:catalog:response:%s' % digest
+        data = cache.get(key)
+        if data is None:
+            response = view()
+            if response.status_code != 200:
+                return response
+            cache.set(key, response.data, settings.CATALOG_CACHE_TIMEOUT)
+            data = response.data
+        conditional = Response(data)
+    for header, value in headers.items():
+        conditional[header] = value
+    return conditional
+
+
+# Signals
+@receiver(post_save, sender=Dataset)
+@receiver(post_delete, sender=Dataset)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=DataProvider)
+@receiver(post_delete, sender=DataProvider)
+@receiver(post_save, sender=DataSteward)
+@receiver(post_delete, sender=DataSteward)
+@receiver(post_save, sender=DatabaseSchema)
+@receiver(post_delete, sender=DatabaseSchema)
+def catalog_changed(sender, **kwargs):
+    bump()
+
+
+@receiver(post_init, sender=UserDfRole)
+def snapshot_user_df_role(sender, instance, **kwargs):
+    # Read from __dict__ so a deferred field is not loaded.
+    instance._catalog_role_id = instance.__dict__.get('role_id')
+
+
+@receiver(post_save, sender=UserDfRole)
+@receiver(post_delete, sender=UserDfRole)
+def user_df_role_changed(sender, instance, **kwargs):
+    # The curators are listed in the curator_permissions of every dataset, so a role moving off them counts too.
+    role_ids = set([instance.role_id, getattr(instance, '_catalog_role_id', None)]) - {None}
+    if DfRole.objects.filter(pk__in=role_ids, name=DfRole.ADRF_CURATORS).exists():
+        bump()
+    instance._catalog_role_id = instance.role_id
+
+
+@receiver(post_init, sender=User)
+def snapshot_user_ldap_name(sender, instance, **kwargs):
+    # Read from __dict__ so a deferred field is not loaded.
+    instance._catalog_ldap_name = instance.__dict__.get('ldap_name')
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created=False, **kwargs):
+    # The usernames of the curators and stewards are in the responses.
+    if not created and getattr(instance, '_catalog_ldap_name', None) != instance.ldap_name:
+        bump()
+    instance._catalog_ldap_name = instance.ldap_name
@@ -0,0 +1,207 @@
+''' Delta feed of the effective permission changes, built on the simple_history tables.
+
+Changes come from two kinds of sources:
+    - history records of Project, Dataset, ProjectMember, UserDfRole and DatasetAccess (created, updated
+      and deleted rows);
+    - time windows: memberships, roles and accesses that started or ended, and datasets that expired,
+      without any write. These are emitted when their time is reached.
+
+Each change says whether the permission it describes is active at the time of the change. Changes are
+ordered by (time, source, kind, id) and read in pages after an opaque cursor, so consumers can sync in
+O(changes).
+'''
+import base64
+import datetime
+import json
+from collections import namedtuple
+
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from data_facility_admin.models import User, Project, ProjectRole, ProjectMember, DfRole, UserDfRole
+from data_facility_admin.models import Dataset, DatasetAccess, DatabaseSchema
+
+SOURCES = ('project', 'dataset', 'project_member', 'user_df_role', 'dataset_access')
+KINDS = ('history', 'start', 'end')
+HISTORY_ACTIONS = {'+': 'created', '~': 'updated', '-': 'deleted'}
+WINDOW_ACTIONS = {'start': 'activated', 'end': 'deactivated'}
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+ONE_DAY = datetime.timedelta(days=1)
+
+
+class Cursor(namedtuple('Cursor', 'at source kind id')):
+    ''' Position of a change in the feed. source and kind are indexes in SOURCES and KINDS. '''
+
+    def encode(self):
+        return base64.urlsafe_b64encode(json.dumps([self.at.isoformat(), self.source, self.kind, self.id]))
+
+    @classmethod
+    def decode(cls, token):
+        at, source, kind, id = json.loads(base64.urlsafe_b64decode(str(token)))
+        return cls(parse_datetime(at), source, kind, id)
+
+    @classmethod
+    def since(cls, at):
+        ''' Cursor before all the changes at or after the given time. '''
+        return cls(at, -1, -1, -1)
+
+
+BEGINNING = Cursor.since(datetime.datetime(1970, 1, 1, tzinfo=timezone.utc))
+
+Change = namedtuple('Change', 'cursor record action')
+
+
+def _after(cursor, source, kind, gt, eq, id_field):
+    ''' Keyset filter for the records after the cursor, given the filters for the records whose change
+        time is greater than and equal to the cursor's time. '''
+    position = (SOURCES.index(source), KINDS.index(kind))
+    if position > (cursor.source, cursor.kind):
+        return gt | eq
+    if position == (cursor.source, cursor.kind):
+        return gt | (eq & Q(**{'%s__gt' % id_field: cursor.id}))
+    return gt
+
+
+def _history_changes(source, model, cursor, now, limit):
+    records = model.history.filter(
+        _after(cursor, source, 'history', Q(history_date__gt=cursor.at), Q(history_date=cursor.at), 'history_id'),
+        history_date__lte=now).order_by('history_date', 'history_id')[:limit]
+    return [Change(Cursor(record.history_date, SOURCES.index(source), KINDS.index('history'), record.history_id),
+                   record, HISTORY_ACTIONS[record.history_type])
+            for record in records]
+
+
+def _window_changes(source, model, kind, field, cursor, now, limit):
+    records = model.objects.filter(
+        _after(cursor, source, kind, Q(**{'%s__gt' % field: cursor.at}), Q(**{field: cursor.at}), 'id'),
+        # Windows that started or ended before the row existed are covered by its history.
+        **{'%s__lte' % field: now, '%s__gt' % field: F('created_at')}).order_by(field, 'id')[:limit]
+    return [Change(Cursor(getattr(record, field), SOURCES.index(source), KINDS.index(kind), record.id),
+                   record, WINDOW_ACTIONS[kind])
+            for record in records]
+
+
+def _expiration(expiration):
+    # Datasets are available until the end of their expiration date.
+    return timezone.make_aware(datetime.datetime.combine(expiration + ONE_DAY, datetime.time.min), timezone.utc)
+
+
+def _expiration_changes(cursor, now, limit):
+    at = cursor.at.astimezone(timezone.utc)
+    gt = Q(expiration__gte=at.date())
+    # Only an expiration on the previous day ends exactly at the cursor's time (midnight).
+    eq = Q(expiration=at.date() - ONE_DAY) if at.time() == datetime.time.min else Q(pk__in=[])
+    records = Dataset.objects.filter(_after(cursor, 'dataset', 'end', gt, eq, 'id'),
+                                     expiration__lt=now.astimezone(timezone.utc).date()) \
+        .order_by('expiration', 'id')[:limit]
+    return [Change(Cursor(_expiration(record.expiration), SOURCES.index('dataset'), KINDS.index('end'), record.id),
+                   record, 'expired')
+            for record in records]
+
+
+def _names(model, refs, field='ldap_name'):
+    ''' Names of the (id, time) references, by reference. A row deleted since is named after its latest history
+        record at or before the time. '''
+    refs = set((id, at) for id, at in refs if id is not None)
+    if not refs:
+        return {}
+    names = dict(model.objects.filter(id__in=set(id for id, at in refs)).values_list('id', field))
+    missing = set(id for id, at in refs if id not in names)
+    history = {}
+    if missing:
+        for id, date, name in model.history.filter(id__in=missing, history_date__lte=max(at for id, at in refs)) \
+                .order_by('history_date', 'history_id').values_list('id', 'history_date', field):
+            history.setdefault(id, []).append((date, name))
+    results = {}
+    for id, at in refs:
+        if id in names:
+            results[id, at] = names[id]
+        else:
+            found = [name for date, name in history.get(id, []) if date <= at]
+            if found:
+                results[id, at] = found[-1]
+    return results
+
+
+def _in_window(at, start, end, end_inclusive=True, start_required=False):
+    if start is None:
+        if start_required:
+            return False
+    elif start > at:
+        return False
+    if end is None:
+        return True
+    return end >= at if end_inclusive else end > at
+
+
+def _describe(changes):
+    ''' The JSON representation of the changes, loading the referenced names with a query or two per model. '''
+    refs = [(change.record, change.cursor.at) for change in changes]
+    usernames = _names(User, [(getattr(r, 'member_id', None), at) for r, at in refs] +
+                       [(getattr(r, 'user_id', None), at) for r, at in refs])
+    projects = _names(Project, [(getattr(r, 'project_id', None), at) for r, at in refs])
+    datasets = _names(Dataset, [(getattr(r, 'dataset_id', None), at) for r, at in refs])
+    roles = _names(DfRole, [(getattr(r, 'role_id', None), at) for r, at in refs
+                            if isinstance(r, (UserDfRole, UserDfRole.history.model))])
+    system_roles = _names(ProjectRole, [(getattr(r, 'role_id', None), at) for r, at in refs
+                                        if isinstance(r, (ProjectMember, ProjectMember.history.model))],
+                          'system_role')
+    schemas = _names(DatabaseSchema, [(getattr(r, 'database_schema_id', None), at) for r, at in refs], 'name')
+
+    results = []
+    for change in changes:
+        at, source, record = change.cursor.at, SOURCES[change.cursor.source], change.record
+        deleted = change.action == 'deleted'
+        data = {'cursor': change.cursor.encode(), 'at': at.isoformat(), 'type': source, 'action': change.action}
+        if source == 'project':
+            data.update(project=record.ldap_name, status=record.status,
+                        active=not deleted and record.status == Project.STATUS_ACTIVE)
+        elif source == 'dataset':
+            data.update(dataset=record.ldap_name, status=record.status, public=record.public,
+                        db_schema=schemas.get((record.database_schema_id, at)),
+                        active=not deleted and change.action != 'expired' and
+                        record.status == Dataset.STATUS_ACTIVE and
+                        (record.expiration is None or record.expiration >= at.date()))
+        elif source == 'project_member':
+            data.update(project=projects.get((record.project_id, at)), username=usernames.get((record.member_id, at)),
+                        system_role=system_roles.get((record.role_id, at)),
+                        active=not deleted and change.action != 'deactivated' and
+                        _in_window(at, record.start_date, record.end_date, start_required=True))
+        elif source == 'user_df_role':
+            data.update(role=roles.get((record.role_id, at)), username=usernames.get((record.user_id, at)),
+                        active=not deleted and change.action != 'deactivated' and
+                        _in_window(at, record.begin, record.end, end_inclusive=False))
+        elif source == 'dataset_access':
+            data.update(project=projects.get((record.project_id, at)), dataset=datasets.get((record.dataset_id, at)),
+                        active=not deleted and change.action != 'deactivated' and
+                        _in_window(at, record.start_at, record.end_at))
+        results.append(data)
+    return results
+
+
+def changes_after(cursor=BEGINNING, limit=DEFAULT_LIMIT, now=None):
+    '''
+    The changes after the cursor, up to now.
+
+    :return: (list of changes as dicts, cursor of the last one, whether there are more changes)
+    '''
+    now = now or timezone.now()
+    # Each source returns its first limit + 1 changes; the first limit + 1 of all of them are enough.
+    fetch = limit + 1
+    changes = []
+    for source, model in (('project', Project), ('dataset', Dataset), ('project_member', ProjectMember),
+                          ('user_df_role', UserDfRole), ('dataset_access', DatasetAccess)):
+        changes += _history_changes(source, model, cursor, now, fetch)
+    for source, model, start, end in (('project_member', ProjectMember, 'start_date', 'end_date'),
+                                      ('user_df_role', UserDfRole, 'begin', 'end'),
+                                      ('dataset_access', DatasetAccess, 'start_at', 'end_at')):
+        changes += _window_changes(source, model, 'start', start, cursor, now, fetch)
+        changes += _window_changes(source, model, 'end', end, cursor, now, fetch)
+    changes += _expiration_changes(cursor, now, fetch)
+
+    changes.sort(key=lambda change: change.cursor)
+    more = len(changes) > limit
+    changes = changes[:limit]
+    return _describe(changes), changes[-1].cursor if changes else cursor, more
@@ -0,0 +1,155 @@
+''' Entitlement snapshots: the db-sync data of each project stored in ProjectEntitlement.
+
+A snapshot is removed when something it depends on is saved or deleted (memberships, instructor roles,
+dataset accesses, ...) and when the time windows of its memberships and accesses reach its valid_until.
+refresh() then rebuilds only the missing snapshots, resolving their permissions with one AccessGraph.
+'''
+import hashlib
+import logging
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Max
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from data_facility_admin.access import AccessGraph, next_access_changes
+from data_facility_admin.models import User, Project, ProjectRole, ProjectMember, UserDfRole
+from data_facility_admin.models import Dataset, DatasetAccess, DatabaseSchema, ProjectEntitlement
+
+logger = logging.getLogger(__name__)
+
+# The db-sync fields of a project, in the order the API returns them.
+SNAPSHOT_FIELDS = ('name', 'ldap_name', 'environment', 'status', 'parent_project_ldap_name', 'owner',
+                   'members_count', 'active_member_permissions', 'datasets_with_access', 'db_schema', 'instructors',
+                   'dfri')
+
+
+def snapshot_data(project):
+    ''' The db-sync data of the project stored in its snapshot. Without owner or parent, their keys are left out. '''
+    data = {
+        'name': project.name,
+        'ldap_name': project.ldap_name,
+        'environment': project.environment,
+        'status': project.status,
+        'members_count': project.members_count(),
+        'active_member_permissions': project.active_member_permissions(),
+        'datasets_with_access': project.datasets_with_access(),
+        'db_schema': project.db_schema(),
+        'instructors': project.instructors_id,
+        'dfri': project.ldap_name,
+    }
+    if project.parent_project is not None:
+        data['parent_project_ldap_name'] = project.parent_project.ldap_name
+    if project.owner is not None:
+        data['owner'] = project.owner.username
+    return data
+
+
+def refresh(now=None):
+    ''' Rebuilds the outdated and missing snapshots. Returns how many were built. '''
+    now = now or timezone.now()
+    ProjectEntitlement.objects.filter(valid_until__lte=now).delete()
+    projects = list(Project.objects.filter(entitlement__isnull=True)
+                    .select_related('owner', 'parent_project'))
+    if not projects:
+        return 0
+    AccessGraph.attach(projects, now)
+    valid_until = next_access_changes(projects, now)
+    data = [snapshot_data(project) for project in projects]
+    try:
+        with transaction.atomic():
+            ProjectEntitlement.objects.bulk_create(
+                ProjectEntitlement(project=project, data=project_data, valid_until=valid_until.get(project.id))
+                for project, project_data in zip(projects, data))
+    except IntegrityError:
+        # A concurrent refresh built them.
+        return 0
+    logger.info('Built %d entitlement snapshots', len(projects))
+    return len(projects)
+
+
+def version():
+    ''' Changes whenever a snapshot is built or removed. '''
+    stats = ProjectEntitlement.objects.aggregate(count=Count('pk'), updated_at=Max('updated_at'))
+    return '%s-%s' % (stats['count'], stats['updated_at'].isoformat() if stats['updated_at'] else '')
+
+
+def etag(*parts):
+    return '"%s"' % hashlib.md5('|'.join([version()] + list(parts))).hexdigest()
+
+
+def invalidate(project_ids):
+    project_ids = set(project_ids)
+    if project_ids:
+        ProjectEntitlement.objects.filter(project__in=project_ids).delete()
+
+
+def user_project_ids(user):
+    ''' The projects whose snapshots show the user: as member, instructor or owner. '''
+    return users_project_ids([user])
+
+
+def users_project_ids(users):
+    ''' The projects whose snapshots show any of the users. users can be a list or a User queryset. '''
+    project_ids = set(ProjectMember.objects.filter(member__in=users).values_list('project_id', flat=True))
+    project_ids.update(Project.objects.filter(instructors__userdfrole__user__in=users).values_list('id', flat=True))
+    project_ids.update(Project.objects.filter(owner__in=users).values_list('id', flat=True))
+    return project_ids
+
+
+# Signals
+@receiver(post_save, sender=ProjectMember)
+@receiver(post_delete, sender=ProjectMember)
+@receiver(post_save, sender=DatasetAccess)
+@receiver(post_delete, sender=DatasetAccess)
+def project_relation_changed(sender, instance, **kwargs):
+    invalidate([instance.project_id])
+
+
+@receiver(post_save, sender=UserDfRole)
+@receiver(post_delete, sender=UserDfRole)
+def user_df_role_changed(sender, instance, **kwargs):
+    invalidate(Project.objects.filter(instructors=instance.role_id).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Project)
+def project_changed(sender, instance, **kwargs):
+    # Child projects show the parent's ldap_name.
+    project_ids = set(Project.objects.filter(parent_project=instance).values_list('id', flat=True))
+    project_ids.add(instance.id)
+    invalidate(project_ids)
+
+
+@receiver(post_save, sender=ProjectRole)
+def project_role_changed(sender, instance, **kwargs):
+    invalidate(ProjectMember.objects.filter(role=instance).values_list('project_id', flat=True))
+
+
+@receiver(post_save, sender=Dataset)
+def dataset_changed(sender, instance, **kwargs):
+    invalidate(DatasetAccess.objects.filter(dataset=instance).values_list('project_id', flat=True))
+
+
+@receiver(post_save, sender=DatabaseSchema)
+def database_schema_changed(sender, instance, **kwargs):
+    invalidate(DatasetAccess.objects.filter(dataset__database_schema=instance)
+               .values_list('project_id', flat=True))
+
+
+def _user_values(user):
+    # Read from __dict__ so deferred fields are not loaded.
+    return user.__dict__.get('status'), user.__dict__.get('ldap_name')
+
+
+@receiver(post_init, sender=User)
+def snapshot_user_values(sender, instance, **kwargs):
+    instance._entitlement_values = _user_values(instance)
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created=False, **kwargs):
+    # Only the status and the username are part of the snapshots.
+    if not created and getattr(instance, '_entitlement_values', None) != _user_values(instance):
+        invalidate(user_project_ids(instance))
+    instance._entitlement_values = _user_values(instance)
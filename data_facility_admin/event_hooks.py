@@ -4,7 +4,12 @@ import logging
 import boto3
 # import boto3.ClientError
 import json
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from django.conf import settings
+from django.db import transaction
+from prometheus_client import Counter, Histogram
 import copy
 
 logger = logging.getLogger(__name__)
@@ -12,46 +17,212 @@ logger = logging.getLogger(__name__)
 SNS_HOOK = settings.SNS_HOOK
 
 
-def send_sns_event(topic, subject, payload):
-    logger.debug('[send_sns_event] Topic:%s, Subject:%s\nPayload:%s' % (topic, subject, payload))
+PUBLISH_BATCH_SIZE = 10  # Max entries of a SNS PublishBatch call.
+
+PUBLISH_LATENCY = Histogram('dfadmin_sns_publish_latency_seconds', 'Latency of the SNS publish calls',
+                            ['topic'])
+PUBLISH_FAILURES = Counter('dfadmin_sns_publish_failures_total', 'SNS events that could not be published',
+                           ['topic'])
+
+_sns_client = None
+_sns_client_lock = threading.Lock()
+_dataset_batch = threading.local()
+
+
+def _create_sns_client():
     if SNS_HOOK['AWS_ACCESS_KEY_ID']:
         logger.debug('Authenticating with credentials from env')
-        sns = boto3.client('sns',
-                           region_name=SNS_HOOK['REGION'],
-                           aws_access_key_id=SNS_HOOK['AWS_ACCESS_KEY_ID'],
-                           aws_secret_access_key=SNS_HOOK['AWS_ACCESS_KEY'],
-                           aws_session_token=SNS_HOOK['AWS_SESSION_TOKEN']
-                           )
-    else:
-        # When running on AWS, instance roles should be used.
-        logger.debug('Authenticating with IAM Role')
-        sns = boto3.client('sns', region_name=SNS_HOOK['REGION'])
-
-    response = sns.publish(
-        TargetArn='%s:%s' % (SNS_HOOK['BASE_ARN'], topic),
-        Subject=subject,
-        Message=json.dumps({"default": json.dumps(payload)}),
-        MessageStructure='json'
-    )
-
-    # response = sns.publish(
-    #     TopicArn='arn:aws:sns:us-east-1:441870321480:adrf-dataset-created',
-    #     Message='Hello World!',
-    # )
-    logger.debug('SNS Response: %s' % response)
-    # except ClientError as error:
-    #     raise
-    logger.info('SNS Event pushed with success: %s - %s' % (topic, subject))
-
-
-def dataset_saved(instance, **kwargs):
+        return boto3.client('sns',
+                            region_name=SNS_HOOK['REGION'],
+                            aws_access_key_id=SNS_HOOK['AWS_ACCESS_KEY_ID'],
+                            aws_secret_access_key=SNS_HOOK['AWS_ACCESS_KEY'],
+                            aws_session_token=SNS_HOOK['AWS_SESSION_TOKEN']
+                            )
+    # When running on AWS, instance roles should be used.
+    logger.debug('Authenticating with IAM Role')
+    return boto3.client('sns', region_name=SNS_HOOK['REGION'])
+
+
+def sns_client():
+    ''' The SNS client of the process, created on first use. boto3 clients can be shared by threads. '''
+    global _sns_client
+    if _sns_client is None:
+        with _sns_client_lock:
+            if _sns_client is None:
+                _sns_client = _create_sns_client()
+    return _sns_client
+
+
+def _topic_arn(topic):
+    return '%s:%s' % (SNS_HOOK['BASE_ARN'], topic)
+
+
+def _message(payload):
+    return json.dumps({"default": json.dumps(payload)})
+
+
+def _supports_publish_batch(client):
+    # PublishBatch needs botocore >= 1.23, which does not support Python 2.7.
+    return hasattr(client, 'publish_batch')
+
+
+class SnsTransport(object):
+    ''' Publishes the events to the SNS topics, under SNS_HOOK['BASE_ARN']. Uses PublishBatch when the installed
+        botocore has it, otherwise one Publish call per event over the shared client. '''
+
+    def publish_many(self, events):
+        by_topic = OrderedDict()
+        for index, (topic, subject, payload) in enumerate(events):
+            by_topic.setdefault(topic, []).append(index)
+
+        client = sns_client()
+        publish_topic = self._publish_batches if _supports_publish_batch(client) else self._publish_each
+        errors = {}
+        for topic, indexes in by_topic.items():
+            topic_errors = publish_topic(client, topic, indexes, events)
+            PUBLISH_FAILURES.labels(topic).inc(len(topic_errors))
+            errors.update(topic_errors)
+        return errors
+
+    def _publish_batches(self, client, topic, indexes, events):
+        errors = {}
+        for start in range(0, len(indexes), PUBLISH_BATCH_SIZE):
+            batch = indexes[start:start + PUBLISH_BATCH_SIZE]
+            entries = [{'Id': str(index),
+                        'Subject': events[index][1],
+                        'Message': _message(events[index][2]),
+                        'MessageStructure': 'json'} for index in batch]
+            try:
+                with PUBLISH_LATENCY.labels(topic).time():
+                    response = client.publish_batch(TopicArn=_topic_arn(topic), PublishBatchRequestEntries=entries)
+            except Exception as ex:
+                logger.warning('Error publishing %s SNS events to %s: %s' % (len(batch), topic, ex))
+                errors.update((index, repr(ex)) for index in batch)
+            else:
+                for failure in response.get('Failed', []):
+                    errors[int(failure['Id'])] = '%s: %s' % (failure.get('Code'), failure.get('Message'))
+        return errors
+
+    def _publish_each(self, client, topic, indexes, events):
+        errors = {}
+        for index in indexes:
+            try:
+                with PUBLISH_LATENCY.labels(topic).time():
+                    client.publish(TargetArn=_topic_arn(topic),
+                                   Subject=events[index][1],
+                                   Message=_message(events[index][2]),
+                                   MessageStructure='json')
+            except Exception as ex:
+                logger.warning('Error publishing SNS event to %s: %s' % (topic, ex))
+                errors[index] = repr(ex)
+        return errors
+
+
+class MemoryTransport(object):
+    ''' Keeps the events in the events list, for tests and benchmarks. '''
+
+    def __init__(self):
+        self.events = []
+
+    def publish_many(self, events):
+        self.events.extend(events)
+        return {}
+
+
+class FileTransport(object):
+    ''' Appends the events as JSON lines to SNS_HOOK['FILE_PATH'], as a local stand-in for SNS. '''
+
+    def __init__(self, path=None):
+        self.path = path or SNS_HOOK['FILE_PATH']
+        self.lock = threading.Lock()
+
+    def publish_many(self, events):
+        lines = [json.dumps({'topic': topic, 'subject': subject, 'payload': payload}) + '\n'
+                 for topic, subject, payload in events]
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.writelines(lines)
+        return {}
+
+
+TRANSPORTS = {
+    'sns': SnsTransport,
+    'memory': MemoryTransport,
+    'file': FileTransport,
+}
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def transport():
+    ''' The event transport of the process, chosen by SNS_HOOK['TRANSPORT'] and created on first use. '''
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = TRANSPORTS[SNS_HOOK['TRANSPORT']]()
+    return _transport
+
+
+def reset_transport():
+    ''' Makes the next transport() follow the current SNS_HOOK['TRANSPORT']. '''
+    global _transport
+    _transport = None
+
+
+def publish_many(events):
+    '''
+    Publishes the events with the transport. The SNS transport sends PublishBatch calls of up to
+    PUBLISH_BATCH_SIZE events of the same topic when botocore supports it, and one Publish per event otherwise.
+
+    :param events: list of (topic, subject, payload).
+    :return: dict with the errors of the events that could not be published, by their index in events.
+    '''
+    errors = transport().publish_many(events)
+    logger.info('Events pushed: %s, failed: %s' % (len(events) - len(errors), len(errors)))
+    return errors
+
+
+def dataset_event_values(instance):
+    # Read from __dict__ so deferred fields are not loaded.
+    return instance.__dict__.get('status'), instance.__dict__.get('database_schema_id')
+
+
+def dataset_saved(instance, created=False):
+    '''
+    Queues the SNS events of a dataset save in the outbox (see data_facility_admin.outbox). Called by
+    Dataset.save after the row is written, in the same transaction. Inside coalesce_dataset_events() the
+    events are queued at the end of the block instead.
+    '''
     if not SNS_HOOK['ACTIVE']: return
-    from data_facility_admin.models import Dataset
 
-    logger.debug('Dataset saved - instance: {0} params: {1}'.format(instance, kwargs))
+    logger.debug('Dataset saved - instance: {0} created: {1}'.format(instance, created))
+
+    # The values the dataset was loaded with, see the post_init snapshot in models.
+    old_status, old_schema_id = (None, None) if created else getattr(instance, '_event_values', (None, None))
+    if old_status is None and not created:
+        # Deferred when loaded: unknown, so considered unchanged.
+        old_status, old_schema_id = dataset_event_values(instance)
+    instance._event_values = dataset_event_values(instance)
+
+    pending = getattr(_dataset_batch, 'pending', None)
+    if pending is not None:
+        # The events compare the values before the first save of the block with the last one.
+        if instance.pk in pending:
+            created, old_status, old_schema_id, _ = pending[instance.pk]
+        pending[instance.pk] = (created, old_status, old_schema_id, instance)
+        return
+
+    from data_facility_admin import outbox
+    for topic, subject, payload in dataset_events(instance, created, old_status, old_schema_id):
+        outbox.enqueue(topic, subject, payload)
+
+
+def dataset_events(instance, created, old_status, old_schema_id):
+    ''' The (topic, subject, payload) events of a dataset saved with the given previous values. '''
+    from data_facility_admin.models import Dataset, DatabaseSchema
 
-    created = kwargs['created'] if 'created' in kwargs else instance.id is None
-    # When added to an active project
     if created:
         topic = SNS_HOOK['TOPIC_DATASET_CREATED']
         subject = 'Dataset created: {0}'.format(instance.dataset_id)
@@ -66,46 +237,76 @@ def dataset_saved(instance, **kwargs):
         'status': instance.status,
         'entity': instance.name,
     }
-    send_sns_event(topic, subject, payload)
+    events = [(topic, subject, payload)]
 
-    # Check event dataset activated
-    logger.debug('Checking if the dataset was activated...')
-    try:
-        old_instance = Dataset.objects.get(id=instance.id)
-    except Dataset.DoesNotExist:
-        old_instance = None
-
-    if instance.status == Dataset.STATUS_ACTIVE and (created or old_instance.status != instance.status):
-            logger.debug('Dataset activated: %s' % instance.dataset_id)
-            subject = 'Dataset activated: {0}'.format(instance.dataset_id)
-            send_sns_event(SNS_HOOK['TOPIC_DATASET_ACTIVATED'], subject, payload)
-
-    # Check for deactivation
-    logger.debug('Checking if the dataset was deactivated...')
-    if not created and instance.status != Dataset.STATUS_ACTIVE and old_instance.status == Dataset.STATUS_ACTIVE:
+    if instance.status == Dataset.STATUS_ACTIVE and (created or old_status != instance.status):
         logger.debug('Dataset activated: %s' % instance.dataset_id)
-        subject = 'Dataset deactivated: {0}'.format(instance.dataset_id)
-        send_sns_event(SNS_HOOK['TOPIC_DATASET_DEACTIVATED'], subject, payload)
-
-    logger.debug('Checking for database schema updates...')
-    current_schema = instance.database_schema
-    old_schema = None if old_instance is None else old_instance.database_schema
-    if current_schema is not None:
-        if old_schema is None or old_schema != current_schema:
-            logger.debug('Dataset DB schema activated: %s' % current_schema.name)
-            subject = '{0} - {1}'.format(instance.dataset_id, current_schema.name)
-            payload['extra'] = {'schema': current_schema.name}
-            send_sns_event(SNS_HOOK['TOPIC_DATASET_DB_ACTIVATED'], subject, payload)
-
-        if old_schema is not None:
-            logger.debug('Dataset DB schema changed. Deactivate previous one: %s' % old_schema.name)
-            subject = '{0} - {1}'.format(instance.dataset_id, old_schema.name)
-            payload['extra'] = {'schema': old_schema.name}
-            send_sns_event(SNS_HOOK['TOPIC_DATASET_DB_DEACTIVATED'], subject, payload)
+        subject = 'Dataset activated: {0}'.format(instance.dataset_id)
+        events.append((SNS_HOOK['TOPIC_DATASET_ACTIVATED'], subject, payload))
 
+    if not created and instance.status != Dataset.STATUS_ACTIVE and old_status == Dataset.STATUS_ACTIVE:
+        logger.debug('Dataset deactivated: %s' % instance.dataset_id)
+        subject = 'Dataset deactivated: {0}'.format(instance.dataset_id)
+        events.append((SNS_HOOK['TOPIC_DATASET_DEACTIVATED'], subject, payload))
 
+    if instance.database_schema_id != old_schema_id:
+        if instance.database_schema_id is not None:
+            schema_name = instance.database_schema.name
+            logger.debug('Dataset DB schema activated: %s' % schema_name)
+            subject = '{0} - {1}'.format(instance.dataset_id, schema_name)
+            events.append((SNS_HOOK['TOPIC_DATASET_DB_ACTIVATED'], subject,
+                           dict(payload, extra={'schema': schema_name})))
 
+        if old_schema_id is not None:
+            schema_name = DatabaseSchema.objects.filter(pk=old_schema_id).values_list('name', flat=True).first()
+            logger.debug('Dataset DB schema changed. Deactivate previous one: %s' % schema_name)
+            subject = '{0} - {1}'.format(instance.dataset_id, schema_name)
+            events.append((SNS_HOOK['TOPIC_DATASET_DB_DEACTIVATED'], subject,
+                           dict(payload, extra={'schema': schema_name})))
+    return events
 
 
+@contextmanager
+def coalesce_dataset_events(summary=False):
+    '''
+    Holds the events of the datasets saved inside the block and queues them at its end: the events of each
+    dataset compare its values before the first save with the ones of the last save. With summary, a single
+    event is sent to SNS_HOOK['TOPIC_DATASET_BATCH'] instead, with the ids of the datasets by topic.
+    When the block raises inside a transaction, nothing is queued: the transaction is being rolled back and
+    may be unusable. Outside of one, the saves before the error were committed and their events are queued.
+    '''
+    if getattr(_dataset_batch, 'pending', None) is not None:
+        # Nested: the outermost block queues the events.
+        yield
+        return
+    _dataset_batch.pending = OrderedDict()
+    try:
+        yield
+    except BaseException:
+        pending = _dataset_batch.pending
+        _dataset_batch.pending = None
+        if not transaction.get_connection().in_atomic_block:
+            _queue_coalesced_events(pending.values(), summary)
+        raise
+    pending = _dataset_batch.pending
+    _dataset_batch.pending = None
+    _queue_coalesced_events(pending.values(), summary)
 
 
+def _queue_coalesced_events(saves, summary):
+    from data_facility_admin import outbox
+    events = [event for created, old_status, old_schema_id, instance in saves
+              for event in dataset_events(instance, created, old_status, old_schema_id)]
+    if not events:
+        return
+    if not summary:
+        for topic, subject, payload in events:
+            outbox.enqueue(topic, subject, payload)
+        return
+    datasets_by_topic = OrderedDict()
+    for topic, subject, payload in events:
+        datasets_by_topic.setdefault(topic, []).append(dict(payload.get('extra', {}), entity_id=payload['entity_id']))
+    outbox.enqueue(SNS_HOOK['TOPIC_DATASET_BATCH'], 'Datasets changed: {0}'.format(len(saves)), {
+        'sender': 'DFAdmin',
+        'events': datasets_by_topic,
+    })
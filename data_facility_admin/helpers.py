@@ -1,6 +1,13 @@
 import ldap
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
 import logging
+import sys
+import threading
+import time
+from collections import namedtuple, OrderedDict
 from copy import deepcopy
+from functools import partial
 import pytz
 import random
 
@@ -9,17 +16,24 @@ from django.template.loader import render_to_string
 
 from django.conf import settings
 from data_facility_admin.keycloak import KeycloakAPI
-from data_facility_admin.models import User, Dataset
+from data_facility_admin.models import User, Dataset, SystemInfo
+from data_facility_admin.models import UserDfRole, ProjectMember, DatasetAccess
 from data_facility_admin.models import DfRole
 from data_facility_admin.models import Project
 from data_facility_admin.serializers import UserLDAPSerializer, DatasetLDAPSerializer
 from data_facility_admin.serializers import ProjectLDAPSerializer
 from data_facility_admin.serializers import DfRoleLDAPSerializer
 from data_facility_admin.serializers import UserPrivateGroupLDAPSerializer
+from data_facility_admin.utils import bulk_update
 from django.core.mail import EmailMultiAlternatives
+from django.db.models import Q
 from django.utils import timezone
 import datetime
 
+# Users without a login for this long are locked by inactivity.
+INACTIVITY_PERIOD = datetime.timedelta(days=60)
+
+
 class UserHelper:
     @staticmethod
     def pwgen(z, t):
@@ -131,15 +145,29 @@ class KeycloakHelper(object):
             self.logger.exception("Error enabling user %s. Error message: %s"
                                   % (df_user.email, ex.message))
 
+# A write to a single DN: a list of (method, args) calls on the LDAP connection, the message
+# logged if any of them fails and what to run on DFAdmin once all of them succeed.
+LdapWrite = namedtuple('LdapWrite', ['dn', 'operations', 'error_message', 'on_success'])
+
+
 class LDAPHelper:
+    # Above this number of names, searches are not filtered by name on LDAP, only on DFAdmin.
+    MAX_FILTERED_NAMES = 200
+
+    @staticmethod
+    def connect():
+        conn = ldap.initialize(settings.LDAP_SERVER)
+        conn.protocol_version = ldap.VERSION3
+        conn.simple_bind_s(settings.LDAP_SETTINGS['Connection']['BindDN'],
+                           settings.LDAP_SETTINGS['Connection']['BindPassword'])
+        return conn
+
     def init_ldap(self):
-        self.__ldap_conn = ldap.initialize(settings.LDAP_SERVER)
-        self.__ldap_conn.protocol_version = ldap.VERSION3
-        self.__ldap_conn.simple_bind_s(settings.LDAP_SETTINGS['Connection']['BindDN'],
-                                       settings.LDAP_SETTINGS['Connection']['BindPassword'])
+        self.__ldap_conn = self.connect()
 
     def __init__(self):
         self.logger = logging.getLogger(__name__)
+        self.__pending_writes = None
         self.init_ldap()
 
     def close(self):
@@ -156,34 +184,85 @@ class LDAPHelper:
                 list_.append((k, v))
             return list_
 
-    def get_from_ldap(self, search_base, search_filter, values):
+    @staticmethod
+    def paged_search(conn, base, search_filter, values, page_size=None):
+        """
+        Generator over the entries of a subtree search, requested in pages of page_size entries
+        with the Simple Paged Results control so the server size limit is never hit.
+        A page_size of 0 falls back to a single search_s.
+        """
+        if page_size is None:
+            page_size = settings.LDAP_SETTINGS['General']['SearchPageSize']
+        if not page_size:
+            for entry in conn.search_s(base, ldap.SCOPE_SUBTREE, search_filter, values):
+                yield entry
+            return
+
+        page_control = SimplePagedResultsControl(True, size=page_size, cookie='')
+        while True:
+            msgid = conn.search_ext(base, ldap.SCOPE_SUBTREE, search_filter, values,
+                                    serverctrls=[page_control])
+            _, result_data, _, server_controls = conn.result3(msgid)
+            for entry in result_data:
+                # Skip search references, they have no DN.
+                if entry[0]:
+                    yield entry
+            page_control.cookie = ''
+            for control in server_controls:
+                if control.controlType == SimplePagedResultsControl.controlType:
+                    page_control.cookie = control.cookie
+            if not page_control.cookie:
+                break
+
+    def iter_from_ldap(self, search_base, search_filter, values):
         if not search_base:
             base = settings.LDAP_BASE_DN
         else:
             base = "%s,%s" % (search_base, settings.LDAP_BASE_DN)
-        result_data = self.__ldap_conn.search_s(base, ldap.SCOPE_SUBTREE, search_filter, values)
-        return result_data
+        return self.paged_search(self.__ldap_conn, base, search_filter, values)
+
+    def get_from_ldap(self, search_base, search_filter, values):
+        return list(self.iter_from_ldap(search_base, search_filter, values))
+
+    def get_named_from_ldap(self, search_base, search_filter, values, attr, names=None):
+        """
+        Same as iter_from_ldap, but only yields the entries whose attr is one of the given names
+        (ignoring case). When names is None all entries are yielded.
+        """
+        if names is None:
+            for entry in self.iter_from_ldap(search_base, search_filter, values):
+                yield entry
+            return
+        if not names:
+            return
+        if len(names) <= self.MAX_FILTERED_NAMES:
+            search_filter = '(&%s(|%s))' % (search_filter, ''.join(
+                '(%s=%s)' % (attr, escape_filter_chars(name)) for name in sorted(names)))
+        names = set(name.lower() for name in names)
+        for entry in self.iter_from_ldap(search_base, search_filter, values):
+            if entry[1].get(attr) and entry[1][attr][0].lower() in names:
+                yield entry
 
     def get_max_uid_number(self):
         search_filter = "(uid=*)"
         values = ['uidNumber']
-        search_result = self.get_from_ldap(settings.LDAP_USER_SEARCH, search_filter, values)
-        uid_numbers = [int(user[1]['uidNumber'][0]) for user in search_result if
-                       'uidNumber' in user[1] and len(user[1]['uidNumber']) == 1]
-        return max(uid_numbers)
+        return max(int(user[1]['uidNumber'][0])
+                   for user in self.iter_from_ldap(settings.LDAP_USER_SEARCH, search_filter, values)
+                   if 'uidNumber' in user[1] and len(user[1]['uidNumber']) == 1)
+
     def get_max_gid_number(self):
         search_filter = "(cn=*)"
         values = ['gidNumber']
-        search_result = self.get_from_ldap(None, search_filter, values)
-        gid_numbers = [int(group[1]['gidNumber'][0]) for group in search_result if
-                       'gidNumber' in group[1] and len(group[1]['gidNumber']) == 1]
-        return max(gid_numbers)
+        return max(int(group[1]['gidNumber'][0])
+                   for group in self.iter_from_ldap(None, search_filter, values)
+                   if 'gidNumber' in group[1] and len(group[1]['gidNumber']) == 1)
 
-    def get_ldap_projects(self):
+    def get_ldap_projects(self, names=None):
         search_filter = "(&(objectclass=posixGroup)(|({0}=project-*)({0}=yproject-*)))" \
             .format(settings.PROJECT_LDAP_MAP['ldap_name'])
         values = settings.PROJECT_LDAP_MAP.values()
-        return self.get_from_ldap(settings.LDAP_PROJECT_SEARCH, search_filter, values)
+        return self.get_named_from_ldap(settings.LDAP_PROJECT_SEARCH, search_filter, values,
+                                        settings.PROJECT_LDAP_MAP['ldap_name'], names)
 
     @classmethod
     def flat_attributes_from_settings(cls, values):
@@ -196,190 +275,266 @@ class LDAPHelper:
                 flat_values.append(value)
         return flat_values
 
-    def get_ldap_users(self):
+    def get_ldap_users(self, names=None):
         search_filter = "(%s=*)" % settings.USER_LDAP_MAP['username']
         # values = ['uid', 'mail', 'givenName', 'sn', ]
         values = self.flat_attributes_from_settings(settings.USER_LDAP_MAP.values())
-        return self.get_from_ldap(settings.LDAP_USER_SEARCH, search_filter, values)
+        return self.get_named_from_ldap(settings.LDAP_USER_SEARCH, search_filter, values,
+                                        settings.USER_LDAP_MAP['username'], names)
 
-    def get_ldap_groups(self):
+    def get_ldap_groups(self, names=None):
         search_filter = '(&(objectclass=posixGroup))'
         values = settings.PROJECT_LDAP_MAP.values()
-        return self.get_from_ldap(settings.LDAP_GROUP_SEARCH, search_filter, values)
+        return self.get_named_from_ldap(settings.LDAP_GROUP_SEARCH, search_filter, values,
+                                        settings.GROUP_LDAP_MAP['ldap_name'], names)
 
-    def get_ldap_datasets(self):
+    def get_ldap_datasets(self, names=None):
         search_filter = '(&(objectclass=posixGroup))'
         values = settings.DATASET_LDAP_MAP.values()
-        return self.get_from_ldap(settings.LDAP_DATASET_SEARCH, search_filter, values)
+        return self.get_named_from_ldap(settings.LDAP_DATASET_SEARCH, search_filter, values,
+                                        settings.DATASET_LDAP_MAP['ldap_name'], names)
 
-    def ldap_add(self, ldap_tuple):
-        dn = ldap_tuple[0]
-        if 'authTimestamp' in ldap_tuple[1]:
-            ldap_tuple[1].pop("authTimestamp")
-        if 'pwdChangedTime' in ldap_tuple[1]:
-            ldap_tuple[1].pop("pwdChangedTime")
-        # if 'posixAccount' in ldap_tuple[1]['objectClass']:
-        #    ldap_tuple[1]['uidNumber'] = ["%s" % (self.get_max_uid_number() + 1)]
-        # elif 'posixGroup' in ldap_tuple[1]['objectClass']:
-        #    ldap_tuple[1]['gidNumber'] = ["%s" % (self.get_max_gid_number() + 1)]
-
-        self.__ldap_conn.add_s(dn, self.to_list_tuples(ldap_tuple[1]))
+    @classmethod
+    def add_operation(cls, ldap_tuple):
+        attrs = dict(ldap_tuple[1])
+        attrs.pop("authTimestamp", None)
+        attrs.pop("pwdChangedTime", None)
+        return 'add_s', (ldap_tuple[0], cls.to_list_tuples(attrs))
 
-    def ldap_update(self, ldap_tuple_new, ldap_tuple_curr):
-        self.logger.debug("ldap_update() new=<{0}>, current=<{1}>".format(ldap_tuple_new, ldap_tuple_curr))
+    @classmethod
+    def update_operations(cls, ldap_tuple_new, ldap_tuple_curr):
+        modlist = cls.ldap_modlist(ldap_tuple_new, ldap_tuple_curr)
+        if not modlist:
+            return []
+        return [('modify_s', (ldap_tuple_new[0], modlist))]
 
-        dn = ldap_tuple_new[0]
+    @staticmethod
+    def delete_operation(dn):
+        return 'delete_s', (dn,)
 
-        curr_attrs = set(ldap_tuple_curr[1].keys())
-        new_attrs = set(ldap_tuple_new[1].keys())
+    @classmethod
+    def recreate_operations(cls, ldap_tuple_new, ldap_tuple_curr):
+        copy_tuple = deepcopy(ldap_tuple_new)
+        if "member" in copy_tuple[1]:
+            copy_tuple[1].pop("member")
+        return [cls.delete_operation(ldap_tuple_curr[0]),
+                cls.add_operation(copy_tuple)] + cls.update_operations(ldap_tuple_new, copy_tuple)
 
-        try:
-            curr_attrs.remove("authTimestamp")
-            new_attrs.remove("authTimestamp")
-        except Exception as ex:
-            self.logger.debug("There is no <authTimestamp> to remove for dn: %s" % dn)
+    def ldap_add(self, ldap_tuple):
+        method, args = self.add_operation(ldap_tuple)
+        getattr(self.__ldap_conn, method)(*args)
 
-        try:
-            curr_attrs.remove("pwdChangedTime")
-            new_attrs.remove("pwdChangedTime")
-        except:
-            self.logger.debug("There is no <pwdChangedTime> to remove for dn: %s" % dn)
-
-        user_values = settings.USER_LDAP_MAP.values()
-        user_flat_values = []
-        for value in user_values:
-            if hasattr(value, '__iter__'):
-                for v in value:
-                    user_flat_values.append(v)
-            else:
-                user_flat_values.append(value)
-        user_attrs = set(user_flat_values)
+    @classmethod
+    def updatable_attributes(cls):
+        user_attrs = set(cls.flat_attributes_from_settings(settings.USER_LDAP_MAP.values()))
         group_attrs = set(settings.GROUP_LDAP_MAP.values())
         project_attrs = set(settings.PROJECT_LDAP_MAP.values())
         user_private_group_attrs = set(settings.USER_PRIVATE_GROUP_LDAP_MAP.values())
         dataset_attrs = set(settings.DATASET_LDAP_MAP.values())
+        return user_attrs | group_attrs | project_attrs | user_private_group_attrs | dataset_attrs
 
-        updatable_attrs = user_attrs | group_attrs | project_attrs | user_private_group_attrs | dataset_attrs
-        curr_attrs = curr_attrs & updatable_attrs
-        new_attrs = new_attrs & updatable_attrs
-
+    @classmethod
+    def ldap_modlist(cls, ldap_tuple_new, ldap_tuple_curr):
+        """
+        Plans the changes needed to turn the current LDAP entry into the new one.
+
+        Single valued attributes are replaced, multi valued attributes are updated with the
+        values added and removed, so the whole diff for the DN fits in one modify_s call.
+
+        :param ldap_tuple_new: (dn, attrs) tuple serialized from DFAdmin.
+        :param ldap_tuple_curr: (dn, attrs) tuple currently on LDAP.
+        :return: list of (op, attr, values) tuples. Empty when there is nothing to change.
+        """
+        new_values = ldap_tuple_new[1]
+        curr_values = ldap_tuple_curr[1]
+        if new_values == curr_values:
+            return []
+
+        updatable_attrs = cls.updatable_attributes() - {'authTimestamp', 'pwdChangedTime'}
+        curr_attrs = set(curr_values.keys()) & updatable_attrs
+        new_attrs = set(new_values.keys()) & updatable_attrs
+
+        modlist = []
         if 'AttributesBlackList' in settings.LDAP_SETTINGS['General'] and settings.LDAP_SETTINGS['General'][
             'AttributesBlackList']:
             blacklisted = set(settings.LDAP_SETTINGS['General']['AttributesBlackList'])
-            blacklisted = blacklisted & curr_attrs
-            for attr in blacklisted:
-                for value in ldap_tuple_curr[1][attr]:
-                    self.__ldap_conn.modify_s(dn, [(ldap.MOD_DELETE, attr, value)])
-
-        for attr in curr_attrs - new_attrs:
-            for value in ldap_tuple_curr[1][attr]:
-                self.__ldap_conn.modify_s(dn, [(ldap.MOD_DELETE, attr, value)])
-        for attr in new_attrs - curr_attrs:
-            for value in ldap_tuple_new[1][attr]:
-                self.__ldap_conn.modify_s(dn, [(ldap.MOD_ADD, attr, value)])
-        for attr in new_attrs & curr_attrs:
-            if len(ldap_tuple_curr[1][attr]) == 1 and len(ldap_tuple_new[1][attr]) == 1:
-                if ldap_tuple_new[1][attr][0] != ldap_tuple_curr[1][attr][0]:
-                    self.__ldap_conn.modify_s(dn, [(ldap.MOD_REPLACE, attr, ldap_tuple_new[1][attr][0])])
+            blacklisted = blacklisted & set(curr_values.keys())
+            for attr in sorted(blacklisted):
+                modlist.append((ldap.MOD_DELETE, attr, None))
+            curr_attrs = curr_attrs - blacklisted
+
+        for attr in sorted(curr_attrs - new_attrs):
+            modlist.append((ldap.MOD_DELETE, attr, None))
+        for attr in sorted(new_attrs - curr_attrs):
+            if new_values[attr]:
+                modlist.append((ldap.MOD_ADD, attr, list(new_values[attr])))
+        for attr in sorted(new_attrs & curr_attrs):
+            if len(curr_values[attr]) == 1 and len(new_values[attr]) == 1:
+                if new_values[attr][0] != curr_values[attr][0]:
+                    modlist.append((ldap.MOD_REPLACE, attr, [new_values[attr][0]]))
             else:
-                for value in ldap_tuple_curr[1][attr]:
-                    if value not in ldap_tuple_new[1][attr]:
-                        self.__ldap_conn.modify_s(dn, [(ldap.MOD_DELETE, attr, value)])
-                for value in ldap_tuple_new[1][attr]:
-                    if value not in ldap_tuple_curr[1][attr]:
-                        self.__ldap_conn.modify_s(dn, [(ldap.MOD_ADD, attr, value)])
+                values_to_add = set(new_values[attr])
+                values_to_delete = set(curr_values[attr]) - values_to_add
+                values_to_add = values_to_add - set(curr_values[attr])
+                if values_to_delete:
+                    modlist.append((ldap.MOD_DELETE, attr, sorted(values_to_delete)))
+                if values_to_add:
+                    modlist.append((ldap.MOD_ADD, attr, sorted(values_to_add)))
+        return modlist
+
+    def ldap_update(self, ldap_tuple_new, ldap_tuple_curr):
+        self.logger.debug("ldap_update() new=<{0}>, current=<{1}>".format(ldap_tuple_new, ldap_tuple_curr))
+
+        operations = self.update_operations(ldap_tuple_new, ldap_tuple_curr)
+        if not operations:
+            self.logger.debug("Nothing to update for dn: %s" % ldap_tuple_new[0])
+        for method, args in operations:
+            getattr(self.__ldap_conn, method)(*args)
+
+    @staticmethod
+    def _execute(conn, write):
+        for method, args in write.operations:
+            getattr(conn, method)(*args)
+
+    def _write(self, dn, operations, error_message, on_success=None):
+        """
+        Sends the operations for a DN to LDAP and then runs on_success.
+        During export_all() the write is only queued, to be applied later by apply_writes().
+        """
+        write = LdapWrite(dn, operations, error_message, on_success)
+        if self.__pending_writes is not None:
+            self.__pending_writes.append(write)
+            return
+        try:
+            self._execute(self.__ldap_conn, write)
+            if on_success:
+                on_success()
+        except Exception:
+            self.logger.exception(error_message)
+
+    def apply_writes(self, writes, pool_size):
+        """
+        Applies the queued writes using up to pool_size bound connections.
+        Writes to the same DN always go to the same connection, in the order they were queued.
+        The on_success callbacks run afterwards on this thread, also in the order they were queued.
+        """
+        lanes = [[] for _ in range(max(pool_size, 1))]
+        for index, write in enumerate(writes):
+            if write.operations:
+                lanes[hash(write.dn.lower()) % len(lanes)].append(index)
+        errors = [None] * len(writes)
+
+        def run_lane(lane):
+            try:
+                conn = self.connect()
+            except Exception:
+                error = sys.exc_info()
+                for index in lane:
+                    errors[index] = error
+                return
+            try:
+                for index in lane:
+                    try:
+                        self._execute(conn, writes[index])
+                    except Exception:
+                        errors[index] = sys.exc_info()
+            finally:
+                conn.unbind()
+
+        workers = [threading.Thread(target=run_lane, args=(lane,)) for lane in lanes if lane]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        for write, error in zip(writes, errors):
+            if error is not None:
+                self.logger.error(write.error_message, exc_info=error)
+            elif write.on_success:
+                try:
+                    write.on_success()
+                except Exception:
+                    self.logger.exception(write.error_message)
+
+    # Timestamps kept in sync from LDAP by import_users.
+    LDAP_TIMESTAMP_FIELDS = ('ldap_last_auth_time', 'ldap_last_pwd_change', 'ldap_lock_time')
+
+    @staticmethod
+    def parse_ldap_timestamp(value):
+        return datetime.datetime.strptime(value, "%Y%m%d%H%M%SZ").replace(tzinfo=pytz.utc)
+
+    def reconcile_user(self, df_user, ldap_attrs, now):
+        """
+        Applies an LDAP entry to a DFAdmin user in memory.
+
+        :return: (set of changed fields, reason for the status change or None)
+        """
+        changed = set()
+        for field in self.LDAP_TIMESTAMP_FIELDS:
+            ldap_attr = settings.USER_LDAP_MAP[field]
+            if ldap_attr not in ldap_attrs:
+                continue
+            try:
+                value = self.parse_ldap_timestamp(ldap_attrs[ldap_attr][0])
+            except (ValueError, TypeError, IndexError):
+                value = None
+            if getattr(df_user, field) != value:
+                setattr(df_user, field, value)
+                changed.add(field)
+
+        lockdown = datetime.timedelta(seconds=settings.LDAP_SETTINGS['General']['PpolicyLockDownDurationSeconds'])
+        reason = None
+        if df_user.status == User.STATUS_LOCKED_WRONG_PASSWD and \
+                (df_user.ldap_lock_time is None or now > df_user.ldap_lock_time + lockdown):
+            self.logger.info("User %s was unlocked automatically", df_user.username)
+            df_user.status = User.STATUS_ACTIVE
+            df_user.ldap_lock_time = None
+            changed.update(['status', 'ldap_lock_time'])
+            reason = '[Import from LDAP] 344: Unlocking user (STATUS=STATUS_LOCKED_WRONG_PASSWD)'
+        elif df_user.status == User.STATUS_ACTIVE and df_user.ldap_lock_time is not None:
+            if now > df_user.ldap_lock_time + lockdown:
+                self.logger.info("User %s was unlocked automatically", df_user.username)
+                df_user.ldap_lock_time = None
+                changed.add('ldap_lock_time')
+            elif now < df_user.ldap_lock_time + lockdown:
+                df_user.status = User.STATUS_LOCKED_WRONG_PASSWD
+                changed.add('status')
+                reason = '[Import from LDAP] updated 350: STATUS_LOCKED_WRONG_PASSWD'
+        return changed, reason
 
     def import_users(self):
+        """
+        Updates the DFAdmin users with the LDAP timestamps and lock status.
+        All users are loaded in a single query and reconciled in memory. Users whose status
+        changes are saved one by one, with history. The others only have their changed
+        timestamps written, in bulk and without history.
+        """
         self.logger.info("Starting partial import")
-        ldap_users = self.get_ldap_users()
-        self.logger.debug("Updating %d users from LDAP", len(ldap_users))
-        for ldap_user in ldap_users:
-            self.logger.debug("Updating user %s", ldap_user[0])
-            df_user = None
+        now = timezone.now()
+        df_users = dict((user.ldap_id, user) for user in User.objects.exclude(ldap_id__isnull=True))
+        timestamp_updates = []
+        status_updates = []
+        for ldap_user in self.get_ldap_users():
             try:
-                df_user = User.objects.filter(ldap_id=int(ldap_user[1]["uidNumber"][0])).first()
-            except Exception:
+                df_user = df_users.get(int(ldap_user[1]["uidNumber"][0]))
+            except (KeyError, IndexError, ValueError):
+                df_user = None
+            if not df_user:
                 self.logger.info("The user %s is not in DFAdmin Database." % ldap_user[0])
-            else:
-                if not df_user:
-                    self.logger.info("The user %s is not in DFAdmin Database." % ldap_user[0])
-                else:
-                    if settings.USER_LDAP_MAP["ldap_last_auth_time"] in ldap_user[1]:
-                        try:
-                            ldap_last_auth_time = ldap_user[1][settings.USER_LDAP_MAP["ldap_last_auth_time"]][0]
-                            self.logger.debug("Updating last authentication time for user %s: %s", ldap_user[0], ldap_last_auth_time)
-                            ldap_last_auth_time = datetime.datetime.strptime(ldap_last_auth_time, "%Y%m%d%H%M%SZ")
-                            ldap_last_auth_time = ldap_last_auth_time.replace(tzinfo=pytz.utc)
-                            if df_user.ldap_last_auth_time != ldap_last_auth_time:
-                                df_user.ldap_last_auth_time = ldap_last_auth_time
-                                df_user.changeReason = '[Import from LDAP] updated 302: ldap_last_auth_time'
-                                df_user.save_without_historical_record()
-                        except:
-                            if df_user.ldap_last_auth_time is not None:
-                                df_user.ldap_last_auth_time = None
-                                df_user.changeReason = '[Import from LDAP] updated 307: ldap_last_auth_time (except)'
-                                df_user.save_without_historical_record()
-                    if settings.USER_LDAP_MAP["ldap_last_pwd_change"] in ldap_user[1]:
-                        try:
-                            ldap_last_pwd_change = ldap_user[1][settings.USER_LDAP_MAP["ldap_last_pwd_change"]][0]
-                            self.logger.debug("Updating last password change time for user %s: %s", ldap_user[0], ldap_last_pwd_change)
-                            ldap_last_pwd_change = datetime.datetime.strptime(ldap_last_pwd_change, "%Y%m%d%H%M%SZ")
-                            ldap_last_pwd_change = ldap_last_pwd_change.replace(tzinfo=pytz.utc)
-                            if df_user.ldap_last_pwd_change != ldap_last_pwd_change:
-                                df_user.ldap_last_pwd_change = ldap_last_pwd_change
-                                df_user.changeReason = '[Import from LDAP] updated ldap_last_pwd_change'
-                                df_user.save()
-                        except:
-                            if df_user.ldap_last_pwd_change is not None:
-                                df_user.ldap_last_pwd_change = None
-                                df_user.changeReason = '[Import from LDAP] updated ldap_last_pwd_change (except)'
-                                df_user.save()
-                    if settings.USER_LDAP_MAP["ldap_lock_time"] in ldap_user[1]:
-                        try:
-                            ldap_lock_time = ldap_user[1][settings.USER_LDAP_MAP["ldap_lock_time"]][0]
-                            self.logger.debug("Updating lock time for user %s: %s", ldap_user[0],
-                                              ldap_lock_time)
-                            ldap_lock_time = datetime.datetime.strptime(ldap_lock_time, "%Y%m%d%H%M%SZ")
-                            ldap_lock_time = ldap_lock_time.replace(tzinfo=pytz.utc)
-                            if df_user.ldap_lock_time != ldap_lock_time:
-                                df_user.ldap_lock_time = ldap_lock_time
-                                df_user.changeReason = '[Import from LDAP] updated ldap_lock_time'
-                                df_user.save()
-                        except:
-                            if df_user.ldap_lock_time is not None:
-                                df_user.ldap_lock_time = None
-                                df_user.changeReason = '[Import from LDAP] updated ldap_lock_time (except)'
-                                df_user.save()
-
-    # # Locked in DFAdmin but not on LDAP anymore
-    # df_user.status == User.STATUS_LOCKED_WRONG_PASSWD and settings.USER_LDAP_MAP["ldap_lock_time"] not in ldap_user[1]
-    #
-    # # Locked in DFAdmin and still has the flag on LDAP bc the user didn't login again.
-    # df_user.status == User.STATUS_LOCKED_WRONG_PASSWD and timezone.now() > df_user.ldap_lock_time + datetime.timedelta(seconds=settings.LDAP_SETTINGS['General']['PpolicyLockDownDurationSeconds'])
-
-                    if df_user.status == User.STATUS_LOCKED_WRONG_PASSWD and \
-                        ( df_user.ldap_lock_time is None or
-                        timezone.now() > df_user.ldap_lock_time + datetime.timedelta(seconds=settings.LDAP_SETTINGS['General']['PpolicyLockDownDurationSeconds']) ):
-                        self.logger.info("User %s was unlocked automatically", ldap_user[0])
-                        df_user.status = User.STATUS_ACTIVE
-                        df_user.ldap_lock_time = None
-                        df_user.changeReason = '[Import from LDAP] 344: Unlocking user (STATUS=STATUS_LOCKED_WRONG_PASSWD)'
-                        df_user.save()
-                    elif df_user.status == User.STATUS_ACTIVE and \
-                        (df_user.ldap_lock_time is not None and timezone.now() > df_user.ldap_lock_time + datetime.timedelta(seconds=settings.LDAP_SETTINGS['General']['PpolicyLockDownDurationSeconds'])):
-                        self.logger.info("User %s was unlocked automatically", ldap_user[0])
-                        df_user.ldap_lock_time = None
-                        df_user.changeReason = '[Import from LDAP] 344: Cleaning ldap_lock_time on DFadmin'
-                        df_user.save_without_historical_record()
-
-                    elif df_user.status == User.STATUS_ACTIVE and \
-                                    df_user.ldap_lock_time is not None and \
-                                    timezone.now() < df_user.ldap_lock_time + datetime.timedelta(seconds=settings.LDAP_SETTINGS['General']['PpolicyLockDownDurationSeconds']):
-                        df_user.status = User.STATUS_LOCKED_WRONG_PASSWD
-                        df_user.changeReason = '[Import from LDAP] updated 350: STATUS_LOCKED_WRONG_PASSWD'
-                        df_user.save()
-                    self.logger.debug("User %s processed in import user", ldap_user[0])
-        self.logger.info("Finishing LDAP partial import")
+                continue
+
+            changed, reason = self.reconcile_user(df_user, ldap_user[1], now)
+            if reason:
+                df_user.changeReason = reason
+                status_updates.append(df_user)
+            elif changed:
+                timestamp_updates.append(df_user)
+
+        bulk_update(timestamp_updates, self.LDAP_TIMESTAMP_FIELDS)
+        for df_user in status_updates:
+            df_user.save()
+        self.logger.info("Finishing LDAP partial import: %d users with new timestamps, %d with a new status",
+                         len(timestamp_updates), len(status_updates))
 
     def import_datasets(self):
         self.logger.info("Starting Datasets partial import")
@@ -389,9 +544,7 @@ class LDAPHelper:
             [(str(ldap_dataset[1][settings.DATASET_LDAP_MAP['ldap_name']][0]),
               ldap_dataset) for ldap_dataset in
              ldap_datasets])
-        ldap_cns = set(
-            [ldap_dataset[1][settings.DATASET_LDAP_MAP['ldap_name']][0] for ldap_dataset in
-             ldap_datasets])
+        ldap_cns = set(ldap_tuple_by_cn)
         df_dataset_cns = set([str(dataset.ldap_name) for dataset in df_datasets])
 
         cns_to_create = ldap_cns - df_dataset_cns
@@ -429,17 +582,168 @@ class LDAPHelper:
         self.logger.info("Finishing Datasets partial import")
 
 
-    def export_users(self):
+    def export_all(self, pool_size=None, changes=None):
+        """
+        Runs the whole LDAP export computing what needs to change first and then applying the
+        LDAP writes through a pool of connections.
+        Users are planned and applied first, as creating them activates the accounts that
+        the projects, roles and datasets exports include as members.
+
+        :param changes: optional dict from changed_since(), to export only those objects.
+        :return: OrderedDict with the seconds spent on each phase.
+        """
+        if pool_size is None:
+            pool_size = settings.LDAP_SETTINGS['General']['ExportPoolSize']
+        changes = changes or {}
+        phases = [('users', [(self.export_users, 'users')]),
+                  ('groups', [(self.export_projects, 'projects'),
+                              (self.export_df_roles, 'df_roles'),
+                              (self.export_datasets, 'datasets')])]
+        timings = OrderedDict()
+        for phase, exports in phases:
+            start = time.time()
+            self.__pending_writes = []
+            try:
+                for export, key in exports:
+                    export(changes.get(key))
+                writes = self.__pending_writes
+            finally:
+                self.__pending_writes = None
+            timings['%s_plan' % phase] = time.time() - start
+
+            start = time.time()
+            self.apply_writes(writes, pool_size)
+            timings['%s_apply' % phase] = time.time() - start
+            self.logger.info("LDAP export %s: %d writes planned in %.2fs and applied in %.2fs",
+                             phase, len(writes), timings['%s_plan' % phase], timings['%s_apply' % phase])
+        return timings
+
+    @staticmethod
+    def changed_since(since, until):
+        """
+        Computes which objects may have a different LDAP representation between since and until.
+        Besides the objects updated on that window, it includes the ones affected by membership
+        changes and by dates that were crossed (memberships starting or ending, dataset accesses
+        expiring and users reaching the inactivity period).
+
+        :return: dict of querysets with the keys users, df_roles, projects and datasets.
+        """
+        def crossed(field, start=since, end=until):
+            return Q(**{field + '__gt': start, field + '__lte': end})
+
+        users = User.objects.filter(
+            Q(updated_at__gt=since) |
+            Q(status__in=[User.STATUS_NEW, User.STATUS_UNLOCKED_BY_ADMIN]) |
+            crossed('ldap_last_auth_time', since - INACTIVITY_PERIOD, until - INACTIVITY_PERIOD) |
+            Q(ldap_last_auth_time__isnull=True) &
+            crossed('created_at', since - INACTIVITY_PERIOD, until - INACTIVITY_PERIOD))
+
+        df_roles = DfRole.objects.filter(
+            Q(updated_at__gt=since) |
+            Q(id__in=UserDfRole.history.filter(history_date__gt=since).values('role')) |
+            Q(id__in=UserDfRole.objects.filter(crossed('begin') | crossed('end') |
+                                               Q(user__in=users)).values('role')))
+
+        projects = Project.objects.filter(
+            Q(updated_at__gt=since) |
+            Q(id__in=ProjectMember.history.filter(history_date__gt=since).values('project')) |
+            Q(id__in=ProjectMember.objects.filter(crossed('start_date') | crossed('end_date') |
+                                                  Q(member__in=users)).values('project')) |
+            Q(instructors__in=df_roles))
+
+        datasets = Dataset.objects.filter(
+            Q(updated_at__gt=since) |
+            Q(expiration__gt=since.date(), expiration__lte=until.date()) |
+            Q(id__in=DatasetAccess.history.filter(history_date__gt=since).values('dataset')) |
+            Q(id__in=DatasetAccess.objects.filter(crossed('start_at') | crossed('end_at') |
+                                                  Q(project__in=projects)).values('dataset')))
+        if users.exists():
+            datasets = datasets | Dataset.objects.filter(public=True)
+
+        return {'users': users, 'df_roles': df_roles, 'projects': projects, 'datasets': datasets}
+
+    def export_incremental(self, parallel=False):
+        """
+        Exports only what changed since the last export, using SystemInfo.last_export as the
+        watermark. Objects deleted from DFAdmin are only cleaned from LDAP by full exports, which
+        run when there is no watermark yet or the last one is older than FullExportIntervalHours.
+        """
+        system_info = SystemInfo.get()
+        started_at = timezone.now()
+        full_export_interval = datetime.timedelta(
+            hours=settings.LDAP_SETTINGS['General']['FullExportIntervalHours'])
+
+        changes = None
+        if system_info.last_export is None or system_info.last_full_export is None \
+                or system_info.last_full_export < started_at - full_export_interval:
+            self.logger.info("Running a full LDAP export.")
+        else:
+            self.logger.info("Running an incremental LDAP export since %s.", system_info.last_export)
+            changes = self.changed_since(system_info.last_export, started_at)
+
+        if parallel:
+            self.export_all(changes=changes)
+        else:
+            changes = changes or {}
+            self.export_users(changes.get('users'))
+            self.export_projects(changes.get('projects'))
+            self.export_df_roles(changes.get('df_roles'))
+            self.export_datasets(changes.get('datasets'))
+
+        if changes is None:
+            system_info.last_full_export = started_at
+        system_info.last_export = started_at
+        system_info.save()
+
+    def _user_created(self, df_user, created_users):
+        self.logger.info("Creating user %s in LDAP" % df_user.username)
+        df_user.status = User.STATUS_ACTIVE
+        df_user.changeReason = '[LDAP Export] updated 469: Activating user. NEW -> ACTIVE'
+        df_user.save()
+        created_users.append(df_user)
+        self.logger.info("Set status of user %s to Active", df_user.username)
+
+    def _user_disabled(self, df_user, keycloak_helper):
+        self.logger.debug("Locking user %s in LDAP" % df_user.username)
+        keycloak_helper.disable_user(df_user)
+        self.logger.debug("User locked in Keycloak: %s" % df_user.username)
+
+    def _user_unlocked(self, df_user, keycloak_helper):
+        self.logger.debug("Unlocking user %s in LDAP" % df_user.username)
+        df_user.status = User.STATUS_ACTIVE
+        keycloak_helper.enable_user(df_user)
+        self.logger.debug("User unlocked in Keycloak: %s" % df_user.username)
+        df_user.changeReason = '[LDAP Export] updated 493: Unlocking user. STATUS_UNLOCKED_BY_ADMIN -> STATUS_ACTIVE'
+        df_user.save()
+        self.logger.debug("Set status of user %s to Active", df_user.username)
+
+    def _user_locked_by_inactivity(self, df_user):
+        self.logger.debug("Locking the user %s in LDAP" % df_user.username)
+        if df_user.status != User.STATUS_LOCKED_INACTIVITY:
+            df_user.status = User.STATUS_LOCKED_INACTIVITY
+            df_user.changeReason = '[LDAP Export] updated 516: Locking by inactivity . -> STATUS_LOCKED_INACTIVITY'
+            df_user.save()
+            self.logger.debug("Setting the status of user %s to Locked by Inactivity", df_user.username)
+
+    def export_users(self, users=None):
         #self.logger.info("Starting LDAP export")
-        ldap_users = self.get_ldap_users()
-        df_users = User.objects.all().order_by('ldap_name')
+        names = None
+        if users is None:
+            df_users = User.objects.all().order_by('ldap_name')
+        else:
+            df_users = users.order_by('ldap_name')
+            names = [str(user.username) for user in df_users]
+            if not names:
+                return
+        ldap_users = self.get_ldap_users(names)
         #self.logger.debug("Exporting %d users", len(df_users))
-        ldap_tuple_df = dict([(str(user.username), UserLDAPSerializer.dumps(user)) for user in df_users])
+        df_users = list(df_users)
+        ldap_tuple_df = dict([(str(user.username), ldap_tuple) for user, ldap_tuple in
+                              zip(df_users, UserLDAPSerializer.dumps_many(df_users))])
         ldap_tuple_curr = dict(
-            [(ldap_user[1][settings.USER_LDAP_MAP['username']][0], ldap_user) for ldap_user in ldap_users])
-        ldap_usernames = set([ldap_user[1][settings.USER_LDAP_MAP['username']][0] for ldap_user in ldap_users if
-                              settings.USER_LDAP_MAP['username'] in ldap_user[1] and ldap_user[1][
-                                  settings.USER_LDAP_MAP['username']]])
+            [(ldap_user[1][settings.USER_LDAP_MAP['username']][0], ldap_user) for ldap_user in ldap_users if
+             ldap_user[1].get(settings.USER_LDAP_MAP['username'])])
+        ldap_usernames = set(ldap_tuple_curr)
         df_usernames = set([df_user.username for df_user in df_users])
         users_just_in_ldap = ldap_usernames - df_usernames
         created_users = []
@@ -449,50 +753,44 @@ class LDAPHelper:
         ldap_groups_tuple_curr = None
         ldap_private_group_tuple_new = None
         if settings.LDAP_SETTINGS['General']['UserPrivateGroups']:
-            ldap_groups = self.get_ldap_groups()
+            ldap_groups = self.get_ldap_groups(names)
             ldap_groups_tuple_curr = dict(
                 [(str(ldap_group[1][settings.USER_PRIVATE_GROUP_LDAP_MAP['ldap_name']][0]), ldap_group) for ldap_group
                  in ldap_groups])
             ldap_private_group_tuple_new = dict(
-                [(str(user.username), UserPrivateGroupLDAPSerializer.dumps(user)) for user in df_users])
+                [(str(user.username), ldap_tuple) for user, ldap_tuple in
+                 zip(df_users, UserPrivateGroupLDAPSerializer.dumps_many(df_users))])
 
         for username in users_just_in_ldap:
             if settings.LDAP_SETTINGS['General']['CleanNotInDB']:
-                try:
-                    self.__ldap_conn.delete_s(ldap_tuple_curr[username][0])
-                    self.logger.warning("The user %s is not in DFAdmin Database and it's deleted." % username)
-                except Exception:
-                    self.logger.exception("User not deleted: %s" % username)
+                self._write(ldap_tuple_curr[username][0],
+                            [self.delete_operation(ldap_tuple_curr[username][0])],
+                            "User not deleted: %s" % username,
+                            partial(self.logger.warning,
+                                    "The user %s is not in DFAdmin Database and it's deleted." % username))
             else:
                 self.logger.warning("The user %s is not in DFAdmin Database" % username)
 
         for df_user in df_users:
             if df_user.status == User.STATUS_NEW:
-                try:
-                    if settings.LDAP_SETTINGS['General']['UserPrivateGroups']:
-                        try:
-                            self.ldap_add(ldap_private_group_tuple_new[df_user.username])
-                            self.logger.info("Creating User Private Group %s" % df_user.username)
-                        except Exception as ex:
-                            self.logger.error("Error creating User Private Group: %s" % ex.message)
-
-                    self.ldap_add(ldap_tuple_df[df_user.username])
-                    self.logger.info("Creating user %s in LDAP" % df_user.username)
-                    df_user.status = User.STATUS_ACTIVE
-                    df_user.changeReason = '[LDAP Export] updated 469: Activating user. NEW -> ACTIVE'
-                    df_user.save()
-                    created_users.append(df_user)
-                    self.logger.info("Set status of user %s to Active", df_user.username)
-                except Exception:
-                    self.logger.exception("The user %s was not created in LDAP" % df_user.username)
+                if settings.LDAP_SETTINGS['General']['UserPrivateGroups']:
+                    private_group = ldap_private_group_tuple_new[df_user.username]
+                    self._write(private_group[0], [self.add_operation(private_group)],
+                                "Error creating User Private Group: %s" % df_user.username,
+                                partial(self.logger.info, "Creating User Private Group %s" % df_user.username))
+
+                ldap_tuple = ldap_tuple_df[df_user.username]
+                self._write(ldap_tuple[0], [self.add_operation(ldap_tuple)],
+                            "The user %s was not created in LDAP" % df_user.username,
+                            partial(self._user_created, df_user, created_users))
             elif df_user.status == User.STATUS_DISABLED or df_user.status == User.STATUS_LOCKED_BY_ADMIN:
                 try:
                     ldap_tuple = ldap_tuple_df[df_user.username]
                     ldap_tuple[1][settings.USER_LDAP_MAP["ldap_lock_time"]] = ["000001010000Z"]
-                    self.ldap_update(ldap_tuple, ldap_tuple_curr[df_user.username])
-                    self.logger.debug("Locking user %s in LDAP" % df_user.username)
-                    keycloak_helper.disable_user(df_user)
-                    self.logger.debug("User locked in Keycloak: %s" % df_user.username)
+                    self._write(ldap_tuple[0],
+                                self.update_operations(ldap_tuple, ldap_tuple_curr[df_user.username]),
+                                "The user %s was not disabled in LDAP" % df_user.username,
+                                partial(self._user_disabled, df_user, keycloak_helper))
                 except Exception:
                     self.logger.exception("The user %s was not disabled in LDAP" % df_user.username)
             elif df_user.status == User.STATUS_UNLOCKED_BY_ADMIN:
@@ -500,72 +798,87 @@ class LDAPHelper:
                     ldap_tuple = ldap_tuple_df[df_user.username]
                     if 'pwdAccountLockedTime' in ldap_tuple[1]:
                         ldap_tuple[1].pop(settings.USER_LDAP_MAP["ldap_lock_time"])
-                    self.ldap_update(ldap_tuple, ldap_tuple_curr[df_user.username])
-                    self.logger.debug("Unlocking user %s in LDAP" % df_user.username)
-                    df_user.status = User.STATUS_ACTIVE
-                    keycloak_helper.enable_user(df_user)
-                    self.logger.debug("User unlocked in Keycloak: %s" % df_user.username)
-                    df_user.changeReason = '[LDAP Export] updated 493: Unlocking user. STATUS_UNLOCKED_BY_ADMIN -> STATUS_ACTIVE'
-                    df_user.save()
-                    self.logger.debug("Set status of user %s to Active", df_user.username)
+                    self._write(ldap_tuple[0],
+                                self.update_operations(ldap_tuple, ldap_tuple_curr[df_user.username]),
+                                "The user %s was not unlocked in LDAP" % df_user.username,
+                                partial(self._user_unlocked, df_user, keycloak_helper))
                 except Exception:
                     self.logger.exception("The user %s was not unlocked in LDAP" % df_user.username)
             elif df_user.status in User.MEMBERSHIP_STATUS_WHITELIST and \
                     (df_user.ldap_last_auth_time is not None and df_user.ldap_last_auth_time < timezone.now() -
-                        datetime.timedelta(60, 0, 0)) or (df_user.ldap_last_auth_time is None and
-                            df_user.created_at is not None and df_user.created_at < timezone.now() - datetime.timedelta(
-                                60, 0, 0)):
+                        INACTIVITY_PERIOD) or (df_user.ldap_last_auth_time is None and
+                            df_user.created_at is not None and df_user.created_at < timezone.now() -
+                                INACTIVITY_PERIOD):
                 last_locked_time = df_user.history.filter(status=User.STATUS_LOCKED_INACTIVITY).first()
                 last_unlocked_time = df_user.history.filter(status=User.STATUS_UNLOCKED_BY_ADMIN).first()
                 if last_unlocked_time is not None and last_locked_time is not None \
                         and last_unlocked_time.history_date > last_locked_time.history_date and \
-                                last_unlocked_time.history_date > timezone.now() - datetime.timedelta(60, 0, 0):
+                                last_unlocked_time.history_date > timezone.now() - INACTIVITY_PERIOD:
                     self.logger.debug("The user %s was not locked by inactivity because the user was unlocked by admin", df_user.username)
                 else:
                     try:
                         ldap_tuple = ldap_tuple_df[df_user.username]
                         ldap_tuple[1][settings.USER_LDAP_MAP["ldap_lock_time"]] = ["000001010000Z"]
-                        self.ldap_update(ldap_tuple, ldap_tuple_curr[df_user.username])
-                        self.logger.debug("Locking the user %s in LDAP" % df_user.username)
-                        if df_user.status != User.STATUS_LOCKED_INACTIVITY:
-                            df_user.status = User.STATUS_LOCKED_INACTIVITY
-                            df_user.changeReason = '[LDAP Export] updated 516: Locking by inactivity . -> STATUS_LOCKED_INACTIVITY'
-                            df_user.save()
-                            self.logger.debug("Setting the status of user %s to Locked by Inactivity", df_user.username)
+                        self._write(ldap_tuple[0],
+                                    self.update_operations(ldap_tuple, ldap_tuple_curr[df_user.username]),
+                                    "The user %s was not locked by inactivity in LDAP" % df_user.username,
+                                    partial(self._user_locked_by_inactivity, df_user))
                     except Exception:
                         self.logger.exception("The user %s was not locked by inactivity in LDAP" % df_user.username)
             #Next is the update part, make sure the entry exists in LDAP before update ...
             elif df_user.username in ldap_tuple_curr:
                 if settings.LDAP_SETTINGS['General']['UserPrivateGroups']:
+                    private_group = ldap_private_group_tuple_new[df_user.username]
                     if df_user.username in ldap_groups_tuple_curr:
-                        try:
-                            self.ldap_update(ldap_private_group_tuple_new[df_user.username],
-                                             ldap_groups_tuple_curr[df_user.username])
-                            self.logger.debug("Updated User Private Group for user %s", df_user.username)
-                        except Exception:
-                            self.logger.exception("UserPrivateGroup not updated: %s", df_user.username)
+                        self._write(private_group[0],
+                                    self.update_operations(private_group, ldap_groups_tuple_curr[df_user.username]),
+                                    "UserPrivateGroup not updated: %s" % df_user.username,
+                                    partial(self.logger.debug,
+                                            "Updated User Private Group for user %s" % df_user.username))
                     elif df_user.status in User.MEMBERSHIP_STATUS_WHITELIST:
-                        try:
-                            self.ldap_add(ldap_private_group_tuple_new[df_user.username])
-                            self.logger.debug("Created User Private Group for user %s in LDAP" % df_user.username)
-                        except Exception:
-                            self.logger.exception("UserPrivateGroup not created: %s", df_user.username)
-                try:
-                    self.ldap_update(ldap_tuple_df[df_user.username], ldap_tuple_curr[df_user.username])
-                    self.logger.debug("Updated user %s in LDAP" % df_user.username)
-                except Exception:
-                    self.logger.exception("User not updated: %s" % df_user.username)
-
-        keycloak_helper.send_welcome_email(created_users, reset_otp=settings.ADRF_MFA_ACTIVATED, reset_pwd=True)
+                        self._write(private_group[0], [self.add_operation(private_group)],
+                                    "UserPrivateGroup not created: %s" % df_user.username,
+                                    partial(self.logger.debug,
+                                            "Created User Private Group for user %s in LDAP" % df_user.username))
+                ldap_tuple = ldap_tuple_df[df_user.username]
+                self._write(ldap_tuple[0],
+                            self.update_operations(ldap_tuple, ldap_tuple_curr[df_user.username]),
+                            "User not updated: %s" % df_user.username,
+                            partial(self.logger.debug, "Updated user %s in LDAP" % df_user.username))
+
+        # Queued with no LDAP operations, so it runs after the users above are created.
+        self._write(None, [], "Error sending welcome emails",
+                    partial(keycloak_helper.send_welcome_email, created_users,
+                            reset_otp=settings.ADRF_MFA_ACTIVATED, reset_pwd=True))
+
+    def _export_group_updates(self, cn, ldap_tuple_new, ldap_tuple_curr, object_name):
+        if settings.LDAP_SETTINGS['General']['RecreateGroups']:
+            self._write(ldap_tuple_curr[0],
+                        self.recreate_operations(ldap_tuple_new, ldap_tuple_curr),
+                        "%s not recreated: %s" % (object_name, cn),
+                        partial(self.logger.debug, "%s %s has been recreated" % (object_name, cn)))
+        else:
+            self._write(ldap_tuple_new[0],
+                        self.update_operations(ldap_tuple_new, ldap_tuple_curr),
+                        "%s not updated: %s" % (object_name, cn),
+                        partial(self.logger.debug, "%s %s has been updated" % (object_name, cn)))
 
-    def export_projects(self):
+    def export_projects(self, projects=None):
         self.logger.info("Starting projects export.")
-        ldap_projects = self.get_ldap_projects()
+        names = None
         df_projects = Project.objects.exclude(ldap_name__isnull=True)
-        ldap_tuple_new = dict([(str(proj.ldap_name).lower(), ProjectLDAPSerializer.dumps(proj)) for proj in df_projects])
+        if projects is not None:
+            df_projects = df_projects.filter(id__in=projects.values('id'))
+            names = [str(proj.ldap_name) for proj in df_projects]
+            if not names:
+                return
+        ldap_projects = self.get_ldap_projects(names)
+        df_projects = list(df_projects)
+        ldap_tuple_new = dict([(str(proj.ldap_name).lower(), ldap_tuple) for proj, ldap_tuple in
+                               zip(df_projects, ProjectLDAPSerializer.dumps_many(df_projects))])
         ldap_tuple_curr = dict(
             [(ldap_proj[1][settings.PROJECT_LDAP_MAP['ldap_name']][0].lower(), ldap_proj) for ldap_proj in ldap_projects])
-        ldap_cns = set([ldap_proj[1][settings.PROJECT_LDAP_MAP['ldap_name']][0].lower() for ldap_proj in ldap_projects])
+        ldap_cns = set(ldap_tuple_curr)
         df_proj_active = set([str(proj.ldap_name).lower() for proj in df_projects if proj.status == Project.STATUS_ACTIVE])
         df_proj_disabled = set([str(proj.ldap_name).lower() for proj in df_projects if proj.status != Project.STATUS_ACTIVE])
 
@@ -576,55 +889,42 @@ class LDAPHelper:
 
         for cn in cns_just_in_ldap:
             if settings.LDAP_SETTINGS['General']['CleanNotInDB']:
-                try:
-                    self.__ldap_conn.delete_s(ldap_tuple_curr[cn][0])
-                    self.logger.debug("The project %s is not in DFAdmin Database and it's deleted." % cn)
-                except Exception as e:
-                    self.logger.exception("Project not deleted: %s" % cn)
+                self._write(ldap_tuple_curr[cn][0], [self.delete_operation(ldap_tuple_curr[cn][0])],
+                            "Project not deleted: %s" % cn,
+                            partial(self.logger.debug,
+                                    "The project %s is not in DFAdmin Database and it's deleted." % cn))
             else:
                 self.logger.warning("The project %s is not in DFAdmin Database" % cn)
 
         for cn in cns_to_delete:
-            try:
-                self.__ldap_conn.delete_s(ldap_tuple_curr[cn][0])
-                self.logger.debug("The project %s has been deleted." % cn)
-            except Exception as e:
-                self.logger.exception("Project not deleted: %s" % cn)
+            self._write(ldap_tuple_curr[cn][0], [self.delete_operation(ldap_tuple_curr[cn][0])],
+                        "Project not deleted: %s" % cn,
+                        partial(self.logger.debug, "The project %s has been deleted." % cn))
         for cn in cns_to_create:
-            try:
-                self.ldap_add(ldap_tuple_new[cn])
-                self.logger.debug("The project %s has been created." % cn)
-            except Exception as e:
-                self.logger.exception("Project not created: %s" % cn)
+            self._write(ldap_tuple_new[cn][0], [self.add_operation(ldap_tuple_new[cn])],
+                        "Project not created: %s" % cn,
+                        partial(self.logger.debug, "The project %s has been created." % cn))
         for cn in cns_to_update:
-            if settings.LDAP_SETTINGS['General']['RecreateGroups']:
-                try:
-                    self.__ldap_conn.delete_s(ldap_tuple_curr[cn][0])
-                    orig_tuple = ldap_tuple_new[cn]
-                    copy_tuple = deepcopy(orig_tuple)
-                    if "member" in copy_tuple[1]:
-                        copy_tuple[1].pop("member")
-                    self.ldap_add(copy_tuple)
-                    self.ldap_update(orig_tuple, copy_tuple)
-                    self.logger.debug("The project %s has been recreadted." % cn)
-                except Exception as e:
-                    self.logger.exception("Project not recreated: %s" % cn)
-            else:
-                try:
-                    self.ldap_update(ldap_tuple_new[cn], ldap_tuple_curr[cn])
-                    self.logger.debug("The project %s has been updated" % cn)
-                except Exception as e:
-                    self.logger.exception("Project not updated: %s" % cn)
+            self._export_group_updates(cn, ldap_tuple_new[cn], ldap_tuple_curr[cn], 'Project')
         self.logger.info("Project Export has ended.")
 
-    def export_df_roles(self):
+    def export_df_roles(self, df_roles=None):
         self.logger.info("Starting DF Roles (LDAP Groups) Export.")
-        ldap_groups = self.get_ldap_groups()
-        df_roles = DfRole.objects.exclude(ldap_name__isnull=True)
-        ldap_tuple_new = dict([(str(role.ldap_name), DfRoleLDAPSerializer.dumps(role)) for role in df_roles])
+        names = None
+        if df_roles is None:
+            df_roles = DfRole.objects.exclude(ldap_name__isnull=True)
+        else:
+            df_roles = df_roles.exclude(ldap_name__isnull=True)
+            names = [str(role.ldap_name) for role in df_roles]
+            if not names:
+                return
+        ldap_groups = self.get_ldap_groups(names)
+        df_roles = list(df_roles)
+        ldap_tuple_new = dict([(str(role.ldap_name), ldap_tuple) for role, ldap_tuple in
+                               zip(df_roles, DfRoleLDAPSerializer.dumps_many(df_roles))])
         ldap_tuple_curr = dict(
             [(ldap_group[1][settings.GROUP_LDAP_MAP['ldap_name']][0], ldap_group) for ldap_group in ldap_groups])
-        ldap_cns = set([ldap_group[1][settings.GROUP_LDAP_MAP['ldap_name']][0] for ldap_group in ldap_groups])
+        ldap_cns = set(ldap_tuple_curr)
         df_role_cns = set([str(role.ldap_name) for role in df_roles])
 
         cns_to_delete = ldap_cns - df_role_cns
@@ -635,48 +935,35 @@ class LDAPHelper:
         cns_to_update = df_role_cns & ldap_cns
 
         for cn in cns_to_delete:
-            try:
-                self.__ldap_conn.delete_s(ldap_tuple_curr[cn][0])
-                self.logger.debug("DfRole %s has been deleted" % cn)
-            except Exception as e:
-                self.logger.exception("DfRole not deleted: %s" % cn)
+            self._write(ldap_tuple_curr[cn][0], [self.delete_operation(ldap_tuple_curr[cn][0])],
+                        "DfRole not deleted: %s" % cn,
+                        partial(self.logger.debug, "DfRole %s has been deleted" % cn))
 
         for cn in cns_to_create:
-            try:
-                self.ldap_add(ldap_tuple_new[cn])
-                self.logger.debug("DfRole %s has been created", cn)
-            except Exception as e:
-                self.logger.exception("DfRole not created in LDAP: %s", cn)
+            self._write(ldap_tuple_new[cn][0], [self.add_operation(ldap_tuple_new[cn])],
+                        "DfRole not created in LDAP: %s" % cn,
+                        partial(self.logger.debug, "DfRole %s has been created" % cn))
 
         for cn in cns_to_update:
-            if settings.LDAP_SETTINGS['General']['RecreateGroups']:
-                try:
-                    self.__ldap_conn.delete_s(ldap_tuple_curr[cn][0])
-                    orig_tuple = ldap_tuple_new[cn]
-                    copy_tuple = deepcopy(orig_tuple)
-                    if "member" in copy_tuple[1]:
-                        copy_tuple[1].pop("member")
-                    self.ldap_add(copy_tuple)
-                    self.ldap_update(orig_tuple, copy_tuple)
-                    self.logger.debug("DfRole %s has been recreated", cn)
-                except Exception as e:
-                    self.logger.exception("DfRole not recreated: %s", cn)
-            else:
-                try:
-                    self.ldap_update(ldap_tuple_new[cn], ldap_tuple_curr[cn])
-                    self.logger.debug("DfRole %s has been updated", cn)
-                except Exception as e:
-                    self.logger.exception("DfRole not updated: %s", cn)
+            self._export_group_updates(cn, ldap_tuple_new[cn], ldap_tuple_curr[cn], 'DfRole')
         self.logger.info("DF Roles (LDAP Groups) Export has ended.")
 
-    def export_datasets(self):
+    def export_datasets(self, datasets=None):
         self.logger.info("Stating Datasets Export.")
-        ldap_datasets = self.get_ldap_datasets()
+        names = None
         df_datasets = Dataset.objects.exclude(ldap_name__isnull=True)
-        ldap_tuple_new = dict([(str(dataset.ldap_name), DatasetLDAPSerializer.dumps(dataset)) for dataset in df_datasets])
+        if datasets is not None:
+            df_datasets = df_datasets.filter(id__in=datasets.values('id'))
+            names = [str(dataset.ldap_name) for dataset in df_datasets]
+            if not names:
+                return
+        ldap_datasets = self.get_ldap_datasets(names)
+        df_datasets = list(df_datasets)
+        ldap_tuple_new = dict([(str(dataset.ldap_name), ldap_tuple) for dataset, ldap_tuple in
+                               zip(df_datasets, DatasetLDAPSerializer.dumps_many(df_datasets))])
         ldap_tuple_curr = dict(
             [(ldap_dataset[1][settings.DATASET_LDAP_MAP['ldap_name']][0], ldap_dataset) for ldap_dataset in ldap_datasets])
-        ldap_cns = set([ldap_dataset[1][settings.DATASET_LDAP_MAP['ldap_name']][0] for ldap_dataset in ldap_datasets])
+        ldap_cns = set(ldap_tuple_curr)
         df_dataset_cns = set([str(dataset.ldap_name) for dataset in df_datasets])
 
         cns_to_delete = ldap_cns - df_dataset_cns
@@ -692,31 +979,12 @@ class LDAPHelper:
         #         self.logger.exception("Dataset not deleted: %s", cn)
 
         for cn in cns_to_create:
-            try:
-                self.ldap_add(ldap_tuple_new[cn])
-                self.logger.debug("Dataset %s has been created", cn)
-            except Exception as e:
-                self.logger.exception("Dataset not created in LDAP: %s", cn)
+            self._write(ldap_tuple_new[cn][0], [self.add_operation(ldap_tuple_new[cn])],
+                        "Dataset not created in LDAP: %s" % cn,
+                        partial(self.logger.debug, "Dataset %s has been created" % cn))
 
         for cn in cns_to_update:
-            if settings.LDAP_SETTINGS['General']['RecreateGroups']:
-                try:
-                    self.__ldap_conn.delete_s(ldap_tuple_curr[cn][0])
-                    orig_tuple = ldap_tuple_new[cn]
-                    copy_tuple = deepcopy(orig_tuple)
-                    if "member" in copy_tuple[1]:
-                        copy_tuple[1].pop("member")
-                    self.ldap_add(copy_tuple)
-                    self.ldap_update(orig_tuple, copy_tuple)
-                    self.logger.debug("Dataset %s has been recreated", cn)
-                except Exception as e:
-                    self.logger.exception("Dataset not recreated: %s", cn)
-            else:
-                try:
-                    self.ldap_update(ldap_tuple_new[cn], ldap_tuple_curr[cn])
-                    self.logger.debug("Dataset %s has been updated", cn)
-                except Exception as e:
-                    self.logger.exception("Dataset not updated: %s", cn)
+            self._export_group_updates(cn, ldap_tuple_new[cn], ldap_tuple_curr[cn], 'Dataset')
         self.logger.info("Datasets Export has ended.")
 
 
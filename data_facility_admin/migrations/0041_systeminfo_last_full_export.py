@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.23 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_facility_admin', '0040_auto_20190827_1559'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='systeminfo',
+            name='last_full_export',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.23 on 2026-10-18 10:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+class Migration(migrations.Migration):
+
+    def init_ldap_id_sequence(apps, schema_editor):
+        LdapObject = apps.get_model('data_facility_admin', 'LdapObject')
+        LdapIdSequence = apps.get_model('data_facility_admin', 'LdapIdSequence')
+        max_id = LdapObject.objects.all().aggregate(Max('ldap_id')).values()[0]
+        # Same as LdapObject.MIN_LDAP_UID when there are no objects yet.
+        LdapIdSequence.objects.create(pk=1, next_id=1000 if max_id is None else max_id + 1)
+
+    dependencies = [
+        ('data_facility_admin', '0041_systeminfo_last_full_export'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LdapIdSequence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('next_id', models.IntegerField()),
+            ],
+        ),
+        migrations.RunPython(init_ldap_id_sequence, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.23 on 2026-10-18 16:05
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_facility_admin', '0043_projectentitlement'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dataset',
+            name='generated_detailed_metadata',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='dataset',
+            name='generated_search_metadata',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='historicaldataset',
+            name='generated_detailed_metadata',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='historicaldataset',
+            name='generated_search_metadata',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
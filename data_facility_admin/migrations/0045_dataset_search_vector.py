@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.23 on 2026-10-18 17:40
+from __future__ import unicode_literals
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_facility_admin', '0044_dataset_generated_metadata'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='dataset',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='historicaldataset',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='dataset',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='dataset_search_vector_gin'),
+        ),
+        # Used by the trigram_similar lookup of the dataset name.
+        migrations.RunSQL(
+            'CREATE INDEX dataset_name_trigram_gin ON data_facility_admin_dataset USING gin (name gin_trgm_ops);',
+            'DROP INDEX dataset_name_trigram_gin;',
+        ),
+    ]
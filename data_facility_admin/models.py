@@ -1,20 +1,27 @@
 '''DfAdmin Django models'''
 from django.contrib.auth.models import User as DjangoUser
 from django.core.validators import RegexValidator, URLValidator, EmailValidator
-from django.db import models
-from django.db.models import Max, Q
-from django.db.models.signals import post_save
+from django.db import models, transaction
+from django.db.models import F, Max, Q
+from django.db.models.signals import post_init, post_save
 from django.dispatch import receiver
 from django.utils import timezone
 from django.conf import settings
 from simple_history.models import HistoricalRecords
+import re
+import threading
 import unicodedata
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import date
 import hashlib
 from model_utils import Choices
 from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, SearchVectorField, TrigramSimilarity
 from django.utils.text import slugify
 import event_hooks
+from data_facility_admin.utils import bulk_update
 CHAR_FIELD_MAX_LENGTH = settings.CHAR_FIELD_MAX_LENGTH
 TEXT_FIELD_MAX_LENGTH = settings.TEXT_FIELD_MAX_LENGTH
 
@@ -57,29 +64,46 @@ class LdapObject(models.Model):
     def ldap_full_dn(self):
         raise NotImplementedError("ldap_full_dn() in LDapObject is not implemented.")
 
+    @staticmethod
+    def normalize_ldap_name(ldap_name):
+        ldap_name = slugify(ldap_name.replace(' ', '').lower())
+        # Normalize non ASCII to ASCII
+        return unicodedata.normalize('NFD', ldap_name).encode('ascii', 'ignore')
+
     def prepare_ldap_name(self):
         ''' Prepares the ldap_name protecting against collisions.'''
-        self.ldap_name = slugify(self.ldap_name.replace(' ','').lower())
-        # Normalize non ASCII to ASCII
-        self.ldap_name = unicodedata.normalize('NFD', self.ldap_name).encode('ascii', 'ignore')
-        count = 0
-        base_ldap_name = self.ldap_name
-        while True:
-            if self.__class__.objects.filter(ldap_name=self.ldap_name).count() > 0:
+        self.__class__.prepare_ldap_names([self])
+
+    @classmethod
+    def prepare_ldap_names(cls, objects):
+        ''' Same as prepare_ldap_name for objects that will be created together, with a single
+            query for the names already taken. The names are also unique within the batch.'''
+        if not objects:
+            return
+        base_ldap_names = [cls.normalize_ldap_name(obj.ldap_name) for obj in objects]
+        pattern = r'^(%s)[0-9]*$' % '|'.join(re.escape(name) for name in set(base_ldap_names))
+        taken = set(cls.objects.filter(ldap_name__regex=pattern).values_list('ldap_name', flat=True))
+        for obj, base_ldap_name in zip(objects, base_ldap_names):
+            count = 0
+            obj.ldap_name = base_ldap_name
+            while obj.ldap_name in taken:
                 count += 1
-                self.ldap_name = base_ldap_name + str(count)
-            else:
-                break
+                obj.ldap_name = base_ldap_name + str(count)
+            taken.add(obj.ldap_name)
+            obj.ldap_name_prepared = True
+
+    @staticmethod
+    def reserve_ldap_ids(count):
+        ''' Reserves a block of count ldap_ids for bulk creation, returning them as a list. '''
+        first_id = LdapIdSequence.reserve(count)
+        return range(first_id, first_id + count)
 
     def save(self, *args, **kwargs):
         if self.ldap_id is None:
-            max_id = LdapObject.objects.all().aggregate(Max('ldap_id')).values()[0]
-            if max_id is None:
-                # Not 1 to be different than system default users/groups.
-                self.ldap_id = LdapObject.MIN_LDAP_UID
-            else:
-                self.ldap_id = max_id + 1
-        if not self.id:
+            self.ldap_id = LdapIdSequence.reserve()
+        elif not self.id:
+            LdapIdSequence.skip_to(self.ldap_id)
+        if not self.id and not getattr(self, 'ldap_name_prepared', False):
             self.prepare_ldap_name()
         super(LdapObject, self).save(*args, **kwargs)
 
@@ -87,6 +111,42 @@ class LdapObject(models.Model):
         return '(%s) %s' % (self.ldap_id, self.ldap_name)
 
 
+class LdapIdSequence(models.Model):
+    ''' This model is internal and hands out the LdapObject ldap_ids.
+        It has a single row that is locked while ids are reserved, so concurrent saves never
+        get the same id.
+    '''
+    next_id = models.IntegerField()
+
+    @staticmethod
+    def initial_value():
+        max_id = LdapObject.objects.all().aggregate(Max('ldap_id')).values()[0]
+        if max_id is None:
+            # Not 1 to be different than system default users/groups.
+            return LdapObject.MIN_LDAP_UID
+        return max_id + 1
+
+    @classmethod
+    def reserve(cls, count=1):
+        ''' Reserves count consecutive ids and returns the first one. '''
+        with transaction.atomic():
+            sequence = cls.objects.select_for_update().filter(pk=1).first()
+            if sequence is None:
+                # Created by the migration, unless the table was flushed. A concurrent caller creating it too
+                # gets the IntegrityError handled by get_or_create, and then waits for the lock.
+                cls.objects.get_or_create(pk=1, defaults={'next_id': cls.initial_value()})
+                sequence = cls.objects.select_for_update().get(pk=1)
+            first_id = sequence.next_id
+            sequence.next_id += count
+            sequence.save(update_fields=['next_id'])
+        return first_id
+
+    @classmethod
+    def skip_to(cls, ldap_id):
+        ''' Makes sure an ldap_id set by hand (e.g. imported from LDAP) is never handed out. '''
+        cls.objects.filter(pk=1, next_id__lte=ldap_id).update(next_id=ldap_id + 1)
+
+
 class ProfileTag(models.Model):
     ''' Profile tags are used to describe users, such as tech-savy/non-tech-savy, CS-backgrund, etc.
         This should facilitate and improve communication with users.
@@ -133,6 +193,20 @@ class DfRole(LdapObject):
         # queryset = UserDfRole.objects.filter(Q(role=self, user__status__in=User.MEMBERSHIP_STATUS_WHITELIST))
         # return queryset.filter(UserDfRole.FILTER_ACTIVE)
 
+    @staticmethod
+    def active_users_by_role(role_ids):
+        '''Same as active_users() for many roles in one query: a dict from role id to the list
+        of active UserDfRoles, with their users already loaded.'''
+        now = timezone.now()
+        active_users = {role_id: [] for role_id in role_ids}
+        for user_df_role in UserDfRole.objects.filter(Q(role__in=list(active_users),
+                                                        begin__lte=now,
+                                                        user__status__in=User.MEMBERSHIP_STATUS_WHITELIST),
+                                                      Q(end__isnull=True) | Q(end__gt=now))\
+                .select_related('user'):
+            active_users[user_df_role.role_id].append(user_df_role)
+        return active_users
+
     def active_usernames(self):
         '''return a list of all active users checking their statuses.'''
         # TODO: this method should be renamed to active_user_df_roles
@@ -162,6 +236,37 @@ class SystemInfo(models.Model):
     ''' This model is internal and serves to store system information such as last sync time.'''
     last_export = models.DateTimeField(null=True, blank=True, editable=False)
     last_import = models.DateTimeField(null=True, blank=True, editable=False)
+    last_full_export = models.DateTimeField(null=True, blank=True, editable=False)
+
+    @classmethod
+    def get(cls):
+        system_info = cls.objects.order_by('id').first()
+        if system_info is None:
+            system_info = cls.objects.create()
+        return system_info
+
+
+class OutboxEvent(models.Model):
+    ''' This model is internal and queues the SNS events, which are written in the transaction of the change
+        that raised them and delivered by data_facility_admin.outbox.
+    '''
+    topic = models.CharField(max_length=CHAR_FIELD_MAX_LENGTH)
+    subject = models.CharField(max_length=CHAR_FIELD_MAX_LENGTH)
+    payload = JSONField()
+    # An event repeating the latest pending one of its entity is not queued, see data_facility_admin.outbox.
+    dedupe_key = models.CharField(max_length=40, db_index=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    # None when the delivery was given up.
+    next_attempt_at = models.DateTimeField(null=True, blank=True, default=timezone.now)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '%s: %s' % (self.topic, self.subject)
+
+    class Meta:
+        indexes = [models.Index(fields=['sent_at', 'next_attempt_at'], name='outbox_pending_idx')]
 
 
 class User(LdapObject):
@@ -253,13 +358,17 @@ class User(LdapObject):
         # https://en.gravatar.com/site/implement/images/
         return "https://www.gravatar.com/avatar/%s?d=identicon&r=PG" % hashlib.md5(self.email).hexdigest()
 
+    def default_ldap_name(self):
+        ldap_name = self.first_name + self.last_name
+        if self.foreign_national:
+            ldap_name += '_fr'
+        if self.contractor:
+            ldap_name += '_ctr'
+        return ldap_name
+
     def save(self, *args, **kwargs):
         if not self.ldap_name:
-            self.ldap_name = (self.first_name + self.last_name)
-            if self.foreign_national:
-                self.ldap_name += '_fr'
-            if self.contractor:
-                self.ldap_name += '_ctr'
+            self.ldap_name = self.default_ldap_name()
 
         return super(User, self).save(*args, **kwargs)
 
@@ -277,11 +386,15 @@ class User(LdapObject):
         except UserDfRole.DoesNotExist:
             return None
 
-    def ldap_full_dn(self):
-        return "uid={0},{1},{2}".format(self.ldap_name,
+    @staticmethod
+    def ldap_dn(ldap_name):
+        return "uid={0},{1},{2}".format(ldap_name,
                                         settings.LDAP_SETTINGS['Users']['BaseDn'],
                                         settings.LDAP_BASE_DN)
 
+    def ldap_full_dn(self):
+        return User.ldap_dn(self.ldap_name)
+
     @property
     def active_roles(self):
         return [udfr.role for udfr in UserDfRole.objects.filter(UserDfRole.FILTER_ACTIVE).filter(user=self)]
@@ -315,35 +428,130 @@ class User(LdapObject):
         ordering = ['first_name', 'last_name', 'ldap_name', 'email']
 
 
+# Fields copied to the DjangoUser, which is found by the User's ldap_name.
+DJANGO_USER_FIELDS = ('first_name', 'last_name', 'email')
+_django_user_batch = threading.local()
+
+
+def _django_user_values(user):
+    # Read from __dict__ so deferred fields are not loaded.
+    return tuple(user.__dict__.get(field) for field in ('ldap_name',) + DJANGO_USER_FIELDS)
+
+
+def _queue_django_user_sync(user):
+    """ Inside batch_django_user_sync(), queues the user and returns True. """
+    pending = getattr(_django_user_batch, 'pending', None)
+    if pending is None:
+        return False
+    pending[user.pk] = user
+    return True
+
+
+@contextmanager
+def batch_django_user_sync():
+    """ Collects the Users saved inside the block and syncs their DjangoUsers in one pass at the end.
+        When the block raises inside a transaction, nothing is synced: the Users are being rolled back.
+        Outside of one, the Users saved before the error were committed and are synced. """
+    if getattr(_django_user_batch, 'pending', None) is not None:
+        # Nested: the outermost block syncs.
+        yield
+        return
+    _django_user_batch.pending = OrderedDict()
+    try:
+        yield
+    except BaseException:
+        users = list(_django_user_batch.pending.values())
+        _django_user_batch.pending = None
+        if not transaction.get_connection().in_atomic_block:
+            sync_django_users(users)
+        raise
+    users = list(_django_user_batch.pending.values())
+    _django_user_batch.pending = None
+    sync_django_users(users)
+
+
+def sync_django_users(users):
+    """ Creates or updates the DjangoUsers of many users with a few queries. """
+    users = [user for user in users if user.ldap_name]
+    if not users:
+        return
+    django_users = dict((du.username, du) for du in
+                        DjangoUser.objects.filter(username__in=[user.ldap_name for user in users]))
+    to_create = []
+    to_update = []
+    for user in users:
+        django_user = django_users.get(user.ldap_name)
+        if django_user is None:
+            django_user = DjangoUser(username=user.ldap_name)
+            to_create.append(django_user)
+            django_users[user.ldap_name] = django_user
+        elif any(getattr(django_user, field) != getattr(user, field) for field in DJANGO_USER_FIELDS):
+            to_update.append(django_user)
+        for field in DJANGO_USER_FIELDS:
+            setattr(django_user, field, getattr(user, field))
+
+    # Postgres returns the new ids, so the users can be linked right away.
+    DjangoUser.objects.bulk_create(to_create)
+    bulk_update(to_update, DJANGO_USER_FIELDS)
+    to_link = []
+    for user in users:
+        django_user = django_users[user.ldap_name]
+        if user.django_user_id != django_user.id:
+            user.django_user = django_user
+            to_link.append(user)
+        user._django_user_values = _django_user_values(user)
+    bulk_update(to_link, ['django_user'])
+    logger.info('Synced DjangoUsers for %d Users: %d created, %d updated',
+                len(users), len(to_create), len(to_update))
+
+
+@receiver(post_init, sender=User)
+def snapshot_django_user_values(sender, instance, **kwargs):
+    instance._django_user_values = _django_user_values(instance)
+
+
 @receiver(post_save, sender=User)
 def create_django_user(sender, instance, created, **kwargs):
     if created:
+        if _queue_django_user_sync(instance):
+            return
         du = DjangoUser.objects.create(username=instance.ldap_name,
                                   first_name=instance.first_name,
                                   last_name=instance.last_name,
                                   email=instance.email,
                                   )
         instance.django_user = du
-        instance.save()
+        instance._django_user_values = _django_user_values(instance)
+        # Link without another save(): no signals nor history for it.
+        User.objects.filter(pk=instance.pk).update(django_user=du)
         logger.info('Created DjangoUser for User: %s' % instance)
 
 
 @receiver(post_save, sender=User)
-def save_django_user(sender, instance, **kwargs):
+def save_django_user(sender, instance, created=False, update_fields=None, **kwargs):
+    if created:
+        # Handled by create_django_user.
+        return
+    if update_fields is not None and not set(update_fields) & set(('ldap_name',) + DJANGO_USER_FIELDS):
+        return
+    if getattr(instance, '_django_user_values', None) == _django_user_values(instance):
+        return
+    if _queue_django_user_sync(instance):
+        return
     try:
         django_user = DjangoUser.objects.get(username=instance.ldap_name)
         django_user.first_name = instance.first_name
         django_user.last_name = instance.last_name
         django_user.email = instance.email
         django_user.save()
+        instance._django_user_values = _django_user_values(instance)
         logger.info('Updated DjangoUser for User: %s' % instance)
 
     except DjangoUser.DoesNotExist as ex:
-        kwargs['created'] = True
-        create_django_user(sender, instance, kwargs)
+        create_django_user(sender, instance, created=True)
 
     except Exception as ex:
-        logger.error('Error while updating DjangoUser for User: %s' % instance, exec_info=True)
+        logger.error('Error while updating DjangoUser for User: %s' % instance, exc_info=True)
 
 
 class UserDfRole(models.Model):
@@ -529,46 +737,28 @@ class Project(LdapObject):
             return ', '.join(members_list)
         return None
 
+    def get_access_graph(self):
+        ''' The AccessGraph attached to this project (see AccessGraph.attach) or a new one. '''
+        from data_facility_admin.access import AccessGraph
+        return getattr(self, 'access_graph', None) or AccessGraph([self])
+
     def active_members(self):
-        members = set()
-        for pm in self.projectmember_set.all():
-            if pm.active() and pm.member.status in User.MEMBERSHIP_STATUS_WHITELIST:
-                members.add(pm.member)
-        # members = {pm.member for pm in ProjectMember.objects.filter(Q(project=self,
-        #                     start_date__lte=timezone.now(),
-        #                     member__status__in=User.MEMBERSHIP_STATUS_WHITELIST),
-        #                     Q(end_date__isnull=True) | Q(end_date__gt=timezone.now()))}
-
-        if self.instructors:
-            members = members | {udr.user for udr in
-                                 UserDfRole.objects.filter(Q(role=self.instructors,
-                                    begin__lte=timezone.now(),
-                                    user__status__in=User.MEMBERSHIP_STATUS_WHITELIST),
-                                    Q(end__isnull=True) | Q(end__gt=timezone.now()))}
-        return members
+        return self.get_access_graph().members(self)
+
+    @staticmethod
+    def active_members_by_project(projects):
+        '''Same as active_members() for many projects at once: a dict from project id to
+        the set of active members (instructors included).'''
+        from data_facility_admin.access import AccessGraph
+        projects = list(projects)
+        graph = AccessGraph(projects)
+        return {project.id: graph.members(project) for project in projects}
 
     def active_member_permissions(self):
-        active_members = self.active_members()
-
-        member_permissions = []
-        # Project Instructors have write permissions by default.
-        if self.instructors:
-            for mr in self.instructors.active_users():
-                member_permissions.append({'username': mr.user.username,
-                                           'system_role': ProjectRole.SYSTEM_ROLE_WRITER})
-        instructor_usernames = [mp['username'] for mp in member_permissions]
-        # Member permissions depend on associated project role.
-        for pm in self.projectmember_set.all():
-            if pm.member in active_members and pm.member.username not in instructor_usernames:
-                member_permissions.append({'username': pm.member.username,
-                                           'system_role': pm.role.system_role})
-
-        return member_permissions
+        return self.get_access_graph().member_permissions(self)
 
     def datasets_with_access(self):
-        data_access_list = self.datasetaccess_set.all()
-        active_das = [da for da in data_access_list if da.status() is DatasetAccess.STATUS_ACTIVE]
-        return [da.dataset.dataset_and_schema() for da in active_das]
+        return [dataset.dataset_and_schema() for dataset in self.get_access_graph().datasets(self)]
 
     def system_name(self):
         # TODO: write unit tests for this
@@ -576,7 +766,7 @@ class Project(LdapObject):
 
     @property
     def tools(self):
-        return [pt.to_json() for pt in ProjectTool.objects.filter(project=self)]
+        return [pt.to_json() for pt in self.projecttool_set.all()]
 
     def save(self, *args, **kwargs):
         if self.ldap_name is None:
@@ -657,6 +847,18 @@ class ProjectMember(models.Model):
         ordering = ['project', 'member']
 
 
+class ProjectEntitlement(models.Model):
+    ''' Denormalized db-sync representation of a project: its members with their system roles and
+        its datasets with their schemas. Maintained by data_facility_admin.entitlements.
+    '''
+    project = models.OneToOneField(Project, on_delete=models.CASCADE, primary_key=True,
+                                   related_name='entitlement')
+    data = JSONField()
+    # When the time windows of the memberships and accesses make the data outdated.
+    valid_until = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
 class ProjectTool(models.Model):
     ''' Project assets such as Database, Filesystem, Git repo, etc.
         The permissions ProjectMembers have depend on the ProjectRole.
@@ -823,6 +1025,19 @@ class Category(models.Model):
         verbose_name_plural = "categories"
 
 
+class DatasetQuerySet(models.QuerySet):
+
+    def search(self, text):
+        ''' Datasets matching the text in their search vector, or by a similar name, by rank. '''
+        query = SearchQuery(text, config=Dataset.SEARCH_CONFIG)
+        matches = Q(search_vector=query)
+        rank = SearchRank(F('search_vector'), query)
+        if settings.DATASET_SEARCH_TRIGRAM:
+            matches |= Q(name__trigram_similar=text)
+            rank = rank + TrigramSimilarity('name', text)
+        return self.filter(matches).annotate(search_rank=rank).order_by('-search_rank', 'name')
+
+
 class Dataset(LdapObject):
     ''' This model will be refactored on the future to represent the whole dataset,
         considering files and variables.
@@ -905,17 +1120,26 @@ class Dataset(LdapObject):
 
     detailed_gmeta = JSONField(blank=True, null=True)
     search_gmeta = JSONField(blank=True, null=True)
+    # Generated from the fields above on save, see update_metadata.
+    generated_search_metadata = JSONField(blank=True, null=True, editable=False)
+    generated_detailed_metadata = JSONField(blank=True, null=True, editable=False)
+    # Updated after save, see update_search_vector.
+    search_vector = SearchVectorField(null=True, editable=False)
 
     # Automatic Fields
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     history = HistoricalRecords()
 
+    objects = DatasetQuerySet.as_manager()
+
     def __str__(self):
         return '%s [%s]' % (self.name, self.dataset_id)
 
     class Meta:
         ordering = ['name']
+        # The trigram index of the name is created by migration 0045, as Django 1.11 indexes have no opclasses.
+        indexes = [GinIndex(fields=['search_vector'], name='dataset_search_vector_gin')]
 
     def ldap_full_dn(self):
         return "uid={0},{1},{2}".format(self.ldap_name,
@@ -932,16 +1156,13 @@ class Dataset(LdapObject):
                 'db_schema': self.db_schema_name()}
 
     def active_members(self):
-        members = set()
-        if self.public:
-            members = {member for member in
-                       User.objects.filter(status__in=User.MEMBERSHIP_STATUS_WHITELIST)}
-        else:
-            for access in DatasetAccess.objects.filter(Q(dataset=self, project__status=Project.STATUS_ACTIVE)):
-                if access.status() == DatasetAccess.STATUS_ACTIVE:
-                    members = members | set(access.project.active_members())
+        from data_facility_admin.access import AccessGraph
+        return AccessGraph.for_datasets([self]).dataset_members(self)
 
-        return members
+    def active_member_ldap_names(self):
+        ''' Same as active_members, but only the ldap_names, loaded with a values() query. '''
+        from data_facility_admin.access import dataset_member_ldap_names
+        return dataset_member_ldap_names([self])[self.id]
 
     def curators(self):
         '''Get the list of data curators associated with the dataset.'''
@@ -964,8 +1185,16 @@ class Dataset(LdapObject):
     def save(self, *args, **kwargs):
         if self.ldap_name is None:
             self.ldap_name = self.dataset_id
-        event_hooks.dataset_saved(self)
-        super(Dataset, self).save(*args, **kwargs)
+        self.update_metadata()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | set(Dataset.GENERATED_METADATA_FIELDS)
+        created = self.pk is None
+        with transaction.atomic():
+            super(Dataset, self).save(*args, **kwargs)
+            self.update_search_vector()
+            # The events are queued in the outbox, and only delivered if the save commits. Last, so a save
+            # that fails leaves nothing in coalesce_dataset_events().
+            event_hooks.dataset_saved(self, created=created)
 
     def active_stewards(self):
         return [s.user for s in self.datasteward_set.all() if s.is_active()]
@@ -975,27 +1204,78 @@ class Dataset(LdapObject):
         from data_facility_admin import metadata_serializer
         return metadata_serializer.data_classification_to_metadata(self.data_classification)
 
-    @property
-    def search_metadata(self):
+    GENERATED_METADATA_FIELDS = ('generated_search_metadata', 'generated_detailed_metadata')
+
+    def _generate_metadata(self):
+        from data_facility_admin import metadata_serializer
         try:
-            from data_facility_admin import metadata_serializer
-            return metadata_serializer.dumps(self)
+            search_metadata = metadata_serializer.dumps(self)
         except Exception as ex:
             logger.error('Error generating metadata for dataset %s' % self)
             logger.exception(ex)
-            return None
+            search_metadata = None
+        detailed_metadata = None
+        if self.data_classification == Dataset.DATA_CLASSIFICATION_GREEN and self.detailed_gmeta:
+            detailed_metadata = self.detailed_gmeta.copy()
+            if search_metadata is not None:
+                detailed_metadata.update(search_metadata)
+        return search_metadata, detailed_metadata
+
+    def update_metadata(self):
+        ''' Regenerates the stored search and detailed metadata. Called on save. '''
+        self.generated_search_metadata, self.generated_detailed_metadata = self._generate_metadata()
+
+    def store_metadata(self):
+        ''' Regenerates the stored metadata and search vector, writing only them: no history nor events. '''
+        self.update_metadata()
+        Dataset.objects.filter(pk=self.pk).update(search_vector=self._search_vector(),
+                                                  **{field: getattr(self, field)
+                                                     for field in Dataset.GENERATED_METADATA_FIELDS})
+
+    SEARCH_CONFIG = 'english'
+
+    def _search_vector(self):
+        def text(*values):
+            return models.Value(' '.join('%s' % value for value in values if value), output_field=models.TextField())
+        keywords = (self.search_gmeta or {}).get('keywords') or []
+        if not isinstance(keywords, list):
+            keywords = [keywords]
+        data_provider = self.data_provider.name if self.data_provider_id else None
+        return (SearchVector(text(self.name, self.dataset_id), weight='A', config=Dataset.SEARCH_CONFIG) +
+                SearchVector(text(data_provider, *keywords), weight='B', config=Dataset.SEARCH_CONFIG) +
+                SearchVector(text(self.description), weight='C', config=Dataset.SEARCH_CONFIG))
+
+    def update_search_vector(self):
+        ''' Indexes the name, id, data provider, keywords and description for DatasetQuerySet.search. '''
+        Dataset.objects.filter(pk=self.pk).update(search_vector=self._search_vector())
+
+    def _metadata(self):
+        # Rows saved before the metadata was stored are generated on the fly until backfilled.
+        if self.generated_search_metadata is not None:
+            return self.generated_search_metadata, self.generated_detailed_metadata
+        return self._generate_metadata()
+
+    @property
+    def search_metadata(self):
+        return self._metadata()[0]
 
     def detailed_metadata(self):
-        if self.data_classification == Dataset.DATA_CLASSIFICATION_GREEN and self.detailed_gmeta:
-            logger.debug('Generating detailed metadata: %s' % len(self.detailed_gmeta))
-            metadata_to_return = self.detailed_gmeta.copy()
-            temp_search_metadata = self.search_metadata
-            if temp_search_metadata is not None:
-                logger.debug('Updating detailed metadata with search metadata: %s' % len(temp_search_metadata))
-                metadata_to_return.update(temp_search_metadata)
-            return metadata_to_return
-        else:
-            return None
+        return self._metadata()[1]
+
+
+@receiver(post_init, sender=Dataset)
+def snapshot_dataset_event_values(sender, instance, **kwargs):
+    instance._event_values = event_hooks.dataset_event_values(instance)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=DataProvider)
+def update_datasets_metadata(sender, instance, created=False, **kwargs):
+    ''' The metadata of the datasets has the name of their category and data provider. '''
+    if created:
+        return
+    for dataset in instance.dataset_set.select_related('category', 'data_provider'):
+        dataset.store_metadata()
 
 
 class DataSteward(models.Model):
@@ -0,0 +1,128 @@
+''' Transactional outbox of the SNS events.
+
+The events are queued as OutboxEvent rows in the transaction of the change that raised them, so saves never
+wait for SNS and no event is sent for a change that was rolled back. A worker (scripts/deliver_events.py)
+delivers them in batches with event_hooks.publish_many, retrying failures with an exponential backoff until
+SNS_HOOK['OUTBOX_MAX_ATTEMPTS'] attempts.
+
+An event is dropped only when it repeats the latest pending event of the same entity (payload['entity_id']),
+so the events of an entity keep their order: activated, deactivated, activated are all sent. While an event
+of an entity waits for a retry, the later events of that entity are held back behind it.
+'''
+import datetime
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from data_facility_admin import event_hooks
+from data_facility_admin.models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+
+def dedupe_key(topic, subject, payload):
+    return hashlib.sha1(json.dumps([topic, subject, payload], sort_keys=True)).hexdigest()
+
+
+def _entity(payload):
+    return payload.get('entity_id') if isinstance(payload, dict) else None
+
+
+def _pending():
+    return OutboxEvent.objects.filter(sent_at__isnull=True, next_attempt_at__isnull=False)
+
+
+def _unblocked(events):
+    ''' Returns the events without an earlier pending event of their entity outside of them: one waiting for a
+        retry or locked by another worker. '''
+    if not events:
+        return events
+    ids = [e.pk for e in events]
+    first_blocked = {}
+    for pk, payload in _pending().filter(id__lt=max(ids)).exclude(pk__in=ids).order_by('id') \
+            .values_list('id', 'payload'):
+        entity = _entity(payload)
+        if entity is not None:
+            first_blocked.setdefault(entity, pk)
+    return [e for e in events if e.pk < first_blocked.get(_entity(e.payload), e.pk + 1)]
+
+
+def enqueue(topic, subject, payload):
+    ''' Queues the event, unless it repeats the latest pending event of its entity. Returns the queued event
+        or None. '''
+    key = dedupe_key(topic, subject, payload)
+    entity = _entity(payload)
+    if entity is not None and \
+            _pending().filter(payload__entity_id=entity).order_by('-id').values_list('dedupe_key', flat=True) \
+            .first() == key:
+        logger.debug('Event already queued: %s - %s' % (topic, subject))
+        return None
+    return OutboxEvent.objects.create(topic=topic, subject=subject, payload=payload, dedupe_key=key)
+
+
+def retry_delay(attempts):
+    delay = settings.SNS_HOOK['OUTBOX_RETRY_DELAY'] * 2 ** (attempts - 1)
+    return datetime.timedelta(seconds=min(delay, settings.SNS_HOOK['OUTBOX_MAX_RETRY_DELAY']))
+
+
+def deliver(publish_many=None, batch_size=None, now=None):
+    '''
+    Delivers a batch of the events due, oldest first. Concurrent workers get different batches.
+
+    :param publish_many: function publishing a list of (topic, subject, payload) and returning the errors by
+        index, see event_hooks.publish_many (the default).
+    :return: (number of events sent, number of failed deliveries)
+    '''
+    publish_many = publish_many or event_hooks.publish_many
+    now = now or timezone.now()
+    batch_size = batch_size or settings.SNS_HOOK['OUTBOX_BATCH_SIZE']
+    with transaction.atomic():
+        events = _unblocked(list(_pending().select_for_update(skip_locked=True)
+                                 .filter(next_attempt_at__lte=now).order_by('id')[:batch_size]))
+        # An event repeating the previous one of its entity in the batch is sent once, with it.
+        to_send, repeated, last_by_entity = [], {}, {}
+        for event in events:
+            entity = _entity(event.payload)
+            last = last_by_entity.get(entity)
+            if last is not None and last.dedupe_key == event.dedupe_key:
+                repeated.setdefault(last.pk, []).append(event.pk)
+                continue
+            to_send.append(event)
+            if entity is not None:
+                last_by_entity[entity] = event
+        errors = publish_many([(event.topic, event.subject, event.payload) for event in to_send]) if to_send else {}
+
+        failed_ids, held_ids, failed_by_entity = set(), set(), {}
+        for index in sorted(errors):
+            event, error = to_send[index], errors[index]
+            event.attempts += 1
+            event.last_error = error
+            if event.attempts >= settings.SNS_HOOK['OUTBOX_MAX_ATTEMPTS']:
+                logger.error('Giving up SNS event %s after %s attempts: %s' % (event, event.attempts, error))
+                event.next_attempt_at = None
+            else:
+                logger.warning('Error sending SNS event %s: %s' % (event, error))
+                event.next_attempt_at = now + retry_delay(event.attempts)
+            event.save()
+            # The repeated events are retried with it.
+            failed_ids.add(event.pk)
+            failed_ids.update(repeated.get(event.pk, []))
+            OutboxEvent.objects.filter(pk__in=repeated.get(event.pk, [])) \
+                .update(attempts=event.attempts, last_error=error, next_attempt_at=event.next_attempt_at)
+            entity = _entity(event.payload)
+            if entity is not None:
+                failed_by_entity.setdefault(entity, event)
+        # The later events of an entity wait for its failed event, and are sent again after it.
+        for event in events:
+            failed = failed_by_entity.get(_entity(event.payload))
+            if failed is not None and event.pk > failed.pk and event.pk not in failed_ids:
+                held_ids.add(event.pk)
+                OutboxEvent.objects.filter(pk=event.pk).update(next_attempt_at=failed.next_attempt_at or now)
+        OutboxEvent.objects.filter(pk__in=[e.pk for e in events if e.pk not in failed_ids | held_ids]) \
+            .update(sent_at=now)
+    sent = [e for e in to_send if e.pk not in failed_ids | held_ids]
+    return len(sent), len(errors)
@@ -0,0 +1,78 @@
+''' Cached resolution of the DfRoles active for a user, for the API.
+
+The role names of a user are cached by username for settings.ROLE_CACHE_TIMEOUT seconds, or until the next
+role of the user starts or ends. Saving or deleting a UserDfRole, renaming a DfRole or changing the ldap_name
+of a User drops the cached entries of the users involved. The entries are kept in the default cache, shared by
+all the processes (see settings.CACHES), so the drops are seen at once. Changes that send no signal (queryset
+updates and raw SQL) are seen after ROLE_CACHE_TIMEOUT seconds at most.
+'''
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from data_facility_admin.models import User, DfRole, UserDfRole
+
+
+def _cache_key(username):
+    return 'dfadmin:roles:%s' % username
+
+
+def active_role_names(username):
+    ''' The names of the DfRoles active for the user now. '''
+    key = _cache_key(username)
+    role_names = cache.get(key)
+    if role_names is None:
+        now = timezone.now()
+        role_names = set()
+        next_change = None
+        for role_name, begin, end in UserDfRole.objects.filter(user__ldap_name=username) \
+                .values_list('role__name', 'begin', 'end'):
+            if begin <= now and (end is None or end > now):
+                role_names.add(role_name)
+            for when in (begin, end):
+                if when is not None and when > now and (next_change is None or when < next_change):
+                    next_change = when
+        role_names = frozenset(role_names)
+        timeout = settings.ROLE_CACHE_TIMEOUT
+        if next_change is not None:
+            timeout = min(timeout, int((next_change - now).total_seconds()))
+        cache.set(key, role_names, timeout)
+    return role_names
+
+
+def has_role(username, role_name):
+    return role_name in active_role_names(username)
+
+
+def invalidate(usernames):
+    cache.delete_many([_cache_key(username) for username in usernames])
+
+
+# Signals
+@receiver(post_save, sender=UserDfRole)
+@receiver(post_delete, sender=UserDfRole)
+def user_df_role_changed(sender, instance, **kwargs):
+    invalidate(User.objects.filter(pk=instance.user_id).values_list('ldap_name', flat=True))
+
+
+@receiver(post_save, sender=DfRole)
+def df_role_changed(sender, instance, created=False, **kwargs):
+    if not created:
+        invalidate(UserDfRole.objects.filter(role=instance).values_list('user__ldap_name', flat=True))
+
+
+@receiver(post_init, sender=User)
+def snapshot_user_ldap_name(sender, instance, **kwargs):
+    # Read from __dict__ so a deferred field is not loaded.
+    instance._roles_ldap_name = instance.__dict__.get('ldap_name')
+
+
+@receiver(post_save, sender=User)
+def user_changed(sender, instance, created=False, **kwargs):
+    old_ldap_name = getattr(instance, '_roles_ldap_name', None)
+    if not created and old_ldap_name != instance.ldap_name:
+        # The old name could be given to another user, and the new one may have been cached as unknown.
+        invalidate([name for name in (old_ldap_name, instance.ldap_name) if name])
+    instance._roles_ldap_name = instance.ldap_name
@@ -1,8 +1,11 @@
 ''' Serializers for the ldap sync import/export scripts
 '''
 import datetime
+import inspect
 from django.conf import settings
-from data_facility_admin.models import User
+from django.db.models import Manager
+from data_facility_admin.models import User, Project, DfRole
+from data_facility_admin.access import dataset_member_ldap_names
 import pytz
 
 """
@@ -15,55 +18,108 @@ When the key has a '%' sigh, it meand the Serializer will join the properties.
 
 When the key has a '|', it means the Serializer has an object in the left side of the key and a
 property in the right side of the key.
+
+Each key is compiled once into a plan: a function (obj, prefetched=None) -> value, where prefetched
+maps collection names (the left side of a '+') to already loaded collections. Serializers also
+accept whole map keys in prefetched, with the final values.
 """
-def _get_attr_value(obj, attr_name):
-    # TODO: Add docstring with description of language
-    is_collection = False
-    is_property = False
-    is_multiple = False
+_PLANS = {}
+
+
+def _format_value(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(pytz.utc)
+        return value.strftime("%Y%m%d%H%M%SZ")
+    return str(value)
+
+
+def _attribute_reader(name):
+    ''' Reads an attribute, calling it when it is a method. That is checked once per class. '''
+    is_method = {}
+
+    def read(obj):
+        value = getattr(obj, name)
+        if obj.__class__ not in is_method:
+            is_method[obj.__class__] = inspect.ismethod(value)
+        return value() if is_method[obj.__class__] else value
+    return read
+
+
+def _collection_reader(name):
+    ''' Reads a relation (related manager) or a method/property returning a collection. '''
+    read = _attribute_reader(name)
+
+    def read_collection(obj, prefetched):
+        if prefetched and name in prefetched:
+            return prefetched[name]
+        collection = read(obj)
+        if isinstance(collection, Manager):
+            return collection.all()
+        return collection
+    return read_collection
+
+
+def _compile(attr_name):
+    if attr_name in _PLANS:
+        return _PLANS[attr_name]
 
     if '+' in attr_name:
-        attr_name = attr_name.split('+')
-        is_collection = True
+        collection_name, item_attr = attr_name.split('+', 1)
+        read_collection = _collection_reader(collection_name)
+        item_plan = _compile(item_attr)
+
+        def plan(obj, prefetched=None):
+            return [item_plan(e) for e in read_collection(obj, prefetched)]
     elif '|' in attr_name:
-        attr_name = attr_name.split('|')
-        is_property = True
+        relation_name, relation_attr = attr_name.split('|', 1)
+        read_relation = _attribute_reader(relation_name)
+        relation_plan = _compile(relation_attr)
+
+        def plan(obj, prefetched=None):
+            return relation_plan(read_relation(obj))
     elif '%' in attr_name:
-        attr_name = attr_name.split('%')
-        is_multiple = True
+        part_plans = [_compile(part) for part in attr_name.split('%')]
 
-    if len(attr_name) > 1 and is_multiple:
-        return "%s %s" % (_get_attr_value(obj, attr_name[0]), _get_attr_value(obj, attr_name[1]))
-    elif len(attr_name) > 1 and is_collection:
-        try:
-            collection = getattr(obj, attr_name[0]).all()
-        except:
-            try:
-                collection = getattr(obj, attr_name[0])()
-            except:
-                return None
-        return [_get_attr_value(e, attr_name[1]) for e in collection]
-    elif len(attr_name) > 1 and is_property:
-        return _get_attr_value(getattr(obj, attr_name[0]), attr_name[1])
+        def plan(obj, prefetched=None):
+            return ' '.join('%s' % part_plan(obj) for part_plan in part_plans)
     else:
-        value = getattr(obj, attr_name)
+        read = _attribute_reader(attr_name)
 
-        if isinstance(value, datetime.datetime):
-            if value.tzinfo is not None:
-                value = value.astimezone(pytz.utc)
-            return value.strftime("%Y%m%d%H%M%SZ")
+        def plan(obj, prefetched=None):
+            return _format_value(read(obj))
+
+    _PLANS[attr_name] = plan
+    return plan
+
+
+def _compile_map(ldap_map, skip=()):
+    ''' Compiles a settings map into a list of (plan, ldap keys). '''
+    plans = []
+    for df_key, ldap_key in ldap_map.iteritems():
+        if df_key in skip:
+            continue
+        ldap_keys = ldap_key if hasattr(ldap_key, '__iter__') else [ldap_key]
+        plans.append((df_key, _compile(df_key), ldap_keys))
+    return plans
+
+
+def _run_plans(obj, plans, data, prefetched=None):
+    for df_key, plan, ldap_keys in plans:
+        if prefetched and df_key in prefetched:
+            # The whole value was computed beforehand.
+            value = prefetched[df_key]
         else:
-            final_value = None
-            try:
-                final_value = value()
-            except:
-                final_value = value
+            value = _list_if_not(plan(obj, prefetched))
+        for ldap_key in ldap_keys:
+            _add_if_not_empty(data, ldap_key, list(value))
+    return data
+
 
-            if final_value is None:
-                return None
-            else:
-                return str(final_value)
-            
+def _get_attr_value(obj, attr_name, prefetched=None):
+    return _compile(attr_name)(obj, prefetched)
 
 
 def _list_if_not(value):
@@ -79,6 +135,14 @@ def _add_if_not_empty(dict_, key_, value_):
         dict_[key_] = value_
 
 
+USER_PLANS = _compile_map(settings.USER_LDAP_MAP, skip=('ldap_last_auth_time', 'ldap_last_pwd_change'))
+PROJECT_PLANS = _compile_map(settings.PROJECT_LDAP_MAP)
+GROUP_PLANS = _compile_map(settings.GROUP_LDAP_MAP)
+USER_PRIVATE_GROUP_PLANS = _compile_map(settings.USER_PRIVATE_GROUP_LDAP_MAP)
+DATASET_PLANS = _compile_map(settings.DATASET_LDAP_MAP)
+DATASET_MEMBERS_KEY = 'active_members+ldap_full_dn'
+
+
 class UserLDAPSerializer(object):
     """
     LDAP Tuple example:
@@ -139,15 +203,11 @@ class UserLDAPSerializer(object):
                                   .format(user.username)],
             'nda': [settings.LDAP_SETTINGS['Users']['DefaultNDA']],
         }
-        for df_key, ldap_key in settings.USER_LDAP_MAP.iteritems():
-            if df_key == "ldap_last_auth_time" or df_key == "ldap_last_pwd_change":
-                continue
-            if hasattr(ldap_key, '__iter__'):
-                for key in ldap_key:
-                    _add_if_not_empty(data, key, _list_if_not(_get_attr_value(user, df_key)))
-            else:
-                _add_if_not_empty(data, ldap_key, _list_if_not(_get_attr_value(user, df_key)))
-        return user_dn, data
+        return user_dn, _run_plans(user, USER_PLANS, data)
+
+    @staticmethod
+    def dumps_many(users):
+        return [UserLDAPSerializer.dumps(user) for user in users]
 
 
 class ProjectLDAPSerializer(object):
@@ -174,16 +234,22 @@ class ProjectLDAPSerializer(object):
         pass
 
     @staticmethod
-    def dumps(project):
+    def dumps(project, prefetched=None):
         dn = str("cn=%s,%s,%s" % (project.ldap_name, settings.LDAP_PROJECT_SEARCH,
                                   settings.LDAP_BASE_DN))
 
         data = {
             'objectClass': settings.LDAP_SETTINGS['Projects']['ObjectClasses'],
         }
-        for df_key, ldap_key in settings.PROJECT_LDAP_MAP.iteritems():
-            _add_if_not_empty(data, ldap_key, _list_if_not(_get_attr_value(project, df_key)))
-        return dn, data
+        return dn, _run_plans(project, PROJECT_PLANS, data, prefetched)
+
+    @staticmethod
+    def dumps_many(projects):
+        """Same as dumps for a list of projects, loading all the active members at once."""
+        projects = list(projects)
+        active_members = Project.active_members_by_project(projects)
+        return [ProjectLDAPSerializer.dumps(project, {'active_members': active_members[project.id]})
+                for project in projects]
 
 
 class DfRoleLDAPSerializer(object):
@@ -207,14 +273,20 @@ class DfRoleLDAPSerializer(object):
         pass
 
     @staticmethod
-    def dumps(role):
+    def dumps(role, prefetched=None):
         dn = str("cn=%s,%s,%s" % (role.ldap_name, settings.LDAP_GROUP_SEARCH, settings.LDAP_BASE_DN))
         data = {
             'objectClass': settings.LDAP_SETTINGS['Groups']['ObjectClasses'],
         }
-        for df_key, ldap_key in settings.GROUP_LDAP_MAP.iteritems():
-            _add_if_not_empty(data, ldap_key, _list_if_not(_get_attr_value(role, df_key)))
-        return dn, data
+        return dn, _run_plans(role, GROUP_PLANS, data, prefetched)
+
+    @staticmethod
+    def dumps_many(roles):
+        """Same as dumps for a list of roles, loading all the active users at once."""
+        roles = list(roles)
+        active_users = DfRole.active_users_by_role([role.id for role in roles])
+        return [DfRoleLDAPSerializer.dumps(role, {'active_users': active_users[role.id]})
+                for role in roles]
 
 
 class UserPrivateGroupLDAPSerializer(object):
@@ -243,10 +315,11 @@ class UserPrivateGroupLDAPSerializer(object):
         data = {
             'objectClass': settings.LDAP_SETTINGS['UserPrivateGroups']['ObjectClasses'],
         }
-        for df_key, ldap_key in settings.USER_PRIVATE_GROUP_LDAP_MAP.iteritems():
-            _add_if_not_empty(data, ldap_key, _list_if_not(_get_attr_value(user, df_key)))
+        return dn, _run_plans(user, USER_PRIVATE_GROUP_PLANS, data)
 
-        return dn, data
+    @staticmethod
+    def dumps_many(users):
+        return [UserPrivateGroupLDAPSerializer.dumps(user) for user in users]
 
 
 class DatasetLDAPSerializer(object):
@@ -269,13 +342,26 @@ class DatasetLDAPSerializer(object):
         pass
 
     @staticmethod
-    def dumps(dataset):
+    def dumps(dataset, prefetched=None):
         dn = str("cn=%s,%s,%s" % (dataset.ldap_name, settings.LDAP_DATASET_SEARCH, settings.LDAP_BASE_DN))
 
         data = {
             'objectClass': settings.LDAP_SETTINGS['Datasets']['ObjectClasses'],
         }
-        for df_key, ldap_key in settings.DATASET_LDAP_MAP.iteritems():
-            _add_if_not_empty(data, ldap_key, _list_if_not(_get_attr_value(dataset, df_key)))
+        return dn, _run_plans(dataset, DATASET_PLANS, data, prefetched)
 
-        return dn, data
+    @staticmethod
+    def dumps_many(datasets):
+        """Same as dumps for a list of datasets, loading the members' ldap_names at once.
+        Datasets with the same member set (e.g. all public ones) share the member DNs."""
+        datasets = list(datasets)
+        member_ldap_names = dataset_member_ldap_names(datasets)
+        member_dns = {}
+        ldap_tuples = []
+        for dataset in datasets:
+            ldap_names = member_ldap_names[dataset.id]
+            if id(ldap_names) not in member_dns:
+                member_dns[id(ldap_names)] = [User.ldap_dn(ldap_name) for ldap_name in sorted(ldap_names)]
+            ldap_tuples.append(DatasetLDAPSerializer.dumps(
+                dataset, {DATASET_MEMBERS_KEY: member_dns[id(ldap_names)]}))
+        return ldap_tuples
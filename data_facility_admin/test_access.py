@@ -0,0 +1,78 @@
+''' Tests for the set-based access resolution '''
+from django.test import TestCase
+
+from data_facility_admin.access import AccessGraph, dataset_member_ldap_names, next_access_changes
+from data_facility_admin.models import *
+from data_facility_admin.factories import *
+from datetime import timedelta
+
+
+YESTERDAY = timezone.now() - timedelta(days=1)
+TOMORROW = timezone.now() + timedelta(days=1)
+
+
+class AccessGraphTests(TestCase):
+    ''' AccessGraph should match the per-object model methods.'''
+
+    def setUp(self):
+        self.project = ProjectFactory.create(status=Project.STATUS_ACTIVE)
+        self.member = UserFactory.create(status=User.STATUS_ACTIVE)
+        self.former_member = UserFactory.create(status=User.STATUS_ACTIVE)
+        role = ProjectRole.objects.create(name='access-test-reader', system_role=ProjectRole.SYSTEM_ROLE_READER)
+        ProjectMember.objects.create(project=self.project, member=self.member, role=role,
+                                     start_date=YESTERDAY, end_date=TOMORROW)
+        ProjectMember.objects.create(project=self.project, member=self.former_member, role=role,
+                                     start_date=YESTERDAY, end_date=YESTERDAY)
+        self.dataset = DatasetFactory.create(status=Dataset.STATUS_ACTIVE)
+        self.expired_access_dataset = DatasetFactory.create(status=Dataset.STATUS_ACTIVE)
+        DatasetAccess.objects.create(project=self.project, dataset=self.dataset, start_at=YESTERDAY)
+        DatasetAccess.objects.create(project=self.project, dataset=self.expired_access_dataset,
+                                     start_at=YESTERDAY, end_at=YESTERDAY)
+
+    def test_members_skip_ended_memberships(self):
+        graph = AccessGraph([self.project])
+        self.assertEqual({self.member}, graph.members(self.project))
+        self.assertEqual({self.member}, self.project.active_members())
+
+    def test_member_permissions_use_the_project_role(self):
+        graph = AccessGraph([self.project])
+        self.assertEqual([{'username': self.member.username, 'system_role': ProjectRole.SYSTEM_ROLE_READER}],
+                         graph.member_permissions(self.project))
+
+    def test_datasets_skip_ended_accesses(self):
+        graph = AccessGraph([self.project])
+        self.assertEqual([self.dataset], graph.datasets(self.project))
+        self.assertEqual([self.dataset.dataset_and_schema()], self.project.datasets_with_access())
+
+    def test_dataset_members_come_from_active_projects(self):
+        graph = AccessGraph.for_datasets([self.dataset, self.expired_access_dataset])
+        self.assertEqual({self.member}, graph.dataset_members(self.dataset))
+        self.assertEqual(set(), graph.dataset_members(self.expired_access_dataset))
+        self.assertEqual({self.member}, self.dataset.active_members())
+
+    def test_user_lookups(self):
+        graph = AccessGraph([self.project])
+        self.assertEqual([self.project], graph.user_projects(self.member))
+        self.assertEqual([self.dataset], graph.user_datasets(self.member))
+        self.assertEqual([], graph.user_projects(self.former_member))
+
+    def test_attached_graph_is_shared(self):
+        graph = AccessGraph.attach([self.project])
+        self.assertIs(graph, self.project.get_access_graph())
+
+    def test_dataset_member_ldap_names(self):
+        public = DatasetFactory.create(status=Dataset.STATUS_ACTIVE, public=True)
+        other_public = DatasetFactory.create(status=Dataset.STATUS_ACTIVE, public=True)
+
+        members = dataset_member_ldap_names([self.dataset, self.expired_access_dataset, public, other_public])
+
+        self.assertEqual({self.member.ldap_name}, members[self.dataset.id])
+        self.assertEqual(frozenset(), members[self.expired_access_dataset.id])
+        self.assertIn(self.former_member.ldap_name, members[public.id])
+        self.assertIs(members[public.id], members[other_public.id])
+        self.assertEqual(set(u.ldap_name for u in self.dataset.active_members()),
+                         self.dataset.active_member_ldap_names())
+
+    def test_next_access_changes(self):
+        # The active membership ends TOMORROW; nothing else ends or starts later.
+        self.assertEqual({self.project.id: TOMORROW}, next_access_changes([self.project]))
@@ -0,0 +1,68 @@
+''' Tests for the delta feed of permission changes '''
+from django.test import TestCase
+
+from data_facility_admin import changes
+from data_facility_admin.models import *
+from data_facility_admin.factories import *
+from datetime import timedelta
+
+
+class ChangesTests(TestCase):
+
+    def setUp(self):
+        self.project = ProjectFactory.create(status=Project.STATUS_ACTIVE)
+        self.member = UserFactory.create(status=User.STATUS_ACTIVE)
+        self.role = ProjectRole.objects.create(name='changes-test-reader', system_role=ProjectRole.SYSTEM_ROLE_READER)
+        self.start = timezone.now()
+
+    def membership_changes(self, cursor=changes.BEGINNING, now=None):
+        results, last, more = changes.changes_after(cursor, now=now)
+        return [c for c in results if c['type'] == 'project_member'], last
+
+    def test_new_membership(self):
+        ProjectMember.objects.create(project=self.project, member=self.member, role=self.role,
+                                     start_date=self.start - timedelta(days=1))
+        results, _ = self.membership_changes()
+        self.assertEqual(1, len(results))
+        self.assertEqual('created', results[0]['action'])
+        self.assertEqual(self.member.username, results[0]['username'])
+        self.assertEqual(ProjectRole.SYSTEM_ROLE_READER, results[0]['system_role'])
+        self.assertTrue(results[0]['active'])
+
+    def test_window_activation_after_cursor(self):
+        activation = self.start + timedelta(hours=1)
+        ProjectMember.objects.create(project=self.project, member=self.member, role=self.role,
+                                     start_date=activation)
+        results, cursor = self.membership_changes()
+        self.assertEqual(['created'], [c['action'] for c in results])
+        self.assertFalse(results[0]['active'])
+
+        # Nothing new until the membership starts.
+        self.assertEqual([], self.membership_changes(cursor)[0])
+        results, _ = self.membership_changes(cursor, now=activation + timedelta(minutes=1))
+        self.assertEqual(['activated'], [c['action'] for c in results])
+        self.assertTrue(results[0]['active'])
+
+    def test_pages_do_not_repeat_changes(self):
+        for i in range(3):
+            user = UserFactory.create(status=User.STATUS_ACTIVE)
+            ProjectMember.objects.create(project=self.project, member=user, role=self.role,
+                                         start_date=self.start - timedelta(days=1))
+        seen = []
+        cursor, more = changes.BEGINNING, True
+        while more:
+            results, cursor, more = changes.changes_after(cursor, limit=1)
+            seen += [c['cursor'] for c in results]
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(3, len([c for c in seen if changes.Cursor.decode(c).source ==
+                                 changes.SOURCES.index('project_member')]))
+
+    def test_deleted_project_is_named_from_its_history(self):
+        ProjectMember.objects.create(project=self.project, member=self.member, role=self.role,
+                                     start_date=self.start - timedelta(days=1))
+        name = self.project.ldap_name
+        self.project.delete()
+        results, _ = self.membership_changes()
+        self.assertEqual(['created', 'deleted'], [c['action'] for c in results])
+        self.assertEqual([name, name], [c['project'] for c in results])
+        self.assertEqual(self.member.username, results[1]['username'])
@@ -1,12 +1,11 @@
 from django.test import TestCase
 from data_facility_admin.models import *
-from data_facility_admin.helpers import LDAPHelper
+from data_facility_admin.helpers import LDAPHelper, INACTIVITY_PERIOD
 import mock
 from mockldap import MockLdap
 from django.conf import settings
 import ldap
 from django.utils import timezone
-import datetime
 
 
 class BaseLdapTestCase(TestCase):
@@ -180,7 +179,7 @@ class LdapTestCase(BaseLdapTestCase):
         ldap_helper = LDAPHelper()
         ldap_helper.export_users()
 
-        self.setUser(ldap_last_auth_time=timezone.now() - datetime.timedelta(60, 0, 0))
+        self.setUser(ldap_last_auth_time=timezone.now() - INACTIVITY_PERIOD)
         
         ldap_helper.export_users()
         
@@ -196,7 +195,7 @@ class LdapTestCase(BaseLdapTestCase):
         ldap_helper = LDAPHelper()
         ldap_helper.export_users()
 
-        self.setUser(created_at=timezone.now() - datetime.timedelta(60, 0, 0))
+        self.setUser(created_at=timezone.now() - INACTIVITY_PERIOD)
         
         ldap_helper.export_users()
         
@@ -204,3 +203,90 @@ class LdapTestCase(BaseLdapTestCase):
 
         self.assertIn(settings.USER_LDAP_MAP["ldap_lock_time"], self.ldapobj.directory[self.USER_FULL_DN])
         self.assertEqual(self.ldapobj.directory[self.USER_FULL_DN][settings.USER_LDAP_MAP["ldap_lock_time"]][0], "000001010000Z")
+
+    @mock.patch('data_facility_admin.helpers.KeycloakHelper')
+    def test_ldap_user_update_uses_a_single_modify(self, mock_keycloak):
+        self.setUser(status=User.STATUS_NEW)
+
+        ldap_helper = LDAPHelper()
+        ldap_helper.export_users()
+        modify_calls = len([x for x in self.ldapobj.methods_called() if x == 'modify_s'])
+
+        self.setUser(first_name="Rafael", last_name="Alves")
+        ldap_helper.export_users()
+
+        self.assertEqual(modify_calls + 1, len([x for x in self.ldapobj.methods_called() if x == 'modify_s']))
+        self.assertEqual(self.ldapobj.directory[self.USER_FULL_DN]["cn"][0], "Rafael Alves")
+
+    @mock.patch('data_facility_admin.helpers.KeycloakHelper')
+    def test_ldap_user_without_changes_is_not_modified(self, mock_keycloak):
+        self.setUser(status=User.STATUS_NEW)
+
+        ldap_helper = LDAPHelper()
+        ldap_helper.export_users()
+        ldap_helper.export_users()
+
+        self.assertNotIn('modify_s', self.ldapobj.methods_called())
+
+    def test_ldap_modlist_uses_value_deltas_for_multi_valued_attributes(self):
+        dn = 'cn=project-test,ou=Projects,' + settings.LDAP_BASE_DN
+        current = (dn, {'cn': ['project-test'], 'member': ['uid=a', 'uid=b', 'uid=c']})
+        new = (dn, {'cn': ['project-test'], 'member': ['uid=b', 'uid=c', 'uid=d']})
+
+        modlist = LDAPHelper.ldap_modlist(new, current)
+
+        self.assertEqual([(ldap.MOD_DELETE, 'member', ['uid=a']),
+                          (ldap.MOD_ADD, 'member', ['uid=d'])], modlist)
+
+    def test_ldap_modlist_is_empty_when_tuples_match(self):
+        dn = 'cn=project-test,ou=Projects,' + settings.LDAP_BASE_DN
+        current = (dn, {'cn': ['project-test'], 'member': ['uid=a']})
+
+        self.assertEqual([], LDAPHelper.ldap_modlist((dn, {'cn': ['project-test'], 'member': ['uid=a']}), current))
+
+    @mock.patch('data_facility_admin.helpers.KeycloakHelper')
+    def test_ldap_export_all_creates_new_user(self, mock_keycloak):
+        self.setUser(status=User.STATUS_NEW)
+
+        timings = LDAPHelper().export_all(pool_size=2)
+
+        self.assertTrue(self.USER_FULL_DN in self.ldapobj.directory, "The user should have been inserted")
+        self.assertTrue(self.USER_GROUP_FULL_DN in self.ldapobj.directory, "The user private group should have been inserted")
+        self.assertEqual(User.STATUS_ACTIVE, User.objects.get(ldap_id=self.USER_LDAP_ID).status)
+        self.assertEqual(['users_plan', 'users_apply', 'groups_plan', 'groups_apply'], list(timings.keys()))
+
+    @mock.patch('data_facility_admin.helpers.KeycloakHelper')
+    def test_ldap_export_incremental_first_run_is_full_and_sets_watermarks(self, mock_keycloak):
+        self.setUser(status=User.STATUS_NEW)
+
+        LDAPHelper().export_incremental()
+
+        self.assertTrue(self.USER_FULL_DN in self.ldapobj.directory, "The user should have been inserted")
+        system_info = SystemInfo.get()
+        self.assertIsNotNone(system_info.last_export)
+        self.assertEqual(system_info.last_export, system_info.last_full_export)
+
+    def test_changed_since_only_includes_updated_users(self):
+        self.setUser(status=User.STATUS_ACTIVE)
+        since = timezone.now()
+
+        self.assertFalse(LDAPHelper.changed_since(since, timezone.now())['users'].exists())
+        self.setUser(status=User.STATUS_ACTIVE, first_name="Johnny")
+        self.assertEqual([self.USER_LDAP_ID],
+                         [u.ldap_id for u in LDAPHelper.changed_since(since, timezone.now())['users']])
+
+    def test_paged_search_follows_the_page_cookie(self):
+        from ldap.controls import SimplePagedResultsControl
+        conn = mock.Mock()
+        conn.search_ext.side_effect = [1, 2]
+        conn.result3.side_effect = [
+            (ldap.RES_SEARCH_RESULT, [('uid=a', {})], 1,
+             [mock.Mock(controlType=SimplePagedResultsControl.controlType, cookie='next-page')]),
+            (ldap.RES_SEARCH_RESULT, [('uid=b', {}), (None, ['ldap://referral'])], 2,
+             [mock.Mock(controlType=SimplePagedResultsControl.controlType, cookie='')]),
+        ]
+
+        entries = list(LDAPHelper.paged_search(conn, settings.LDAP_BASE_DN, '(uid=*)', ['uid'], page_size=1))
+
+        self.assertEqual(['uid=a', 'uid=b'], [entry[0] for entry in entries])
+        self.assertEqual(2, conn.search_ext.call_count)
@@ -105,3 +105,40 @@ class LdapTestCase(BaseLdapTestCase):
 
 
 
+
+    @mock.patch('data_facility_admin.helpers.KeycloakHelper')
+    def test_ldap_import_timestamps_without_history(self, mock_keycloak):
+        self.setUser(status=User.STATUS_ACTIVE)
+        ldap_helper = LDAPHelper()
+        ldap_helper.export_users()
+        history_count = User.history.count()
+
+        auth_time = timezone.now().replace(microsecond=0)
+        self.ldapobj.directory[self.USER_FULL_DN][settings.USER_LDAP_MAP["ldap_last_auth_time"]] = \
+            [auth_time.astimezone(pytz.utc).strftime("%Y%m%d%H%M%SZ")]
+
+        ldap_helper.import_users()
+        ldap_helper.import_users()
+
+        user = User.objects.get(ldap_id=self.USER_LDAP_ID)
+        self.assertEqual(user.ldap_last_auth_time, auth_time)
+        self.assertEqual(user.status, User.STATUS_ACTIVE)
+        self.assertEqual(User.history.count(), history_count)
+
+    @mock.patch('data_facility_admin.helpers.KeycloakHelper')
+    def test_ldap_import_locked_user_with_history(self, mock_keycloak):
+        self.setUser(status=User.STATUS_ACTIVE)
+        ldap_helper = LDAPHelper()
+        ldap_helper.export_users()
+        history_count = User.history.count()
+
+        lock_time = timezone.now().replace(microsecond=0)
+        self.ldapobj.directory[self.USER_FULL_DN][settings.USER_LDAP_MAP["ldap_lock_time"]] = \
+            [lock_time.astimezone(pytz.utc).strftime("%Y%m%d%H%M%SZ")]
+
+        ldap_helper.import_users()
+
+        user = User.objects.get(ldap_id=self.USER_LDAP_ID)
+        self.assertEqual(user.status, User.STATUS_LOCKED_WRONG_PASSWD)
+        self.assertEqual(user.ldap_lock_time, lock_time)
+        self.assertEqual(User.history.count(), history_count + 1)
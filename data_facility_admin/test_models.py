@@ -90,6 +90,41 @@ class DatasetTests(TestCase):
                           expiration=TOMORROW)
         assert dataset.system_status() is Dataset.STATUS_DISABLED
 
+    def test_dataset_metadata_is_stored_on_save(self):
+        category = Category.objects.create(name='Health')
+        dataset = Dataset.objects.create(name='test', dataset_id='1', category=category,
+                                         data_classification=Dataset.DATA_CLASSIFICATION_GREEN,
+                                         search_gmeta={'keywords': ['a']}, detailed_gmeta={'notes': 'b'})
+        stored = Dataset.objects.get(pk=dataset.pk)
+        self.assertEqual('Health', stored.generated_search_metadata['category'])
+        self.assertEqual(['a'], stored.search_metadata['keywords'])
+        self.assertEqual('b', stored.detailed_metadata()['notes'])
+        self.assertEqual('test', stored.detailed_metadata()['title'])
+
+    def test_dataset_metadata_is_updated_with_the_category(self):
+        category = Category.objects.create(name='Health')
+        dataset = Dataset.objects.create(name='test', dataset_id='1', category=category)
+        category.name = 'Education'
+        category.save()
+        self.assertEqual('Education', Dataset.objects.get(pk=dataset.pk).search_metadata['category'])
+
+    def test_dataset_search_ranks_name_matches_first(self):
+        described = Dataset.objects.create(name='Wages', dataset_id='1', description='Census of the wages')
+        named = Dataset.objects.create(name='Census', dataset_id='2')
+        Dataset.objects.create(name='Unrelated', dataset_id='3')
+        self.assertEqual([named, described], list(Dataset.objects.search('census')))
+
+    def test_dataset_search_matches_keywords_and_data_provider(self):
+        provider = DataProvider.objects.create(name='Bureau of Statistics')
+        dataset = Dataset.objects.create(name='Wages', dataset_id='1', data_provider=provider,
+                                         search_gmeta={'keywords': ['geospatial']})
+        self.assertEqual([dataset], list(Dataset.objects.search('geospatial')))
+        self.assertEqual([dataset], list(Dataset.objects.search('bureau')))
+
+    def test_dataset_search_matches_similar_names(self):
+        dataset = Dataset.objects.create(name='Population census', dataset_id='1')
+        self.assertEqual([dataset], list(Dataset.objects.search('populaton census')))
+
 
 class DatasetAccessTests(TestCase):
     ''' DataAccess Logic tests.'''
@@ -114,6 +149,26 @@ class LdapObjectrTests(TestCase):
         lo.prepare_ldap_name()
         self.assertEqual('ab', lo.ldap_name)
 
+    def test_reserved_ldap_ids_are_not_handed_out_again(self):
+        reserved = LdapObject.reserve_ldap_ids(3)
+        p = Project.objects.create(name='after_reserve')
+        self.assertEqual(3, len(reserved))
+        self.assertEqual(reserved[-1] + 1, p.ldap_id)
+
+    def test_ldap_id_set_by_hand_is_skipped_by_the_sequence(self):
+        p1 = Project.objects.create(name='manual_id', ldap_id=LdapObject.reserve_ldap_ids(1)[0] + 10)
+        p2 = Project.objects.create(name='after_manual_id')
+        self.assertEqual(p1.ldap_id + 1, p2.ldap_id)
+
+    def test_missing_ldap_id_sequence_is_created_once(self):
+        p = Project.objects.create(name='before_flush')
+        LdapIdSequence.objects.all().delete()
+        first = LdapObject.reserve_ldap_ids(2)
+        second = LdapObject.reserve_ldap_ids(2)
+        self.assertEqual([p.ldap_id + 1, p.ldap_id + 2], list(first))
+        self.assertEqual([p.ldap_id + 3, p.ldap_id + 4], list(second))
+        self.assertEqual(1, LdapIdSequence.objects.count())
+
 
 class UserTests(TestCase):
     ''' User logic tests.'''
@@ -137,6 +192,15 @@ class UserTests(TestCase):
         # for u in User.objects.all(): print u.ldap_name
         self.assertEqual('atestuser3', u.ldap_name)
 
+    def test_username_collision_in_batch(self):
+        User.objects.create(ldap_name='btestuser', email='b@a.a')
+        users = [User(ldap_name='btestuser', email='b%s@a.a' % i) for i in range(3)]
+        User.prepare_ldap_names(users)
+        self.assertEqual(['btestuser1', 'btestuser2', 'btestuser3'], [u.ldap_name for u in users])
+        for u in users:
+            u.save()
+        self.assertEqual('btestuser3', User.objects.get(email='b2@a.a').ldap_name)
+
     def test_username_for_foreign_nationals(self):
         user = User.objects.create(first_name='John', last_name='Doe', foreign_national=True)
         expected_username = (user.first_name + user.last_name + '_fr').lower()
@@ -147,6 +211,31 @@ class UserTests(TestCase):
         expected_username = (user.first_name + user.last_name + '_ctr').lower()
         self.assertEqual(expected_username, user.ldap_name)
 
+    def test_django_user_created_and_linked(self):
+        user = User.objects.create(first_name='Jane', last_name='Roe', email='jane@a.a')
+        user.refresh_from_db()
+        self.assertEqual(user.ldap_name, user.django_user.username)
+        self.assertEqual('jane@a.a', user.django_user.email)
+
+    def test_django_user_not_saved_when_unchanged(self):
+        user = User.objects.create(first_name='Jane', last_name='Roe', email='jane@a.a')
+        user = User.objects.get(pk=user.pk)
+        user.ldap_last_auth_time = timezone.now()
+        with self.assertNumQueries(0):
+            save_django_user(User, user, created=False)
+        user.email = 'jane.roe@a.a'
+        user.save()
+        self.assertEqual('jane.roe@a.a', DjangoUser.objects.get(username=user.ldap_name).email)
+
+    def test_batch_django_user_sync(self):
+        with batch_django_user_sync():
+            users = [User.objects.create(first_name='Batch', last_name='User%s' % i, email='batch%s@a.a' % i)
+                     for i in range(3)]
+            self.assertFalse(DjangoUser.objects.filter(username__in=[u.ldap_name for u in users]).exists())
+        for user in users:
+            user.refresh_from_db()
+            self.assertEqual(user.email, user.django_user.email)
+
 
 def create_project_with_membership_permission_for_test(system_role):
     p = Project.objects.create(name='test_memberships')
@@ -234,6 +323,36 @@ class ProjectTests(TestCase):
         assert len(active_member_permissions) is 1
         self.assertEqual(active_member_permissions[0]['system_role'], ProjectRole.SYSTEM_ROLE_WRITER)
 
+    def test_active_members_by_project_matches_active_members(self):
+        p, user, role, pm = create_project_with_membership_permission_for_test(ProjectRole.SYSTEM_ROLE_READER)
+        instructor = User.objects.create(ldap_name='instructor_user', email='instructor_user@adrf.test',
+                                         status=User.STATUS_ACTIVE)
+        instructors = DfRole.objects.create(name='instructors-bulk-test')
+        UserDfRole.objects.create(role=instructors, user=instructor, begin=YESTERDAY)
+        p.instructors = instructors
+        p.save()
+        empty = Project.objects.create(name='test_no_memberships')
+
+        active_members = Project.active_members_by_project([p, empty])
+
+        self.assertEqual(p.active_members(), active_members[p.id])
+        self.assertEqual({user, instructor}, active_members[p.id])
+        self.assertEqual(set(), active_members[empty.id])
+
+    def test_active_users_by_role_skips_ended_roles(self):
+        role = DfRole.objects.create(name='bulk-role-test')
+        active = User.objects.create(ldap_name='active_user', email='active_user@adrf.test',
+                                     status=User.STATUS_ACTIVE)
+        ended = User.objects.create(ldap_name='ended_user', email='ended_user@adrf.test',
+                                    status=User.STATUS_ACTIVE)
+        UserDfRole.objects.create(role=role, user=active, begin=YESTERDAY)
+        UserDfRole.objects.create(role=role, user=ended, begin=YESTERDAY, end=YESTERDAY)
+
+        active_users = DfRole.active_users_by_role([role.id])
+
+        self.assertEqual([active], [udr.user for udr in active_users[role.id]])
+        self.assertEqual(list(role.active_users()), active_users[role.id])
+
 
 class ProjectMemberTests(TestCase):
     ''' ProjectMember Logic tests.'''
@@ -0,0 +1,233 @@
+''' Tests for the SNS events outbox '''
+import json
+import os
+import tempfile
+
+import boto3
+import mock
+from botocore.stub import Stubber
+from django.conf import settings
+from django.db import DatabaseError
+from django.test import TestCase
+from django.utils import timezone
+
+from data_facility_admin import event_hooks, outbox
+from data_facility_admin.models import Dataset, DatabaseSchema, OutboxEvent
+
+SNS_HOOK = settings.SNS_HOOK
+
+
+@mock.patch.dict(SNS_HOOK, ACTIVE=True)
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        self.published = []
+
+    def publish(self, events):
+        self.published += [topic for topic, subject, payload in events]
+        return {}
+
+    def fail(self, events):
+        return {index: 'SNS is down' for index in range(len(events))}
+
+    def queued_topics(self):
+        return list(OutboxEvent.objects.filter(sent_at__isnull=True).order_by('id').values_list('topic', flat=True))
+
+    def test_dataset_events_are_queued(self):
+        dataset = Dataset.objects.create(name='test', dataset_id='1', status=Dataset.STATUS_ACTIVE)
+        self.assertEqual([SNS_HOOK['TOPIC_DATASET_CREATED'], SNS_HOOK['TOPIC_DATASET_ACTIVATED']],
+                         self.queued_topics())
+
+        OutboxEvent.objects.all().delete()
+        dataset = Dataset.objects.get(pk=dataset.pk)
+        dataset.status = Dataset.STATUS_DISABLED
+        dataset.database_schema = DatabaseSchema.objects.create(name='schema')
+        dataset.save()
+        self.assertEqual([SNS_HOOK['TOPIC_DATASET_UPDATED'], SNS_HOOK['TOPIC_DATASET_DEACTIVATED'],
+                          SNS_HOOK['TOPIC_DATASET_DB_ACTIVATED']], self.queued_topics())
+
+    def test_identical_pending_events_are_queued_once(self):
+        dataset = Dataset.objects.create(name='test', dataset_id='1')
+        dataset.save()
+        dataset.save()
+        self.assertEqual([SNS_HOOK['TOPIC_DATASET_CREATED'], SNS_HOOK['TOPIC_DATASET_UPDATED']],
+                         self.queued_topics())
+
+    def test_repeated_events_keep_their_order(self):
+        dataset = Dataset.objects.create(name='test', dataset_id='1', status=Dataset.STATUS_ACTIVE)
+        for status in (Dataset.STATUS_DISABLED, Dataset.STATUS_ACTIVE):
+            dataset.status = status
+            dataset.save()
+        topics = [topic for topic in self.queued_topics() if topic != SNS_HOOK['TOPIC_DATASET_UPDATED']]
+        expected = [SNS_HOOK['TOPIC_DATASET_CREATED'], SNS_HOOK['TOPIC_DATASET_ACTIVATED'],
+                    SNS_HOOK['TOPIC_DATASET_DEACTIVATED'], SNS_HOOK['TOPIC_DATASET_ACTIVATED']]
+        self.assertEqual(expected, topics)
+
+        outbox.deliver(self.publish)
+        self.assertEqual(expected, [topic for topic in self.published if topic != SNS_HOOK['TOPIC_DATASET_UPDATED']])
+
+    def test_repeated_events_in_a_batch_are_sent_once(self):
+        payload = {'entity_id': '1'}
+        for topic in ('a', 'a', 'b', 'a'):
+            OutboxEvent.objects.create(topic=topic, subject='s', payload=payload,
+                                       dedupe_key=outbox.dedupe_key(topic, 's', payload))
+        self.assertEqual((3, 0), outbox.deliver(self.publish))
+        self.assertEqual(['a', 'b', 'a'], self.published)
+        self.assertEqual([], self.queued_topics())
+
+    def test_events_after_a_failed_event_of_the_entity_are_held_back(self):
+        for topic, entity in (('activated', '1'), ('other', '2'), ('deactivated', '1')):
+            payload = {'entity_id': entity}
+            OutboxEvent.objects.create(topic=topic, subject='s', payload=payload,
+                                       dedupe_key=outbox.dedupe_key(topic, 's', payload))
+        now = timezone.now()
+        fail_activated = lambda events: {index: 'SNS is down' for index, (topic, subject, payload)
+                                         in enumerate(events) if topic == 'activated'}
+        self.assertEqual((1, 1), outbox.deliver(fail_activated, now=now))
+        self.assertEqual(['activated', 'deactivated'], self.queued_topics())
+        retry_at = now + outbox.retry_delay(1)
+        self.assertEqual({retry_at}, set(OutboxEvent.objects.filter(sent_at__isnull=True)
+                                          .values_list('next_attempt_at', flat=True)))
+
+        self.assertEqual((2, 0), outbox.deliver(self.publish, now=retry_at))
+        self.assertEqual(['activated', 'deactivated'], self.published)
+
+    def test_events_wait_for_an_earlier_event_of_the_entity_to_be_retried(self):
+        now = timezone.now()
+        for topic, next_attempt_at in (('activated', now + outbox.retry_delay(1)), ('deactivated', now)):
+            payload = {'entity_id': '1'}
+            OutboxEvent.objects.create(topic=topic, subject='s', payload=payload, next_attempt_at=next_attempt_at,
+                                       dedupe_key=outbox.dedupe_key(topic, 's', payload))
+        self.assertEqual((0, 0), outbox.deliver(self.publish, now=now))
+        self.assertEqual((2, 0), outbox.deliver(self.publish, now=now + outbox.retry_delay(1)))
+        self.assertEqual(['activated', 'deactivated'], self.published)
+
+    def test_deliver(self):
+        Dataset.objects.create(name='test', dataset_id='1')
+        self.assertEqual((1, 0), outbox.deliver(self.publish))
+        self.assertEqual([SNS_HOOK['TOPIC_DATASET_CREATED']], self.published)
+        self.assertEqual([], self.queued_topics())
+        self.assertEqual((0, 0), outbox.deliver(self.publish))
+
+    def test_failed_delivery_is_retried_later(self):
+        Dataset.objects.create(name='test', dataset_id='1')
+        now = timezone.now()
+        self.assertEqual((0, 1), outbox.deliver(self.fail, now=now))
+        event = OutboxEvent.objects.get()
+        self.assertEqual(1, event.attempts)
+        self.assertEqual(now + outbox.retry_delay(1), event.next_attempt_at)
+
+        self.assertEqual((0, 0), outbox.deliver(self.publish, now=now))
+        self.assertEqual((1, 0), outbox.deliver(self.publish, now=event.next_attempt_at))
+
+    def test_coalesced_dataset_events(self):
+        schema = DatabaseSchema.objects.create(name='schema')
+        with event_hooks.coalesce_dataset_events():
+            dataset = Dataset.objects.create(name='test', dataset_id='1')
+            self.assertEqual([], self.queued_topics())
+            dataset.status = Dataset.STATUS_ACTIVE
+            dataset.save()
+            dataset.database_schema = schema
+            dataset.save()
+        self.assertEqual([SNS_HOOK['TOPIC_DATASET_CREATED'], SNS_HOOK['TOPIC_DATASET_ACTIVATED'],
+                          SNS_HOOK['TOPIC_DATASET_DB_ACTIVATED']], self.queued_topics())
+
+    def test_coalesced_events_are_not_queued_when_the_block_fails(self):
+        with self.assertRaises(ValueError):
+            with event_hooks.coalesce_dataset_events():
+                Dataset.objects.create(name='test', dataset_id='1')
+                raise ValueError()
+        self.assertEqual([], self.queued_topics())
+
+    def test_coalesced_events_skip_failed_saves(self):
+        with event_hooks.coalesce_dataset_events():
+            with mock.patch.object(Dataset, 'update_search_vector', side_effect=DatabaseError()):
+                with self.assertRaises(DatabaseError):
+                    Dataset.objects.create(name='failed', dataset_id='1')
+            Dataset.objects.create(name='test', dataset_id='2')
+        self.assertEqual(['2'], [event.payload['entity_id'] for event in OutboxEvent.objects.all()])
+
+    def test_summary_of_dataset_events(self):
+        with event_hooks.coalesce_dataset_events(summary=True):
+            Dataset.objects.create(name='test 1', dataset_id='1')
+            Dataset.objects.create(name='test 2', dataset_id='2', status=Dataset.STATUS_ACTIVE)
+        event = OutboxEvent.objects.get()
+        self.assertEqual(SNS_HOOK['TOPIC_DATASET_BATCH'], event.topic)
+        self.assertEqual({SNS_HOOK['TOPIC_DATASET_CREATED']: [{'entity_id': '1'}, {'entity_id': '2'}],
+                          SNS_HOOK['TOPIC_DATASET_ACTIVATED']: [{'entity_id': '2'}]}, event.payload['events'])
+
+    def test_delivery_is_given_up_after_max_attempts(self):
+        Dataset.objects.create(name='test', dataset_id='1')
+        OutboxEvent.objects.update(attempts=SNS_HOOK['OUTBOX_MAX_ATTEMPTS'] - 1)
+        self.assertEqual((0, 1), outbox.deliver(self.fail))
+        self.assertIsNone(OutboxEvent.objects.get().next_attempt_at)
+
+
+class FakeSnsClient(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.batches.append((TopicArn.split(':')[-1], [entry['Subject'] for entry in PublishBatchRequestEntries]))
+        failed = [entry for entry in PublishBatchRequestEntries if entry['Subject'] == 'fail']
+        return {'Failed': [{'Id': entry['Id'], 'Code': 'InternalError', 'Message': 'failed'} for entry in failed]}
+
+
+class TransportTests(TestCase):
+
+    def test_events_are_published_in_batches_by_topic(self):
+        sns = FakeSnsClient()
+        events = [('a', str(i), {}) for i in range(12)] + [('b', 'fail', {}), ('a', '12', {})]
+        with mock.patch.object(event_hooks, '_sns_client', sns):
+            errors = event_hooks.SnsTransport().publish_many(events)
+        self.assertEqual([('a', [str(i) for i in range(10)]), ('a', ['10', '11', '12']), ('b', ['fail'])],
+                         sns.batches)
+        self.assertEqual([12], list(errors))
+
+    def stubbed_client(self):
+        return boto3.client('sns', region_name='us-east-1', aws_access_key_id='test', aws_secret_access_key='test')
+
+    def test_events_are_published_one_by_one_without_publish_batch(self):
+        client = self.stubbed_client()
+        events = [('a', 'created', {'entity_id': '1'}), ('b', 'fail', {'entity_id': '2'})]
+        with Stubber(client) as stubber:
+            stubber.add_response('publish', {'MessageId': '1'},
+                                 {'TargetArn': '%s:a' % SNS_HOOK['BASE_ARN'], 'Subject': 'created',
+                                  'Message': event_hooks._message({'entity_id': '1'}), 'MessageStructure': 'json'})
+            stubber.add_client_error('publish', 'InternalError')
+            with mock.patch.object(event_hooks, '_sns_client', client), \
+                    mock.patch.object(event_hooks, '_supports_publish_batch', return_value=False):
+                errors = event_hooks.SnsTransport().publish_many(events)
+            stubber.assert_no_pending_responses()
+        self.assertEqual([1], list(errors))
+
+    def test_events_are_published_with_publish_batch_when_supported(self):
+        client = self.stubbed_client()
+        if not event_hooks._supports_publish_batch(client):
+            self.skipTest('The installed botocore has no SNS PublishBatch.')
+        with Stubber(client) as stubber:
+            stubber.add_response('publish_batch', {'Successful': [{'Id': '0', 'MessageId': '1'}], 'Failed': []})
+            with mock.patch.object(event_hooks, '_sns_client', client):
+                errors = event_hooks.SnsTransport().publish_many([('a', 'created', {'entity_id': '1'})])
+            stubber.assert_no_pending_responses()
+        self.assertEqual({}, errors)
+
+    def test_file_transport(self):
+        path = tempfile.mktemp()
+        try:
+            event_hooks.FileTransport(path).publish_many([('a', 'subject', {'entity_id': '1'})])
+            event_hooks.FileTransport(path).publish_many([('b', 'subject', {})])
+            with open(path) as f:
+                self.assertEqual(['a', 'b'], [json.loads(line)['topic'] for line in f])
+        finally:
+            os.remove(path)
+
+    @mock.patch.dict(SNS_HOOK, TRANSPORT='memory')
+    def test_memory_transport(self):
+        event_hooks.reset_transport()
+        try:
+            self.assertEqual({}, event_hooks.publish_many([('a', 'subject', {})]))
+            self.assertEqual([('a', 'subject', {})], event_hooks.transport().events)
+        finally:
+            event_hooks.reset_transport()
@@ -0,0 +1,45 @@
+''' Tests for the cached role resolution '''
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from data_facility_admin import roles
+from data_facility_admin.models import *
+from data_facility_admin.factories import *
+from datetime import timedelta
+
+
+@override_settings(ROLE_CACHE_TIMEOUT=60)
+class RolesTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = UserFactory.create(status=User.STATUS_ACTIVE)
+        self.role = DfRole.objects.create(name='roles-test-curators')
+
+    def test_cached_until_user_df_role_changes(self):
+        self.assertFalse(roles.has_role(self.user.username, self.role.name))
+        with self.assertNumQueries(0):
+            self.assertFalse(roles.has_role(self.user.username, self.role.name))
+
+        user_df_role = UserDfRole.objects.create(user=self.user, role=self.role,
+                                                 begin=timezone.now() - timedelta(days=1))
+        self.assertTrue(roles.has_role(self.user.username, self.role.name))
+
+        user_df_role.end = timezone.now() - timedelta(minutes=1)
+        user_df_role.save()
+        self.assertFalse(roles.has_role(self.user.username, self.role.name))
+
+    def test_ended_and_future_roles_are_not_active(self):
+        UserDfRole.objects.create(user=self.user, role=self.role, begin=timezone.now() + timedelta(days=1))
+        self.assertEqual(frozenset(), roles.active_role_names(self.user.username))
+
+    def test_cached_entry_dropped_when_ldap_name_changes(self):
+        UserDfRole.objects.create(user=self.user, role=self.role, begin=timezone.now() - timedelta(days=1))
+        old_username = self.user.username
+        self.assertTrue(roles.has_role(old_username, self.role.name))
+
+        user = User.objects.get(pk=self.user.pk)
+        user.ldap_name = 'roles-test-renamed'
+        user.save()
+        self.assertFalse(roles.has_role(old_username, self.role.name))
+        self.assertTrue(roles.has_role('roles-test-renamed', self.role.name))
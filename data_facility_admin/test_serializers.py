@@ -1,7 +1,7 @@
 ''' tests for the serializers '''
 # from django.test import TestCase
 from unittest import TestCase, main
-from .serializers import _get_attr_value, UserLDAPSerializer
+from .serializers import _get_attr_value, _compile, UserLDAPSerializer
 from .models import User
 from django.conf import settings
 
@@ -79,6 +79,20 @@ class LdapSerializersTests(TestCase):
     def test_user_ldap_serializer_dump_dn(self):
         self.assertEqual('uid=%s,ou=People,%s' % (self.user_dc.ldap_name, settings.LDAP_BASE_DN), self.ldap_user[0])
 
+    def test_user_ldap_serializer_dumps_many_matches_dumps(self):
+        self.assertEqual([self.ldap_user], UserLDAPSerializer.dumps_many([self.user_dc]))
+
+    def test_attr_plans_are_compiled_once(self):
+        self.assertIs(_compile('first_name%last_name'), _compile('first_name%last_name'))
+
+    def test_attr_value_calls_methods(self):
+        self.assertEqual(self.user_dc.full_name(), _get_attr_value(self.user_dc, 'full_name'))
+
+    def test_attr_value_uses_prefetched_collections(self):
+        self.assertEqual([self.user_dc.ldap_full_dn()],
+                         _get_attr_value(None, 'active_members+ldap_full_dn',
+                                         {'active_members': [self.user_dc]}))
+
 
 if __name__ == '__main__':
     main()
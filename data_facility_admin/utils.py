@@ -6,3 +6,23 @@ def show_urls(urllist, depth=0):
         if hasattr(entry, 'url_patterns'):
             urls += (show_urls(entry.url_patterns, depth + 1))
     return urls
+
+
+def bulk_update(objects, fields, batch_size=500):
+    '''
+    Writes the given fields of the objects with a single UPDATE per batch, as Django 1.11 has no
+    QuerySet.bulk_update. Like QuerySet.update, it does not call save() nor send signals.
+    '''
+    from django.db.models import Case, Value, When
+    objects = list(objects)
+    if not objects:
+        return
+    model = objects[0].__class__
+    for start in range(0, len(objects), batch_size):
+        batch = objects[start:start + batch_size]
+        values = {}
+        for field_name in fields:
+            field = model._meta.get_field(field_name)
+            values[field_name] = Case(*[When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field))
+                                        for obj in batch], output_field=field)
+        model.objects.filter(pk__in=[obj.pk for obj in batch]).update(**values)
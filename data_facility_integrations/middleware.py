@@ -0,0 +1,26 @@
+from django.conf import settings
+
+
+class RdsAccessBatchMiddleware(object):
+    """
+    Sends the RDS grants and revokes of a request in one batch after the view, so saving a project with many
+    memberships in the admin does not make one blocking API call per member.
+    """
+
+    def process_request(self, request):
+        if settings.RDS_INTEGRATION:
+            from data_facility_integrations import rds_client
+            request._rds_access_batch = rds_client.start_access_batch()
+
+    def process_exception(self, request, exception):
+        self._end_batch(request, send=False)
+
+    def process_response(self, request, response):
+        self._end_batch(request)
+        return response
+
+    def _end_batch(self, request, send=True):
+        if getattr(request, '_rds_access_batch', False):
+            from data_facility_integrations import rds_client
+            request._rds_access_batch = False
+            rds_client.end_access_batch(send=send)
@@ -1,6 +1,12 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 from decouple import config
 import logging
+import random
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
@@ -19,6 +25,16 @@ RDS_API = config('RDS_API')
 DATABASE_ENDPOINT = RDS_API + '/database'
 DATABASE_PERMISSION_ENDPOINT = RDS_API + '/database_permission'
 API_KEY = config('RDS_API_KEY')
+# Endpoint granting or revoking many permissions in one call, with a JSON body {"permissions": [params, ...]}.
+# When empty, batched changes are sent one by one over the pooled session.
+DATABASE_PERMISSION_BATCH_ENDPOINT = config('RDS_API_BATCH_PERMISSION_ENDPOINT', default='')
+CONNECT_TIMEOUT = config('RDS_API_CONNECT_TIMEOUT', cast=float, default=5)
+READ_TIMEOUT = config('RDS_API_READ_TIMEOUT', cast=float, default=30)
+MAX_ATTEMPTS = config('RDS_API_MAX_ATTEMPTS', cast=int, default=3)
+RETRY_DELAY = config('RDS_API_RETRY_DELAY', cast=float, default=1)
+MAX_RETRY_DELAY = config('RDS_API_MAX_RETRY_DELAY', cast=float, default=10)
+POOL_SIZE = config('RDS_API_POOL_SIZE', cast=int, default=10)
+TIMED_OUT_MESSAGE = 'Endpoint request timed out'
 
 
 ACTION_CREATE = 'create'
@@ -41,7 +57,62 @@ def init_system_info(project_tool):
         project_tool.save()
 
 
-def call_api(action, api_endpoint, params):
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    """ The requests.Session shared by all the API calls, keeping a pool of connections to the RDS API. """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                new_session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+                new_session.mount('http://', adapter)
+                new_session.mount('https://', adapter)
+                _session = new_session
+    return _session
+
+
+def _timed_out(response):
+    if response.status_code == 504:
+        return True
+    try:
+        return response.json().get('message') == TIMED_OUT_MESSAGE
+    except (ValueError, AttributeError):
+        return False
+
+
+def retry_delay(attempt):
+    """ Full jitter exponential backoff, so concurrent callers do not retry at the same time. """
+    return random.uniform(0, min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (attempt - 1)))
+
+
+def _request(method, url, **kwargs):
+    """
+    Sends the request over the shared session, retrying connection errors, timeouts and
+    "Endpoint request timed out" responses up to MAX_ATTEMPTS times.
+    :return: the last response. Raises the last exception when no response was received.
+    """
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    attempt = 1
+    while True:
+        try:
+            response = session().request(method, url, **kwargs)
+            if not _timed_out(response) or attempt >= MAX_ATTEMPTS:
+                return response
+            logger.warning('{0} {1} timed out (attempt {2} of {3}).'.format(method, url, attempt, MAX_ATTEMPTS))
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt >= MAX_ATTEMPTS:
+                raise
+            logger.warning('{0} {1} failed (attempt {2} of {3}).'.format(method, url, attempt, MAX_ATTEMPTS),
+                           exc_info=True)
+        time.sleep(retry_delay(attempt))
+        attempt += 1
+
+
+def call_api(action, api_endpoint, params, json=None):
     if not settings.RDS_INTEGRATION:
         logger.info('Not calling API as settings.RDS_INTEGRATION is %s' % settings.RDS_INTEGRATION)
         return None
@@ -49,25 +120,25 @@ def call_api(action, api_endpoint, params):
     try:
         logger.debug("params = %s" % params)
         logger.info('Calling API {0} {1} with params: {2}'.format(action, api_endpoint, params))
-        if action is ACTION_CREATE:
-            response = requests.post(api_endpoint, params)
-        elif action is ACTION_DELETE:
-            response = requests.delete(api_endpoint, params)
+        if action == ACTION_CREATE:
+            method = 'POST'
+        elif action == ACTION_DELETE:
+            method = 'DELETE'
         else:
             raise Exception('Unrecognized ACTION: %s. It must be one of %s' % (action, ACTIONS))
+        response = _request(method, api_endpoint, data=params, json=json)
 
         logger.debug("response: %s" % response)
         if response.status_code == 200:
             logger.info('Database %s with success.' % action)
-            return response.body
+            return response.json()
 
         elif response.status_code == 403:
-            logger.error('%s Database failed. Token is invalid. '
-                         'Status code: {0}, message: {1}'.format(action, response.status_code, response.text))
+            logger.error('{0} Database failed. Token is invalid. '
+                         'Status code: {1}, message: {2}'.format(action, response.status_code, response.text))
 
-        elif response.content and 'message' in response.content \
-                and response.content['message'] == 'Endpoint request timed out':
-            error_message = '%s Database failed. Error %s.' % (action, response.content['message'])
+        elif _timed_out(response):
+            error_message = '%s Database failed. Error %s.' % (action, TIMED_OUT_MESSAGE)
             logger.error(error_message)
             raise Exception(error_message)
 
@@ -129,30 +200,91 @@ def delete_database(project_tool):
         project_tool.system_info['rds_status'] = STATUS_DELETED
 
 
+_access_batch = threading.local()
+
+
+def start_access_batch():
+    """ Starts collecting the grants and revokes. Returns False when a batch is already started. """
+    if getattr(_access_batch, 'pending', None) is not None:
+        return False
+    _access_batch.pending = OrderedDict()
+    return True
+
+
+def end_access_batch(send=True):
+    """ Ends the batch, sending its changes unless send is False. """
+    changes = list((getattr(_access_batch, 'pending', None) or {}).values())
+    _access_batch.pending = None
+    if send:
+        change_permissions(changes)
+
+
+@contextmanager
+def batch_access_changes():
+    """
+    Collects the grants and revokes made inside the block and sends them at the end, keeping only the last
+    change of each project membership. The outermost block sends them.
+    """
+    if not start_access_batch():
+        yield
+        return
+    try:
+        yield
+    except BaseException:
+        end_access_batch(send=False)
+        raise
+    end_access_batch()
+
+
+def _change_permission(action, project_membership):
+    params = {'project': project_membership.project.ldap_name, 'user': project_membership.member.ldap_name}
+    pending = getattr(_access_batch, 'pending', None)
+    if pending is not None:
+        key = (params['project'], params['user'])
+        # The last change wins.
+        pending.pop(key, None)
+        pending[key] = (action, params)
+        return None
+    return call_api(action, DATABASE_PERMISSION_ENDPOINT, params)
+
+
+def change_permissions(changes):
+    """
+    Sends the (action, params) permission changes: one call per action to the batch endpoint when it is
+    configured, otherwise one call per change.
+    """
+    if not changes:
+        return
+    if not DATABASE_PERMISSION_BATCH_ENDPOINT:
+        for action, params in changes:
+            call_api(action, DATABASE_PERMISSION_ENDPOINT, params)
+        return
+    for action in (ACTION_DELETE, ACTION_CREATE):
+        permissions = [params for change_action, params in changes if change_action == action]
+        if permissions:
+            call_api(action, DATABASE_PERMISSION_BATCH_ENDPOINT, None, json={'permissions': permissions})
+
+
 def grant_access(project_membership):
     """
     Grant access to database based on project name and username.
+    Inside batch_access_changes() the grant is sent at the end of the block.
     Expected API call response:
         { ... }
     :param project_membership:
     :return:
     """
-    project_name = project_membership.project.ldap_name
-    username = project_membership.member.ldap_name
-    params = {'project': project_name, 'user': username}
-    response = call_api(ACTION_CREATE, DATABASE_PERMISSION_ENDPOINT, params)
+    return _change_permission(ACTION_CREATE, project_membership)
 
 
 def revoke_access(project_membership):
     """
-        Grant access to database based on project name and username.
+        Revoke access to database based on project name and username.
+        Inside batch_access_changes() the revoke is sent at the end of the block.
         Expected API call response:
             { ... }
 
         :param project_membership:
         :return:
         """
-    project_name = project_membership.project.ldap_name
-    username = project_membership.member.ldap_name
-    params = {'project': project_name, 'user': username}
-    response = call_api(ACTION_DELETE, DATABASE_PERMISSION_ENDPOINT, params)
\ No newline at end of file
+    return _change_permission(ACTION_DELETE, project_membership)
@@ -2,7 +2,8 @@
 from __future__ import unicode_literals
 from .rds_hooks import *
 import rds_client
-from django.test import TestCase
+import mock
+from django.test import TestCase, override_settings
 from data_facility_admin.factories import ProjectFactory
 from django.test import tag
 import requests
@@ -25,4 +26,59 @@ class TestRDSClient(TestCase):
         self.assertTrue(self.test_project_tool.system_info, 'System info is still None or empty.')
 
     # def test_rds_client_create_database(self):
-    #     response = rds_client.create_database(self.test_project_tool)
\ No newline at end of file
+    #     response = rds_client.create_database(self.test_project_tool)
+
+
+def response(status_code, data=None):
+    return mock.Mock(status_code=status_code, text='', json=mock.Mock(return_value=data or {}))
+
+
+def membership(project, user):
+    return mock.Mock(project=mock.Mock(ldap_name=project), member=mock.Mock(ldap_name=user))
+
+
+@override_settings(RDS_INTEGRATION=True)
+@mock.patch('time.sleep')
+class TestRDSApiCalls(TestCase):
+
+    def test_timed_out_requests_are_retried(self, sleep):
+        timed_out = response(504, {'message': rds_client.TIMED_OUT_MESSAGE})
+        with mock.patch.object(rds_client, 'session') as session:
+            session.return_value.request.side_effect = [timed_out, response(200, {'project': 'p'})]
+            self.assertEqual({'project': 'p'}, rds_client.call_api(rds_client.ACTION_CREATE,
+                                                                   rds_client.DATABASE_ENDPOINT, {'project': 'p'}))
+        self.assertEqual(2, session.return_value.request.call_count)
+        self.assertEqual(1, sleep.call_count)
+        method, url = session.return_value.request.call_args[0]
+        self.assertEqual('POST', method)
+        self.assertIn('timeout', session.return_value.request.call_args[1])
+
+    def test_connection_errors_give_up_after_max_attempts(self, sleep):
+        with mock.patch.object(rds_client, 'session') as session:
+            session.return_value.request.side_effect = requests.ConnectionError()
+            self.assertIsNone(rds_client.call_api(rds_client.ACTION_DELETE,
+                                                  rds_client.DATABASE_ENDPOINT, {'project': 'p'}))
+        self.assertEqual(rds_client.MAX_ATTEMPTS, session.return_value.request.call_count)
+
+    @mock.patch.object(rds_client, 'DATABASE_PERMISSION_BATCH_ENDPOINT', 'batch')
+    def test_batched_access_changes(self, sleep):
+        with mock.patch.object(rds_client, 'session') as session:
+            session.return_value.request.return_value = response(200)
+            with rds_client.batch_access_changes():
+                rds_client.grant_access(membership('p', 'u1'))
+                rds_client.grant_access(membership('p', 'u2'))
+                rds_client.revoke_access(membership('p', 'u3'))
+                rds_client.revoke_access(membership('p', 'u2'))
+                self.assertEqual(0, session.return_value.request.call_count)
+        calls = [(c[0][0], c[1]['json']) for c in session.return_value.request.call_args_list]
+        self.assertEqual([('DELETE', {'permissions': [{'project': 'p', 'user': 'u3'},
+                                                      {'project': 'p', 'user': 'u2'}]}),
+                          ('POST', {'permissions': [{'project': 'p', 'user': 'u1'}]})], calls)
+
+    def test_batched_access_changes_without_batch_endpoint(self, sleep):
+        with mock.patch.object(rds_client, 'session') as session:
+            session.return_value.request.return_value = response(200)
+            with rds_client.batch_access_changes():
+                rds_client.grant_access(membership('p', 'u1'))
+                rds_client.grant_access(membership('p', 'u1'))
+        self.assertEqual(1, session.return_value.request.call_count)
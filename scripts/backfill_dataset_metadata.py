@@ -0,0 +1,32 @@
+"""
+Stores the generated search and detailed metadata and the search vector of the datasets saved before they
+were stored on save:
+
+    python manage.py runscript backfill_dataset_metadata
+
+Pass --script-args all to regenerate it for every dataset, and chunk=<datasets per transaction> (default 500).
+The datasets are updated without saving them, so no history or SNS events are created.
+"""
+from django.db import transaction
+from django.db.models import Q
+
+from data_facility_admin.models import Dataset
+
+DEFAULT_CHUNK_SIZE = 500
+
+
+def run(*args):
+    options = dict(arg.split('=', 1) for arg in args if '=' in arg)
+    chunk_size = int(options.get('chunk', DEFAULT_CHUNK_SIZE))
+    datasets = Dataset.objects.all()
+    if 'all' not in args:
+        datasets = datasets.filter(Q(generated_search_metadata__isnull=True) | Q(search_vector__isnull=True))
+    ids = list(datasets.order_by('id').values_list('id', flat=True))
+    print('Datasets to update: %s' % len(ids))
+
+    for start in range(0, len(ids), chunk_size):
+        with transaction.atomic():
+            for dataset in Dataset.objects.filter(id__in=ids[start:start + chunk_size]) \
+                    .select_related('category', 'data_provider'):
+                dataset.store_metadata()
+        print('Updated %s of %s' % (min(start + chunk_size, len(ids)), len(ids)))
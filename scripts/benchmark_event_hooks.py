@@ -0,0 +1,85 @@
+"""
+Measures what the dataset event hooks cost, without network: the events go to the memory transport.
+
+    python manage.py runscript benchmark_event_hooks --script-args count=1000
+
+Creates, updates and activates count datasets with the hooks off and on, and reports the latency the hooks
+add to each save. Then delivers the queued events and reports the events per second. Everything runs in a
+transaction that is rolled back at the end.
+"""
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from data_facility_admin import event_hooks, outbox
+from data_facility_admin.models import Dataset, OutboxEvent
+
+DEFAULT_COUNT = 1000
+
+
+def timed(function, items):
+    ''' Calls the function for each item and returns the mean duration in milliseconds. '''
+    started = time.time()
+    for item in items:
+        function(item)
+    return (time.time() - started) * 1000.0 / max(len(items), 1)
+
+
+def create(dataset):
+    dataset.save()
+
+
+def update(dataset):
+    dataset.description = 'Updated by the benchmark'
+    dataset.save()
+
+
+def activate(dataset):
+    dataset.status = Dataset.STATUS_ACTIVE
+    dataset.save()
+
+
+PHASES = (('create', create), ('update', update), ('activate', activate))
+
+
+def run_phases(prefix, count):
+    datasets = [Dataset(name='Benchmark %s %s' % (prefix, i), dataset_id='benchmark-%s-%s' % (prefix, i))
+                for i in range(count)]
+    return [timed(phase, datasets) for name, phase in PHASES]
+
+
+def run(*args):
+    options = dict(arg.split('=', 1) for arg in args if '=' in arg)
+    count = int(options.get('count', DEFAULT_COUNT))
+    hook_settings = dict(settings.SNS_HOOK)
+    try:
+        settings.SNS_HOOK.update(TRANSPORT='memory')
+        event_hooks.reset_transport()
+        with transaction.atomic():
+            settings.SNS_HOOK['ACTIVE'] = False
+            without_hooks = run_phases('off', count)
+            settings.SNS_HOOK['ACTIVE'] = True
+            with_hooks = run_phases('on', count)
+
+            queued = OutboxEvent.objects.filter(sent_at__isnull=True).count()
+            started = time.time()
+            delivered = 0
+            while True:
+                sent, failed = outbox.deliver()
+                if not sent and not failed:
+                    break
+                delivered += sent
+            delivery_time = time.time() - started
+            transaction.set_rollback(True)
+    finally:
+        settings.SNS_HOOK.clear()
+        settings.SNS_HOOK.update(hook_settings)
+        event_hooks.reset_transport()
+
+    print('Datasets: %s' % count)
+    print('%-10s %14s %14s %14s' % ('phase', 'ms/save off', 'ms/save on', 'hooks ms/save'))
+    for (name, phase), off, on in zip(PHASES, without_hooks, with_hooks):
+        print('%-10s %14.3f %14.3f %14.3f' % (name, off, on, on - off))
+    print('Events queued: %s, delivered: %s in %.3fs (%.1f events/s)' %
+          (queued, delivered, delivery_time, delivered / delivery_time if delivery_time else 0))
@@ -10,6 +10,7 @@ from django.utils.dateparse import parse_datetime
 from django.utils.timezone import is_aware, make_aware
 from django.conf import settings
 from data_facility_admin.models import Project, User, ProjectMember, ProjectRole, DfRole, UserDfRole, ProfileTag
+from data_facility_admin.models import LdapObject, batch_django_user_sync
 
 SEPARATOR=','
 NO_USERNAME = '?'
@@ -188,47 +189,61 @@ def create_users(filename, class_file=False, errors=[]):
 
     teams = {}
     with open(filename) as f:
-        for line in f:
-            values = line.strip().split(SEPARATOR)
+        lines = f.readlines()
 
-            # Ignore header if it is in first line.
-            if 'first_name' in values:
-                continue
+    new_users = []
+    new_emails = set()
+    for line in lines:
+        values = line.strip().split(SEPARATOR)
 
+        # Ignore header if it is in first line.
+        if 'first_name' in values:
+            continue
+
+        #Read from file
+        if class_file:
+            first_name, last_name, email, team = values
+        else:
+            first_name, last_name, email = values
+            team = None
+
+        if email in new_emails or len(User.objects.filter(email=email)) > 0:
+                print('  Already exists. Skipping: {0}'.format(line))
+                # raise Exception('Skipping {0}. Already exists.'.format(line))
+        else:
+            user = User(first_name=first_name,
+                        last_name=last_name,
+                        email=email,
+                        status=USER_STATUS)
+            user.ldap_name = user.default_ldap_name()
+            new_users.append((values, user, team))
+            new_emails.add(email)
+
+    # Reserve the ldap_ids of the new users at once.
+    for (values, user, team), ldap_id in zip(new_users, LdapObject.reserve_ldap_ids(len(new_users))):
+        user.ldap_id = ldap_id
+
+    # Class accounts often have similar names, so the usernames are generated all at once.
+    User.prepare_ldap_names([user for values, user, team in new_users])
+
+    # The DjangoUsers are created in one pass at the end.
+    with batch_django_user_sync():
+        for values, user, team in new_users:
             print('Creating user: %s' % str(values))
-            #Read from file
-            if class_file:
-                first_name, last_name, email, team = values
-            else:
-                first_name, last_name, email = values
-                team = None
-
-            # if username == NO_USERNAME:
-            username = None
             try:
-                if len(User.objects.filter(email=email)) > 0:
-                        print('  Already exists. Skipping: {0}'.format(line))
-                        # raise Exception('Skipping {0}. Already exists.'.format(line))
-                else:
-                    user = User(first_name=first_name,
-                                last_name=last_name,
-                                email=email,
-                                status=USER_STATUS,
-                                ldap_name=username)
-                    user.save()
-
-                    print('add_tags')
-                    add_tags(user)
-
-                    if team:
-                        teams.get(team, []).append(user)
-
-                    print('grant_roles')
-                    grant_roles(user)
-                    print('grant_projects')
-                    grant_projects(user, team, class_file)
-                    print('    > Success')
+                user.save()
+
+                print('add_tags')
+                add_tags(user)
+
+                if team:
+                    teams.get(team, []).append(user)
 
+                print('grant_roles')
+                grant_roles(user)
+                print('grant_projects')
+                grant_projects(user, team, class_file)
+                print('    > Success')
 
             except Exception as ex:
                 # raise ex
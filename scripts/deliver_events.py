@@ -0,0 +1,27 @@
+"""
+Delivers the SNS events queued in the outbox (see data_facility_admin.outbox). Runs until stopped, waiting
+SNS_HOOK['OUTBOX_POLL_INTERVAL'] seconds when there is nothing to deliver:
+
+    python manage.py runscript deliver_events
+
+Pass --script-args once to deliver the events due and exit.
+"""
+import time
+
+from django.conf import settings
+
+from data_facility_admin import outbox
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def run(*args):
+    while True:
+        sent, failed = outbox.deliver()
+        if sent or failed:
+            logger.info('SNS events sent: %s, failed: %s' % (sent, failed))
+        elif 'once' in args:
+            return
+        else:
+            time.sleep(settings.SNS_HOOK['OUTBOX_POLL_INTERVAL'])
@@ -1,15 +1,31 @@
 #!/usr/bin/env python
 # From DjangoSnippets: https://djangosnippets.org/snippets/893/
+"""
+Imports users, groups (DfRoles), projects and datasets from LDAP.
+
+The entries are streamed from LDAP and processed in chunks, each one in a transaction. After each chunk
+the progress is saved to a checkpoint file, so an interrupted import can be resumed:
+
+    python manage.py runscript import_from_ldap --script-args resume
+
+Other arguments: checkpoint=<path> (default: ldap_import.checkpoint.json) and chunk=<entries per chunk>.
+"""
+import json
 import os
 
 import ldap
 import datetime
 import pytz
+from itertools import islice
+from django.db import transaction
 from django.utils import timezone
 from django.db.utils import IntegrityError
 
 from django.conf import settings
+from data_facility_admin import event_hooks
+from data_facility_admin.helpers import LDAPHelper
 from data_facility_admin.models import Project, User, ProjectMember, ProjectRole, DfRole, UserDfRole, DatasetAccess, Dataset, MISSING_INFO_FLAG
+from data_facility_admin.models import batch_django_user_sync
 
 USER_ATTRIBUTES = {
     "username": "uid",
@@ -46,13 +62,107 @@ DEFAULT_DF_ROLE = 'Other/Missing'
 TIME_NOW = timezone.now()
 DEBUG = False
 
-ERRORS = {}
+DEFAULT_CHECKPOINT = 'ldap_import.checkpoint.json'
+DEFAULT_CHUNK_SIZE = 200
+# Users first: groups, projects and datasets reference them.
+PHASES = ('users', 'groups', 'projects', 'datasets')
+
+
+class ImportCheckpoint(object):
+    """
+    Progress of an import: the finished phases, the DNs already imported in the current phase and the
+    error counts of the committed chunks. The DNs are appended to '<path>.dns' after each chunk, so saving
+    is O(chunk) and does not depend on the order of the LDAP results; the rest is saved to the JSON file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dns_path = path + '.dns'
+        self.done_phases = []
+        self.phase = None
+        self.done_dns = set()
+        self.errors = {}
+        # Errors of the chunk being imported, merged into errors when it commits.
+        self.chunk_errors = None
+
+    @classmethod
+    def load(cls, path):
+        checkpoint = cls(path)
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            checkpoint.done_phases = state['done_phases']
+            checkpoint.phase = state['phase']
+            checkpoint.errors = state['errors']
+        if checkpoint.phase is not None and os.path.exists(checkpoint.dns_path):
+            with open(checkpoint.dns_path) as f:
+                content = f.read()
+            # A last line without its newline was interrupted while written: it is dropped, and its chunk
+            # imported again.
+            complete = content[:content.rfind('\n') + 1]
+            if complete != content:
+                with open(checkpoint.dns_path, 'w') as f:
+                    f.write(complete)
+            checkpoint.done_dns = set(complete.splitlines())
+        return checkpoint
+
+    def save(self):
+        state = {
+            'done_phases': self.done_phases,
+            'phase': self.phase,
+            'errors': self.errors,
+        }
+        # Write and rename, so an interruption never leaves a truncated checkpoint.
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, self.path)
+
+    def start_chunk(self):
+        self.chunk_errors = {}
+
+    def commit_chunk(self, dns):
+        """ Records a committed chunk: its DNs are done and its errors are counted. """
+        with open(self.dns_path, 'a') as f:
+            f.writelines(dn + '\n' for dn in dns)
+        self.done_dns.update(dns)
+        for key, count in self.chunk_errors.items():
+            self.errors[key] = self.errors.get(key, 0) + count
+        self.chunk_errors = None
+        self.save()
+
+    def start_phase(self, phase):
+        if self.phase != phase:
+            self.phase = phase
+            self.done_dns = set()
+            self._remove_dns()
+
+    def finish_phase(self, phase):
+        self.done_phases.append(phase)
+        self.phase = None
+        self.done_dns = set()
+        self._remove_dns()
+        self.save()
+
+    def _remove_dns(self):
+        if os.path.exists(self.dns_path):
+            os.remove(self.dns_path)
+
+    def remove(self):
+        self._remove_dns()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+CHECKPOINT = ImportCheckpoint(DEFAULT_CHECKPOINT)
 
 
 def add_error(key, message=None):
-    if key not in ERRORS:
-        ERRORS[key] = 0
-    ERRORS[key] += 1
+    # Inside a chunk, counted only if the chunk commits, so rolled back and resumed chunks count once.
+    errors = CHECKPOINT.errors if CHECKPOINT.chunk_errors is None else CHECKPOINT.chunk_errors
+    if key not in errors:
+        errors[key] = 0
+    errors[key] += 1
     if message is None: message = key
     print '\033[31m   [Error] %s: %s \033[0m' % (key, message)
 
@@ -67,10 +177,37 @@ def get_from_ldap(search_base=None, search_filter=None, values=None):
         search = search_base + ',' + settings.LDAP_BASE_DN
     if search_filter is None:
         search_filter = '*'
-    result_id = l.search(search, AUTH_LDAP_SCOPE, search_filter, values)
-    result_type, result_data = l.result(result_id, 1)
-    l.unbind()
-    return result_data
+    try:
+        for entry in LDAPHelper.paged_search(l, search, search_filter, values):
+            yield entry
+    finally:
+        l.unbind()
+
+
+def chunks(entries, size):
+    entries = iter(entries)
+    while True:
+        chunk = list(islice(entries, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_in_chunks(phase, entries, import_chunk, chunk_size):
+    """
+    Imports the entries not imported yet in this phase, one transaction per chunk, saving the checkpoint
+    after each one. An error rolls back the current chunk only.
+    """
+    CHECKPOINT.start_phase(phase)
+    if CHECKPOINT.done_dns:
+        print('  Resuming: %s entries already imported.' % len(CHECKPOINT.done_dns))
+    pending = (entry for entry in entries if entry[0] not in CHECKPOINT.done_dns)
+    for chunk in chunks(pending, chunk_size):
+        CHECKPOINT.start_chunk()
+        with transaction.atomic():
+            import_chunk(chunk)
+        CHECKPOINT.commit_chunk([entry[0] for entry in chunk])
+    CHECKPOINT.finish_phase(phase)
 
 
 def get_members(ldap_members):
@@ -117,357 +254,367 @@ def get_ldap_datasets():
     return get_from_ldap(settings.LDAP_DATASET_SEARCH, search_filter, values)
 
 
-def import_groups():
-    ldap_groups = get_ldap_groups()
+def get_user_ids():
+    ''' username -> User id, loaded once per phase. '''
+    return dict(User.objects.values_list('ldap_name', 'id'))
+
 
+def get_project_ids():
+    ''' cn -> Project id, loaded once per phase. '''
+    return dict(Project.objects.values_list('ldap_name', 'id'))
+
+
+def import_groups(chunk_size=DEFAULT_CHUNK_SIZE):
     try:
-        default_role = DfRole.objects.get(name=DEFAULT_DF_ROLE)
+        DfRole.objects.get(name=DEFAULT_DF_ROLE)
     except DfRole.DoesNotExist:
         raise Exception('Default Role does not exists. Please create it before running the import script.')
 
-    for group in ldap_groups:
-        if DEBUG: print('ldap_group=', group)
-        # get project name and ldap_group
+    user_ids = get_user_ids()
+    # User private groups have the gidNumber of their user.
+    user_ldap_ids = set(str(ldap_id) for ldap_id in User.objects.values_list('ldap_id', flat=True))
 
-        try:
-            group_cn = group[1]['cn'][0].encode('ascii', 'ignore')
-            ldap_id = group[1]['gidNumber'][0].encode('ascii', 'ignore')
-            name = group[1][GROUP_ATTRIBUTES['name']][0].encode('ascii', 'ignore')
+    def import_chunk(ldap_groups):
+        groups = []
+        for group in ldap_groups:
+            if DEBUG: print('ldap_group=', group)
+            try:
+                group_cn = group[1]['cn'][0].encode('ascii', 'ignore')
+                ldap_id = group[1]['gidNumber'][0].encode('ascii', 'ignore')
+                name = group[1][GROUP_ATTRIBUTES['name']][0].encode('ascii', 'ignore')
+            except (KeyError, IndexError):
+                add_error('Group without name', group)
+                continue
             if name == 'None': continue # TODO: Remove this line.
             # ignore project groups
             if name.startswith('project-') or name.startswith('yproject-'): continue
-        except:
-            add_error('Group without name', group)
-            pass
+            if ldap_id in user_ldap_ids: continue
+            groups.append((group, group_cn, ldap_id, name))
 
-        try:
-            # Check if this group is a user group.
-            User.objects.get(ldap_id=ldap_id)
-            continue
-        except User.DoesNotExist:
-            pass
-
-        print ' Processing group: %s' % name
-        try:
-            description = group[1][PROJECT_ATTRIBUTES['description']][0].encode('ascii', 'ignore')
-        except:
-            add_error('Group without description', group_cn)
-            description = None
-
-        # retrieve or create
-        try:
-            df_role = DfRole.objects.get(ldap_name=group_cn)
-        except DfRole.DoesNotExist:
-            df_role = DfRole(ldap_name=group_cn, ldap_id=ldap_id)
-
-        df_role.description = description
-        df_role.name = name.replace('-', ' ').title()
-        df_role.ldap_id = ldap_id
-
-        df_role.save()
+        df_roles = dict((role.ldap_name, role) for role in
+                        DfRole.objects.filter(ldap_name__in=[group_cn for _, group_cn, _, _ in groups]))
+        for group, group_cn, ldap_id, name in groups:
+            print ' Processing group: %s' % name
+            try:
+                description = group[1][PROJECT_ATTRIBUTES['description']][0].encode('ascii', 'ignore')
+            except (KeyError, IndexError):
+                add_error('Group without description', group_cn)
+                description = None
+
+            df_role = df_roles.get(group_cn) or DfRole(ldap_name=group_cn, ldap_id=ldap_id)
+            df_role.description = description
+            df_role.name = name.replace('-', ' ').title()
+            df_role.ldap_id = ldap_id
+            df_role.save()
+            df_roles[group_cn] = df_role
 
         # Get members of groups
-        if GROUP_ATTRIBUTES['members'] in group[1]:
-            current_members = group[1][GROUP_ATTRIBUTES['members']]
+        user_roles = {}
+        for user_role in UserDfRole.objects.filter(role__in=[role.id for role in df_roles.values()]):
+            user_roles.setdefault(user_role.role_id, {})[user_role.user_id] = user_role
+        for group, group_cn, ldap_id, name in groups:
+            if GROUP_ATTRIBUTES['members'] not in group[1]:
+                add_error('Group has no members', name)
+                continue
+            df_role = df_roles[group_cn]
+            previous_members = user_roles.get(df_role.id, {})
+            current_members = set()
+            print '  Adding/Updating current members of %s:' % name
+            for username in get_members(group[1][GROUP_ATTRIBUTES['members']]):
+                print '   > Member:', username
+                if username not in user_ids:
+                    add_error('Group member does not exists', username)
+                    continue
+                current_members.add(user_ids[username])
+                if user_ids[username] not in previous_members:
+                    UserDfRole(role=df_role, user_id=user_ids[username], begin=TIME_NOW).save()
 
             print '  Disabling old members:'
-            for previous_member in df_role.userdfrole_set.all():
-                if previous_member.active() and previous_member.user.username not in current_members:
+            for user_id, previous_member in previous_members.items():
+                if previous_member.active() and user_id not in current_members:
                     previous_member.end = TIME_NOW
                     previous_member.save()
                     print '   > Member disabled:', previous_member.user
 
-            print '  Adding/Updating current members:'
-            for username in get_members(current_members):
-                print '   > Member:', username
-                try:
-                    user = User.objects.get(ldap_name=username)
-                except User.DoesNotExist:
-                    add_error('Group member does not exists', username)
-                    continue
-
-                try:
-                    user_role = UserDfRole.objects.get(role=df_role, user=user)
-                except UserDfRole.DoesNotExist:
-                    user_role = UserDfRole(role=df_role, user=user)
-                    user_role.begin = TIME_NOW
-                user_role.save()
-        else:
-            add_error('Group has no members', name)
-
+    import_in_chunks('groups', get_ldap_groups(), import_chunk, chunk_size)
 
-def import_projects():
-    ldap_projects = get_ldap_projects()
 
+def import_projects(chunk_size=DEFAULT_CHUNK_SIZE):
     try:
         default_role = ProjectRole.objects.get(name=DEFAULT_PROJECT_ROLE)
     except ProjectRole.DoesNotExist:
         raise Exception('Default Project Role does not exists. Please create it before running the import script.')
 
-    for ldap_project in ldap_projects:
-        if DEBUG: print('ldap_project=', ldap_project)
-        # get project name and ldap_group
-        try:
-            project_name = ldap_project[1][PROJECT_ATTRIBUTES['name']][0].encode('ascii', 'ignore')
-            print('\n Processing project: %s' % project_name)
-            ldap_group = ldap_project[1]['cn'][0].encode('ascii', 'ignore')
-            ldap_id = ldap_project[1]['gidNumber'][0].encode('ascii', 'ignore')
-        except:
-            add_error('Project without name', ldap_project)
-            pass
-
-        # retrieve or create project
-        try:
-            project = Project.objects.get(ldap_name=ldap_group)
-        except Project.DoesNotExist:
+    user_ids = get_user_ids()
+    usernames = dict((user_id, username) for username, user_id in user_ids.items())
+    instructors = DfRole.objects.get(ldap_name='instructors')
+
+    def import_chunk(ldap_projects):
+        entries = []
+        for ldap_project in ldap_projects:
+            if DEBUG: print('ldap_project=', ldap_project)
+            # get project name and ldap_group
             try:
-                description = ldap_project[1][PROJECT_ATTRIBUTES['description']][0].encode('ascii', 'ignore')
-            except:
-                add_error('Project without description', project_name)
-                description = "Not Provided"
-            if DEBUG: print('project_description=', description)
-            project = Project(ldap_name=ldap_group, ldap_id=ldap_id, abstract=description)
-            project.ldap_id = ldap_id
-
-        project.name = project_name
-        if project.ldap_name.startswith('yproject'):
-            project.environment = Project.ENV_YELLOW
-        elif project.ldap_name.startswith('project'):
-            project.environment = Project.ENV_GREEN
-        project.status = Project.STATUS_ACTIVE
-        project.instructors = DfRole.objects.get(ldap_name='instructors')
-
-        project.save()
-
-        previous_members = project.projectmember_set.all()
-        # print('previous_members=', previous_members)
-        # print('ldap_project=', ldap_project)
-
-        current_members = []
-        if PROJECT_ATTRIBUTES['members'] in ldap_project[1]:
-            for ldap_member in get_members(ldap_project[1][PROJECT_ATTRIBUTES['members']]):
-                if DEBUG: print('ldap_member=', ldap_member)
-                # # FreeIPA
-                # if USER_ATTRIBUTES['username'] + '=' in ldap_member:
-                #     member_uid = ldap_member.split(USER_ATTRIBUTES['username'] + '=')[1].split(',')[0]
-                # # ADRF - Open LDAP
-                # else:
-                #     member_uid = ldap_member
+                project_name = ldap_project[1][PROJECT_ATTRIBUTES['name']][0].encode('ascii', 'ignore')
+                ldap_group = ldap_project[1]['cn'][0].encode('ascii', 'ignore')
+                ldap_id = ldap_project[1]['gidNumber'][0].encode('ascii', 'ignore')
+            except (KeyError, IndexError):
+                add_error('Project without name', ldap_project)
+                continue
+            entries.append((ldap_project, project_name, ldap_group, ldap_id))
+
+        projects = dict((project.ldap_name, project) for project in
+                        Project.objects.filter(ldap_name__in=[ldap_group for _, _, ldap_group, _ in entries]))
+        for ldap_project, project_name, ldap_group, ldap_id in entries:
+            print('\n Processing project: %s' % project_name)
+            # retrieve or create project
+            project = projects.get(ldap_group)
+            if project is None:
                 try:
-                    user = User.objects.get(ldap_name=ldap_member)
-                except User.DoesNotExist:
-                    add_error('ProjectMemberhsip - User.DoesNotExist', ldap_member)
-                    pass
-                else:
-                    try:
-                        project_member = ProjectMember.objects.get(member=user, project=project)
-                    except ProjectMember.DoesNotExist:
-                        project_member = ProjectMember(member=user, project=project)
-                        project_member.role = default_role
-                        project_member.start_date = TIME_NOW
-                    finally:
-                        if project_member.id is None or not project_member.active():
-                            print '   > Member added/enabled: %s' % user
-                        project_member.save()
-                        current_members.append(ldap_member)
-        else:
-            add_error('Project has no members', project_name)
-            print '   This project has no members.'
-
-        print('   Members=%s' % len(current_members))
-        for disabled_member in [pm for pm in previous_members if pm.member.username not in current_members]:
-            if disabled_member.active():
-                disabled_member.end_date = TIME_NOW
-                disabled_member.save()
-                print('   > Member disabled: %s' % disabled_member.member)
-
-
-def import_datasets():
-    for ldap_dataset in get_ldap_datasets():
-        if DEBUG: print('ldap_dataset=', ldap_dataset)
-
-        try:
-            dataset_cn = ldap_dataset[1]['cn'][0].encode('ascii', 'ignore')
-            ldap_id = ldap_dataset[1]['gidNumber'][0].encode('ascii', 'ignore')
-            name = ldap_dataset[1][DATASET_ATTRIBUTES['ldap_name']][0].encode('ascii', 'ignore')
-        except:
-            add_error('Dataset without name', ldap_dataset)
-            pass
-
-        print '\n Processing Dataset: %s' % name
-        try:
-            description = ldap_dataset[1][DATASET_ATTRIBUTES['description']][0].encode('ascii', 'ignore')
-        except:
-            add_error('Dataset without description', dataset_cn)
-            description = None
-
-        # retrieve or create
-        try:
-            dataset = Dataset.objects.get(ldap_name=dataset_cn)
-        except Dataset.DoesNotExist:
-            dataset = Dataset(ldap_name=dataset_cn, ldap_id=ldap_id)
-        dataset.description = description
-        # doi <- name without 'dataset-'
-        dataset.dataset_id = name.split(',')[0][8:]
-        dataset.name = name.replace('-', ' ').title()
-        dataset.ldap_id = ldap_id
-        dataset.data_classification = Dataset.DATA_CLASSIFICATION_YELLOW
-        dataset.save()
+                    description = ldap_project[1][PROJECT_ATTRIBUTES['description']][0].encode('ascii', 'ignore')
+                except (KeyError, IndexError):
+                    add_error('Project without description', project_name)
+                    description = "Not Provided"
+                if DEBUG: print('project_description=', description)
+                project = Project(ldap_name=ldap_group, ldap_id=ldap_id, abstract=description)
+
+            project.name = project_name
+            if project.ldap_name.startswith('yproject'):
+                project.environment = Project.ENV_YELLOW
+            elif project.ldap_name.startswith('project'):
+                project.environment = Project.ENV_GREEN
+            project.status = Project.STATUS_ACTIVE
+            project.instructors = instructors
+            project.save()
+            projects[ldap_group] = project
+
+        project_members = {}
+        for project_member in ProjectMember.objects.filter(project__in=[p.id for p in projects.values()]):
+            project_members.setdefault(project_member.project_id, {})[project_member.member_id] = project_member
+        for ldap_project, project_name, ldap_group, ldap_id in entries:
+            project = projects[ldap_group]
+            previous_members = project_members.get(project.id, {})
+            current_members = set()
+            if PROJECT_ATTRIBUTES['members'] in ldap_project[1]:
+                for ldap_member in get_members(ldap_project[1][PROJECT_ATTRIBUTES['members']]):
+                    if DEBUG: print('ldap_member=', ldap_member)
+                    if ldap_member not in user_ids:
+                        add_error('ProjectMemberhsip - User.DoesNotExist', ldap_member)
+                        continue
+                    user_id = user_ids[ldap_member]
+                    current_members.add(user_id)
+                    project_member = previous_members.get(user_id)
+                    if project_member is None:
+                        ProjectMember(member_id=user_id, project=project, role=default_role,
+                                      start_date=TIME_NOW).save()
+                        print '   > Member added: %s' % ldap_member
+            else:
+                add_error('Project has no members', project_name)
+                print '   This project has no members.'
 
-        # Get members of groups
-        # print('ldap_dataset[1]=', ldap_dataset[1])
-        # print('settings.LDAP_DATASET_FIELD_MEMBERS=', settings.LDAP_DATASET_FIELD_MEMBERS)
-        if settings.LDAP_DATASET_FIELD_MEMBERS in ldap_dataset[1]:
+            print('   Members=%s' % len(current_members))
+            for user_id, disabled_member in previous_members.items():
+                if user_id not in current_members and disabled_member.active():
+                    disabled_member.end_date = TIME_NOW
+                    disabled_member.save()
+                    print('   > Member disabled: %s' % usernames.get(user_id))
+
+    import_in_chunks('projects', get_ldap_projects(), import_chunk, chunk_size)
+
+
+def import_datasets(chunk_size=DEFAULT_CHUNK_SIZE):
+    project_ids = get_project_ids()
+    project_names = dict((project_id, ldap_name) for ldap_name, project_id in project_ids.items())
+
+    def import_chunk(ldap_datasets):
+        entries = []
+        for ldap_dataset in ldap_datasets:
+            if DEBUG: print('ldap_dataset=', ldap_dataset)
+            try:
+                dataset_cn = ldap_dataset[1]['cn'][0].encode('ascii', 'ignore')
+                ldap_id = ldap_dataset[1]['gidNumber'][0].encode('ascii', 'ignore')
+                name = ldap_dataset[1][DATASET_ATTRIBUTES['ldap_name']][0].encode('ascii', 'ignore')
+            except (KeyError, IndexError):
+                add_error('Dataset without name', ldap_dataset)
+                continue
+            entries.append((ldap_dataset, dataset_cn, ldap_id, name))
+
+        datasets = dict((dataset.ldap_name, dataset) for dataset in
+                        Dataset.objects.filter(ldap_name__in=[dataset_cn for _, dataset_cn, _, _ in entries]))
+        for ldap_dataset, dataset_cn, ldap_id, name in entries:
+            print '\n Processing Dataset: %s' % name
+            try:
+                description = ldap_dataset[1][DATASET_ATTRIBUTES['description']][0].encode('ascii', 'ignore')
+            except (KeyError, IndexError):
+                add_error('Dataset without description', dataset_cn)
+                description = None
+
+            # retrieve or create
+            dataset = datasets.get(dataset_cn) or Dataset(ldap_name=dataset_cn, ldap_id=ldap_id)
+            dataset.description = description
+            # doi <- name without 'dataset-'
+            dataset.dataset_id = name.split(',')[0][8:]
+            dataset.name = name.replace('-', ' ').title()
+            dataset.ldap_id = ldap_id
+            dataset.data_classification = Dataset.DATA_CLASSIFICATION_YELLOW
+            dataset.save()
+            datasets[dataset_cn] = dataset
+
+        accesses = {}
+        for access in DatasetAccess.objects.filter(dataset__in=[d.id for d in datasets.values()]):
+            accesses.setdefault(access.dataset_id, {})[access.project_id] = access
+        for ldap_dataset, dataset_cn, ldap_id, name in entries:
+            if settings.LDAP_DATASET_FIELD_MEMBERS not in ldap_dataset[1]:
+                add_error('Dataset has no permissions', name)
+                continue
+            dataset = datasets[dataset_cn]
+            previous_accesses = accesses.get(dataset.id, {})
             current_projects = get_members(ldap_dataset[1][settings.LDAP_DATASET_FIELD_MEMBERS])
 
             print '  Disabling old members:'
-            for previous_access in dataset.datasetaccess_set.all():
-                if previous_access.status() in \
-                        (DatasetAccess.STATUS_APPROVED or DatasetAccess.STATUS_ACTIVE) \
-                        and previous_access.project.ldap_name not in current_projects:
-                    previous_access.expire_at = TIME_NOW
+            for project_id, previous_access in previous_accesses.items():
+                if previous_access.status() in (DatasetAccess.STATUS_APPROVED, DatasetAccess.STATUS_ACTIVE) \
+                        and project_names.get(project_id) not in current_projects:
+                    previous_access.end_at = TIME_NOW
                     previous_access.save()
-                    print '   > Disabled:', previous_access.project
+                    print '   > Disabled:', project_names.get(project_id)
 
             print '  Adding/Updating current permissions:', current_projects
             for project_name in current_projects:
                 print '   > Project with access:', project_name
-                try:
-                    project = Project.objects.get(ldap_name=project_name)
-                except Project.DoesNotExist:
+                if project_name not in project_ids:
                     add_error('[Dataset Access] Project does not exists', project_name)
                     continue
+                if project_ids[project_name] not in previous_accesses:
+                    DatasetAccess(dataset=dataset, project_id=project_ids[project_name]).save()
 
-                try:
-                    access = DatasetAccess.objects.get(dataset=dataset, project=project)
-                except DatasetAccess.DoesNotExist:
-                    access = DatasetAccess(dataset=dataset, project=project)
-                    # access.granted_at = TIME_NOW
-                # if not access.requested_at:
-                    # access.requested_at = TIME_NOW
-                # if not access.reviewed_at:
-                #     access.reviewed_at = TIME_NOW
-                access.save()
-        else:
-            add_error('Dataset has no permissions', name)
-
-
-def import_users():
-    ldap_users = get_ldap_users()
-    for ldap_user in ldap_users:
-        try:
-            username = ldap_user[1][USER_ATTRIBUTES['username']][0].encode('ascii', 'ignore')
-            ldap_id = ldap_user[1][USER_ATTRIBUTES['ldap_id']][0].encode('ascii', 'ignore')
-        except:
-            add_error('User without username (%s)' % USER_ATTRIBUTES['username'], ldap_user)
-            pass
-        else:
-            try:
-                email = ldap_user[1][USER_ATTRIBUTES['email']][0].encode('ascii', 'ignore')
-            except:
-                email = '%s@undefined.adrf.info' % username
-                add_error('User without email (%s)' % USER_ATTRIBUTES['email'], username)
-            try:
-                first_name = ldap_user[1][USER_ATTRIBUTES['first_name']][0].encode('ascii', 'ignore')
-            except:
-                first_name = MISSING_INFO_FLAG
-                add_error('User without first name (%s)' % USER_ATTRIBUTES['first_name'], username)
+    # The events of the datasets of a chunk are queued with the chunk.
+    def import_chunk_coalescing_events(ldap_datasets):
+        with event_hooks.coalesce_dataset_events():
+            import_chunk(ldap_datasets)
 
-            try:
-                last_name = ldap_user[1][USER_ATTRIBUTES['last_name']][0].encode('ascii', 'ignore')
-            except:
-                last_name = MISSING_INFO_FLAG
-                add_error('User without last name (%s)' % USER_ATTRIBUTES['last_name'], username)
+    import_in_chunks('datasets', get_ldap_datasets(), import_chunk_coalescing_events, chunk_size)
 
-            try:
-                ldap_lock_time = ldap_user[1][USER_ATTRIBUTES['ldap_lock_time']][0].encode('ascii', 'ignore')
-                ldap_lock_time = datetime.datetime.strptime(ldap_lock_time, "%Y%m%d%H%M%SZ")
-                ldap_lock_time = ldap_lock_time.replace(tzinfo=pytz.utc)
-            except:
-                ldap_lock_time = None
 
-            try:
-                ldap_last_auth_time = ldap_user[1][USER_ATTRIBUTES['ldap_last_auth_time']][0].encode('ascii', 'ignore')
-                ldap_last_auth_time = datetime.datetime.strptime(ldap_last_auth_time, "%Y%m%d%H%M%SZ")
-                ldap_last_auth_time = ldap_last_auth_time.replace(tzinfo=pytz.utc)
-            except:
-                ldap_last_auth_time = None
+def parse_ldap_time(ldap_user, attribute):
+    try:
+        value = ldap_user[1][USER_ATTRIBUTES[attribute]][0].encode('ascii', 'ignore')
+        return datetime.datetime.strptime(value, "%Y%m%d%H%M%SZ").replace(tzinfo=pytz.utc)
+    except (KeyError, IndexError, ValueError):
+        return None
 
-            try:
-                ldap_last_pwd_change = ldap_user[1][USER_ATTRIBUTES['ldap_last_pwd_change']][0].encode('ascii', 'ignore')
-                ldap_last_pwd_change = datetime.datetime.strptime(ldap_last_pwd_change, "%Y%m%d%H%M%SZ")
-                ldap_last_pwd_change = ldap_last_pwd_change.replace(tzinfo=pytz.utc)
-            except:
-                ldap_last_pwd_change = None
-
-            if USER_ATTRIBUTES["ldap_ppolicy_configuration_dn"] in ldap_user[1]:
-                system_user = True
-            else:
-                system_user = False
 
-            try:
-                user = User.objects.get(ldap_name=username)
-                print("updating user '%s' ..." % username)
-            except User.DoesNotExist:
-                user = User(ldap_name=username,
-                            ldap_id=ldap_id,
-                            email=email,
-                            first_name=first_name,
-                            last_name=last_name)
-
-                print("Creating user '%s' ..." % username)
-            else:
-                if not user.ldap_id == int(ldap_id):
-                    user.ldap_id = ldap_id
-                    message = "User '%s' ldap_id updated." % username
-                    print(message)
-                if not user.email == email:
-                    user.email = email
-                    message = "User '%s' email updated." % username
-                    print(message)
-                if not user.first_name == first_name:
-                    user.first_name = first_name
-                    message = "User '%s' first name updated." % username
-                    print(message)
-                if not user.last_name == last_name:
-                    user.last_name = last_name
-                    message = "User '%s' last name updated." % username
-                    print(message)
-
-            user.system_user = system_user
-            user.ldap_lock_time = ldap_lock_time
-            user.ldap_last_auth_time = ldap_last_auth_time
-            user.ldap_last_pwd_change = ldap_last_pwd_change
-            try:
-                if USER_ATTRIBUTES['ldap_lock_time'] in ldap_user[1] and \
-                                ldap_user[1][USER_ATTRIBUTES['ldap_lock_time']][0].encode('ascii', 'ignore') == "000001010000Z":
-                    user.status = User.STATUS_DISABLED
-                elif ldap_lock_time:
-                    user.status = User.STATUS_LOCKED_WRONG_PASSWD
-                else:
-                    user.status = User.STATUS_ACTIVE
-                user.save()
-            except IntegrityError, ex:
-                add_error('User UID duplicated %s (%s):' % (ldap_id, username), ex.message)
+def import_users(chunk_size=DEFAULT_CHUNK_SIZE):
 
+    def import_chunk(ldap_users):
+        entries = []
+        for ldap_user in ldap_users:
+            try:
+                username = ldap_user[1][USER_ATTRIBUTES['username']][0].encode('ascii', 'ignore')
+                ldap_id = ldap_user[1][USER_ATTRIBUTES['ldap_id']][0].encode('ascii', 'ignore')
+            except (KeyError, IndexError):
+                add_error('User without username (%s)' % USER_ATTRIBUTES['username'], ldap_user)
+                continue
+            entries.append((ldap_user, username, ldap_id))
+
+        users = dict((user.ldap_name, user) for user in
+                     User.objects.filter(ldap_name__in=[username for _, username, _ in entries]))
+        # The DjangoUsers of the chunk are synced in one pass.
+        with batch_django_user_sync():
+            for ldap_user, username, ldap_id in entries:
+                import_user(ldap_user, username, ldap_id, users.get(username))
+
+    import_in_chunks('users', get_ldap_users(), import_chunk, chunk_size)
     message = "   > Users are synchronized."
     print(message)
-    return
 
 
-def run():
-    print 'Start time:', TIME_NOW
-    print('\n\nImporting Users...')
-    import_users()
+def import_user(ldap_user, username, ldap_id, user):
+    try:
+        email = ldap_user[1][USER_ATTRIBUTES['email']][0].encode('ascii', 'ignore')
+    except (KeyError, IndexError):
+        email = '%s@undefined.adrf.info' % username
+        add_error('User without email (%s)' % USER_ATTRIBUTES['email'], username)
+    try:
+        first_name = ldap_user[1][USER_ATTRIBUTES['first_name']][0].encode('ascii', 'ignore')
+    except (KeyError, IndexError):
+        first_name = MISSING_INFO_FLAG
+        add_error('User without first name (%s)' % USER_ATTRIBUTES['first_name'], username)
+
+    try:
+        last_name = ldap_user[1][USER_ATTRIBUTES['last_name']][0].encode('ascii', 'ignore')
+    except (KeyError, IndexError):
+        last_name = MISSING_INFO_FLAG
+        add_error('User without last name (%s)' % USER_ATTRIBUTES['last_name'], username)
+
+    if user is None:
+        user = User(ldap_name=username,
+                    ldap_id=ldap_id,
+                    email=email,
+                    first_name=first_name,
+                    last_name=last_name)
+        print("Creating user '%s' ..." % username)
+    else:
+        print("updating user '%s' ..." % username)
+        if not user.ldap_id == int(ldap_id):
+            user.ldap_id = ldap_id
+            print("User '%s' ldap_id updated." % username)
+        if not user.email == email:
+            user.email = email
+            print("User '%s' email updated." % username)
+        if not user.first_name == first_name:
+            user.first_name = first_name
+            print("User '%s' first name updated." % username)
+        if not user.last_name == last_name:
+            user.last_name = last_name
+            print("User '%s' last name updated." % username)
+
+    user.system_user = USER_ATTRIBUTES["ldap_ppolicy_configuration_dn"] in ldap_user[1]
+    user.ldap_lock_time = parse_ldap_time(ldap_user, 'ldap_lock_time')
+    user.ldap_last_auth_time = parse_ldap_time(ldap_user, 'ldap_last_auth_time')
+    user.ldap_last_pwd_change = parse_ldap_time(ldap_user, 'ldap_last_pwd_change')
+    if USER_ATTRIBUTES['ldap_lock_time'] in ldap_user[1] and \
+            ldap_user[1][USER_ATTRIBUTES['ldap_lock_time']][0].encode('ascii', 'ignore') == "000001010000Z":
+        user.status = User.STATUS_DISABLED
+    elif user.ldap_lock_time:
+        user.status = User.STATUS_LOCKED_WRONG_PASSWD
+    else:
+        user.status = User.STATUS_ACTIVE
+    try:
+        # A savepoint, so a duplicated user does not break the chunk's transaction.
+        with transaction.atomic():
+            user.save()
+    except IntegrityError, ex:
+        add_error('User UID duplicated %s (%s):' % (ldap_id, username), ex.message)
+
+
+IMPORTS = {
+    'users': ('Importing Users...', import_users),
+    'groups': ('Importing DfRoles (Groups) and membership...', import_groups),
+    'projects': ('Importing Projects and membership...', import_projects),
+    'datasets': ('Importing Datasets and project permissions...', import_datasets),
+}
 
-    print('\nImporting DfRoles (Groups) and membership...')
-    import_groups()
 
-    print('\nImporting Projects and membership...')
-    import_projects()
+def run(*args):
+    global CHECKPOINT
+    options = dict(arg.split('=', 1) for arg in args if '=' in arg)
+    chunk_size = int(options.get('chunk', DEFAULT_CHUNK_SIZE))
+    path = options.get('checkpoint', DEFAULT_CHECKPOINT)
+    if 'resume' in args:
+        CHECKPOINT = ImportCheckpoint.load(path)
+    else:
+        CHECKPOINT = ImportCheckpoint(path)
+        CHECKPOINT.remove()
 
-    print('\nImporting Datasets and project permissions...')
-    import_datasets()
+    print 'Start time:', TIME_NOW
+    for phase in PHASES:
+        message, import_phase = IMPORTS[phase]
+        if phase in CHECKPOINT.done_phases:
+            print('\n%s already done.' % message)
+            continue
+        print('\n\n%s' % message)
+        import_phase(chunk_size)
 
     print('\n\n=== IMPORT SUMMARY ===')
     print('Total Users: %s' % User.objects.all().count())
@@ -476,6 +623,7 @@ def run():
     print('Total User-Roles: %s' % UserDfRole.objects.all().count())
     print('Total Datasets: %s' % Dataset.objects.all().count())
     print('Total Dataset Access: %s' % DatasetAccess.objects.all().count())
-    errors = ['{0}: {1}'.format(e, ERRORS[e]) for e in ERRORS]
+    errors = ['{0}: {1}'.format(e, CHECKPOINT.errors[e]) for e in CHECKPOINT.errors]
     print '\033[31m LDAP Errors:\n > %s \033[0m' % '\n > '.join(sorted(errors))
     print('=== ============== ===')
+    CHECKPOINT.remove()
@@ -7,6 +7,7 @@ import urllib
 
 from django.db import transaction
 
+from data_facility_admin import event_hooks
 from data_facility_admin.models import *
 from data_facility_admin.factories import *
 from data_facility_metadata.models import *
@@ -129,6 +130,11 @@ def grab_nyc_open_data_datasets():
 
 @transaction.atomic
 def run():
+    with event_hooks.coalesce_dataset_events(summary=True):
+        load_data()
+
+
+def load_data():
     try:
         print('Loading Datasets from CSV')
         adrf_metadata_file = 'ADRF_Dataset_Metadata-supplementary-datasets-20181220.csv'
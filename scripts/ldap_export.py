@@ -2,8 +2,13 @@ from data_facility_admin.helpers import LDAPHelper
 
 def run(*args):
     helper = LDAPHelper()
-    helper.export_users()
-    helper.export_projects()
-    helper.export_df_roles()
-    helper.export_datasets()
+    if 'incremental' in args:
+        helper.export_incremental(parallel='parallel' in args)
+    elif 'parallel' in args:
+        helper.export_all()
+    else:
+        helper.export_users()
+        helper.export_projects()
+        helper.export_df_roles()
+        helper.export_datasets()
     helper.close()
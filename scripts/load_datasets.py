@@ -13,7 +13,7 @@ from data_facility_metadata.models import *
 import csv
 from os import listdir
 from os.path import isfile, join
-from data_facility_admin import metadata_serializer
+from data_facility_admin import event_hooks, metadata_serializer
 
 DATASETS_SEARCH_META_FOLDER = 'data/datasets/search_metadata'
 DATASETS_DETAIL_META_FOLDER = 'data/datasets/detailed_metadata'
@@ -51,6 +51,12 @@ def get_detailed_metadata_gmeta(dataset):
 
 
 def update_or_create_datasets(datasets):
+    # One event per dataset, even if it is saved more than once.
+    with event_hooks.coalesce_dataset_events():
+        _update_or_create_datasets(datasets)
+
+
+def _update_or_create_datasets(datasets):
     for dataset_id in sorted(datasets):
         # if dataset_id not in ['dataset-adrf-000005']: continue
         try: